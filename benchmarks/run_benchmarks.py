@@ -0,0 +1,323 @@
+"""Benchmarks for the hot paths of dandi-nwb-meta, on generated fixtures.
+
+Covers h5_to_object on synthetic NWB-like HDF5 files of increasing size,
+serialization (_remove_empty_dicts_in_dict and _save_output_to_file) and
+loading (_load_existing_output_from_file) of a large dandiset output, the
+same in the compact encoding, and the aggregation done by generate_md.main.
+No network access is needed.
+
+Each benchmark reports its throughput (best of --repeat runs) and its peak
+traced memory (from a separate run under tracemalloc, which slows it down).
+
+    python benchmarks/run_benchmarks.py --scale medium --save-baseline baseline.json
+    ... make changes ...
+    python benchmarks/run_benchmarks.py --scale medium --baseline baseline.json
+
+With --baseline, the exit code is 1 if any benchmark is slower or uses more
+memory than the baseline by more than --tolerance.
+"""
+import argparse
+import contextlib
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+import warnings
+from typing import Callable, Dict, List
+
+import h5py
+import numpy as np
+from h5tojson import h5_to_object, H5ToJsonOpts
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "workflow_scripts"))
+
+from dandi_nwb_meta import (  # noqa: E402
+    DandiNwbMetaAsset,
+    DandiNwbMetaDandiset,
+    _load_existing_output,
+    _load_existing_output_from_file,
+    _remove_empty_dicts_in_dict,
+    _save_output,
+    _save_output_to_file,
+)
+from generate_md import ReportAggregator  # noqa: E402
+
+
+SCALES = {
+    # Number of electrical series per HDF5 file, and assets x series for the dandiset
+    "small": {"file_series": [10, 50], "num_assets": 50, "asset_series": 20},
+    "medium": {"file_series": [10, 100, 500], "num_assets": 200, "asset_series": 100},
+    "large": {"file_series": [10, 100, 1000, 5000], "num_assets": 1000, "asset_series": 200},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark (the best is kept)")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--save-baseline", help="Write the results as a baseline to this file")
+    parser.add_argument("--baseline", help="Compare against this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    args = parser.parse_args()
+
+    scale = SCALES[args.scale]
+    results: Dict[str, dict] = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for num_series in scale["file_series"]:
+            fname = os.path.join(tmpdir, f"synthetic_{num_series}.nwb")
+            num_objects = write_nwb_like_file(fname, num_series, random.Random(num_series))
+            results[f"h5_to_object[{num_series} series]"] = measure(
+                lambda: _h5_to_object(fname), count=num_objects, unit="objects", repeat=args.repeat
+            )
+
+        X = make_dandiset(tmpdir, scale["num_assets"], scale["asset_series"])
+        num_assets = len(X.nwb_assets)
+        output_fname = os.path.join(tmpdir, "output.json")
+        results["_remove_empty_dicts_in_dict"] = measure(
+            lambda: [_remove_empty_dicts_in_dict(a.dict()) for a in X.nwb_assets],
+            count=num_assets, unit="assets", repeat=args.repeat,
+        )
+        results["_save_output_to_file"] = measure(
+            lambda: _save_output_to_file(output_fname, X),
+            count=num_assets, unit="assets", repeat=args.repeat,
+        )
+        print(f"Output size: {os.path.getsize(output_fname) / 1e6:.1f} MB")
+        # Compact outputs are written to dandisets/ in the working directory
+        compact_dir = os.path.join(tmpdir, "compact")
+        os.makedirs(compact_dir)
+        with _working_directory(compact_dir):
+            results["_save_output[compact]"] = measure(
+                lambda: _save_output(None, X.dandiset_id, X, encoding="compact"),
+                count=num_assets, unit="assets", repeat=args.repeat,
+            )
+            print(f"Compact output size: {os.path.getsize(f'dandisets/{X.dandiset_id}.dnmb') / 1e6:.1f} MB")
+        dandiset_id = X.dandiset_id
+        del X
+        results["_load_existing_output_from_file[lazy]"] = measure(
+            lambda: _load_existing_output_from_file(output_fname, lazy=True),
+            count=num_assets, unit="assets", repeat=args.repeat,
+        )
+        results["_load_existing_output_from_file"] = measure(
+            lambda: _load_existing_output_from_file(output_fname, lazy=False),
+            count=num_assets, unit="assets", repeat=args.repeat,
+        )
+        results["generate_md aggregation"] = measure(
+            lambda: _aggregate(output_fname), count=num_assets, unit="assets", repeat=args.repeat
+        )
+        with _working_directory(compact_dir):
+            results["_load_existing_output[compact, lazy]"] = measure(
+                lambda: _load_existing_output(None, dandiset_id, lazy=True),
+                count=num_assets, unit="assets", repeat=args.repeat,
+            )
+            results["_load_existing_output[compact]"] = measure(
+                lambda: _load_existing_output(None, dandiset_id, lazy=False),
+                count=num_assets, unit="assets", repeat=args.repeat,
+            )
+            results["generate_md aggregation[compact]"] = measure(
+                lambda: _aggregate_output(_load_existing_output(None, dandiset_id, lazy=True)),
+                count=num_assets, unit="assets", repeat=args.repeat,
+            )
+
+    _print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"scale": args.scale, "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline["scale"] != args.scale:
+            raise ValueError(f"The baseline is for scale {baseline['scale']}")
+        regressions = find_regressions(results, baseline["results"], args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION: {r}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions")
+
+
+def measure(fn: Callable[[], object], *, count: int, unit: str, repeat: int) -> dict:
+    """Runs fn repeat times for the timing and once more for the peak memory."""
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "seconds": best,
+        "count": count,
+        "unit": unit,
+        "throughput": count / best,
+        "peak_mb": peak / 1e6,
+    }
+
+
+def find_regressions(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    ret = []
+    for name, b in baseline.items():
+        r = results.get(name)
+        if r is None:
+            ret.append(f"{name}: missing")
+            continue
+        if r["throughput"] < b["throughput"] * (1 - tolerance):
+            ret.append(f"{name}: {r['throughput']:.1f} {r['unit']}/s, baseline {b['throughput']:.1f}")
+        if r["peak_mb"] > b["peak_mb"] * (1 + tolerance):
+            ret.append(f"{name}: peak {r['peak_mb']:.1f} MB, baseline {b['peak_mb']:.1f} MB")
+    return ret
+
+
+def write_nwb_like_file(fname: str, num_series: int, rng: random.Random) -> int:
+    """Writes an HDF5 file with the structure of an NWB file; returns its number of objects.
+
+    Dataset values are left unwritten (except small ones), so files stay small.
+    """
+    num_objects = 0
+
+    def _typed_group(parent, name: str, neurodata_type: str):
+        nonlocal num_objects
+        num_objects += 1
+        g = parent.create_group(name)
+        g.attrs["neurodata_type"] = neurodata_type
+        g.attrs["namespace"] = "core"
+        g.attrs["object_id"] = str(uuid.UUID(int=rng.getrandbits(128)))
+        return g
+
+    def _dataset(parent, name: str, **kwargs):
+        nonlocal num_objects
+        num_objects += 1
+        return parent.create_dataset(name, **kwargs)
+
+    with h5py.File(fname, "w") as f:
+        num_objects += 1
+        f.attrs["neurodata_type"] = "NWBFile"
+        f.attrs["namespace"] = "core"
+        f.attrs["nwb_version"] = "2.6.0"
+        f.attrs["object_id"] = str(uuid.UUID(int=rng.getrandbits(128)))
+        _dataset(f, "session_description", data="synthetic session")
+        _dataset(f, "identifier", data=str(uuid.UUID(int=rng.getrandbits(128))))
+        _dataset(f, "session_start_time", data="2024-01-01T00:00:00")
+        acquisition = f.create_group("acquisition")
+        for i in range(num_series):
+            g = _typed_group(acquisition, f"ElectricalSeries{i}", "ElectricalSeries")
+            g.attrs["description"] = f"series {i}"
+            g.attrs["comments"] = "no comments"
+            d = _dataset(
+                g, "data",
+                shape=(rng.randint(10_000, 1_000_000), 32), dtype="int16",
+                chunks=(1000, 32), compression="gzip",
+            )
+            d.attrs["conversion"] = 1e-6
+            d.attrs["offset"] = 0.0
+            d.attrs["unit"] = "volts"
+            d = _dataset(g, "starting_time", data=0.0)
+            d.attrs["rate"] = 30000.0
+            d.attrs["unit"] = "seconds"
+            _dataset(g, "electrodes", data=np.arange(32, dtype="int64"))
+        units = _typed_group(f, "units", "Units")
+        units.attrs["colnames"] = ["spike_times", "obs_intervals"]
+        units.attrs["description"] = "units"
+        _dataset(units, "id", data=np.arange(num_series, dtype="int64"))
+        _dataset(units, "spike_times", shape=(num_series * 1000,), dtype="float64")
+        _dataset(units, "spike_times_index", data=np.arange(num_series, dtype="int64") * 1000)
+        general = f.create_group("general")
+        devices = general.create_group("devices")
+        _typed_group(devices, "probe", "Device")
+    return num_objects
+
+
+def make_dandiset(tmpdir: str, num_assets: int, num_series: int) -> DandiNwbMetaDandiset:
+    """Creates a dandiset output from the metadata of generated HDF5 files.
+
+    The assets alternate between two layouts and have their own object ids.
+    """
+    trees = []
+    for n in [num_series, num_series + 1]:
+        fname = os.path.join(tmpdir, f"asset_{n}.nwb")
+        write_nwb_like_file(fname, n, random.Random(n))
+        trees.append(json.dumps(_h5_to_object(fname).dict()))
+    rng = random.Random(0)
+    assets = []
+    for i in range(num_assets):
+        tree = json.loads(trees[i % 2])
+        _replace_object_ids(tree, rng)
+        assets.append(
+            DandiNwbMetaAsset(
+                asset_id=str(uuid.UUID(int=rng.getrandbits(128))),
+                asset_path=f"sub-{i}/sub-{i}_ecephys.nwb",
+                nwb_metadata=tree,
+                download_url=f"https://api.dandiarchive.org/api/assets/{i}/download/",
+                blob_id=str(uuid.UUID(int=rng.getrandbits(128))),
+            )
+        )
+    return DandiNwbMetaDandiset(dandiset_id="000000", dandiset_version="draft", nwb_assets=assets)
+
+
+def _replace_object_ids(x, rng: random.Random):
+    if isinstance(x, dict):
+        for k, v in x.items():
+            if k == "object_id" and isinstance(v, str):
+                x[k] = str(uuid.UUID(int=rng.getrandbits(128)))
+            else:
+                _replace_object_ids(v, rng)
+    elif isinstance(x, list):
+        for v in x:
+            _replace_object_ids(v, rng)
+
+
+def _h5_to_object(fname: str):
+    # Same options as _extract_nwb_metadata, but reading a local file
+    opts = H5ToJsonOpts(skip_all_dataset_data=True)
+    with open(fname, "rb") as f:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return h5_to_object(f, opts)
+
+
+def _aggregate(output_fname: str) -> ReportAggregator:
+    # What generate_md.main does for each dandiset, without the downloads
+    return _aggregate_output(_load_existing_output_from_file(output_fname, lazy=True))
+
+
+def _aggregate_output(X) -> ReportAggregator:
+    aggregator = ReportAggregator()
+    for a in X.nwb_assets:
+        aggregator.add_asset(X.dandiset_id, a)
+    return aggregator
+
+
+@contextlib.contextmanager
+def _working_directory(dirname: str):
+    cwd = os.getcwd()
+    os.chdir(dirname)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def _print_results(results: Dict[str, dict]):
+    print("")
+    print(f"{'Benchmark':45} {'Seconds':>9} {'Throughput':>20} {'Peak MB':>9}")
+    for name, r in results.items():
+        throughput = f"{r['throughput']:.1f} {r['unit']}/s"
+        print(f"{name:45} {r['seconds']:9.3f} {throughput:>20} {r['peak_mb']:9.1f}")
+
+
+if __name__ == "__main__":
+    main()
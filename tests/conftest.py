@@ -0,0 +1,83 @@
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple, Union
+
+import pytest
+
+# The workflow scripts import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "workflow_scripts"))
+
+# status, headers, body
+Response = Tuple[int, Dict[str, str], bytes]
+
+
+class MockHttpServer:
+    """A local HTTP server that answers with programmed responses.
+
+    Responses are set by path (with or without the query string); a path
+    given several responses answers with them in turn and then repeats the
+    last one. A response can also be a function of the request. Other paths
+    answer 404. Every request is recorded as (method, path, headers).
+    """
+
+    def __init__(self):
+        self.routes: Dict[str, List[Union[Response, Callable[[str, str, dict], Response]]]] = {}
+        self.requests: List[Tuple[str, str, dict]] = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._respond(send_body=True)
+
+            def do_HEAD(self):
+                self._respond(send_body=False)
+
+            def _respond(self, send_body: bool):
+                status, headers, body = server._get_response(self.command, self.path, dict(self.headers))
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def add(self, path: str, status: int = 200, body: bytes = b"", headers: Union[Dict[str, str], None] = None):
+        self.routes.setdefault(path, []).append((status, headers or {}, body))
+
+    def add_handler(self, path: str, fn: Callable[[str, str, dict], Response]):
+        self.routes.setdefault(path, []).append(fn)
+
+    def get_requests(self, path: str) -> List[Tuple[str, str, dict]]:
+        return [r for r in self.requests if r[1].split("?")[0] == path]
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _get_response(self, method: str, path: str, headers: dict) -> Response:
+        with self._lock:
+            self.requests.append((method, path, headers))
+            responses = self.routes.get(path) or self.routes.get(path.split("?")[0])
+            if not responses:
+                return 404, {}, b""
+            response = responses.pop(0) if len(responses) > 1 else responses[0]
+        return response(method, path, headers) if callable(response) else response
+
+
+@pytest.fixture
+def http_server():
+    server = MockHttpServer()
+    yield server
+    server.close()
@@ -0,0 +1,123 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from archive_index import ArchiveIndex
+
+
+class _Metadata:
+    """Stands for an H5ToJsonFile; counts how often its groups are read."""
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.num_reads = 0
+
+    def get_all_groups_and_datasets(self):
+        self.num_reads += 1
+        return {path: SimpleNamespace(attributes=attrs) for path, attrs in self.groups.items()}, {}
+
+
+def _typed(neurodata_type, namespace="core"):
+    return {"neurodata_type": neurodata_type, "namespace": namespace}
+
+
+ECEPHYS = {
+    "/": _typed("NWBFile"),
+    "/acquisition/ElectricalSeries": _typed("ElectricalSeries"),
+    "/units": _typed("Units"),
+    "/general": {},
+}
+OPHYS = {
+    "/": _typed("NWBFile"),
+    "/processing/ophys/ImageSegmentation": _typed("ImageSegmentation"),
+    "/processing/ophys/custom": _typed("CustomType", namespace="ndx-custom"),
+}
+
+
+def _asset(asset_id, groups, layout_id=None):
+    x = SimpleNamespace(asset_id=asset_id, nwb_metadata=_Metadata(groups))
+    if layout_id is not None:
+        x.layout_id = layout_id
+    return x
+
+
+def _make_index():
+    index = ArchiveIndex()
+    index.update_dandiset("000001", [_asset("a", ECEPHYS), _asset("b", OPHYS)])
+    index.update_dandiset("000002", [_asset("c", ECEPHYS)])
+    return index
+
+
+def test_find_assets():
+    index = _make_index()
+    assert index.find_assets(neurodata_type="core.Units") == [("000001", "a"), ("000002", "c")]
+    assert index.find_assets(namespace="ndx-custom") == [("000001", "b")]
+    assert index.find_assets(path="/") == [("000001", "a"), ("000001", "b"), ("000002", "c")]
+    # The terms are intersected per asset
+    assert index.find_assets(neurodata_type="core.NWBFile", namespace="ndx-custom") == [("000001", "b")]
+    assert index.find_assets(neurodata_type="core.Units", path="/processing/ophys/custom") == []
+    assert index.find_assets(neurodata_type="core.Missing") == []
+    assert index.find_dandisets(neurodata_type="core.ElectricalSeries") == ["000001", "000002"]
+    assert index.get_dandiset_neurodata_types("000002") == {"core.NWBFile", "core.ElectricalSeries", "core.Units"}
+    with pytest.raises(ValueError):
+        index.find_assets()
+
+
+def test_find_paths():
+    index = _make_index()
+    assert index.find_paths("core.Units") == {"/units": 2}
+    assert index.find_paths("core.NWBFile") == {"/": 3}
+    assert index.find_paths("core.Missing") == {}
+    # Untyped groups are not indexed
+    assert "/general" not in index.paths
+
+
+def test_update_adds_and_removes_assets():
+    index = _make_index()
+    kept = _asset("a", ECEPHYS)
+    assert index.update_dandiset("000001", [kept, _asset("d", OPHYS)])
+    assert index.find_assets(namespace="ndx-custom") == [("000001", "d")]
+    assert index.dandisets["000001"] == {"a", "d"}
+    # The metadata of indexed assets is not read again
+    assert kept.nwb_metadata.num_reads == 0
+    assert not index.update_dandiset("000001", [_asset("a", ECEPHYS), _asset("d", OPHYS)])
+
+
+def test_empty_postings_are_pruned():
+    index = _make_index()
+    index.update_dandiset("000001", [_asset("a", ECEPHYS)])
+    for term in ["core.ImageSegmentation", "ndx-custom.CustomType"]:
+        assert term not in index.neurodata_types
+    assert "ndx-custom" not in index.namespaces
+    assert "/processing/ophys/custom" not in index.paths
+    index.update_dandiset("000001", [])
+    index.update_dandiset("000002", [])
+    assert index.neurodata_types == {}
+    assert index.namespaces == {}
+    assert index.paths == {}
+    # A dandiset without assets is still recorded as indexed
+    assert index.dandisets == {"000001": set(), "000002": set()}
+    assert not index.update_dandiset("000001", [])
+
+
+def test_terms_are_read_once_per_layout():
+    assets = [_asset(f"a{i}", ECEPHYS, layout_id="layout-0") for i in range(3)]
+    assets.append(_asset("b", OPHYS, layout_id="layout-1"))
+    index = ArchiveIndex()
+    index.update_dandiset("000001", assets)
+    assert [a.nwb_metadata.num_reads for a in assets] == [1, 0, 0, 1]
+    assert index.find_assets(neurodata_type="core.Units") == [("000001", f"a{i}") for i in range(3)]
+
+
+def test_dict_round_trip():
+    index = _make_index()
+    # The dict is saved as JSON
+    loaded = ArchiveIndex.from_dict(json.loads(json.dumps(index.to_dict())))
+    assert loaded.to_dict() == index.to_dict()
+    assert loaded.neurodata_types == index.neurodata_types
+    assert loaded.paths == index.paths
+    assert loaded.dandisets == index.dandisets
+    # The loaded index can be updated
+    loaded.update_dandiset("000002", [])
+    assert loaded.find_assets(neurodata_type="core.Units") == [("000001", "a")]
@@ -0,0 +1,91 @@
+import io
+
+import pytest
+
+from compact_encoding import (
+    FORMAT_VERSION,
+    MAGIC,
+    CompactOutput,
+    decode_body,
+    encode_output,
+    is_compact_output,
+    write_output,
+)
+
+
+def _make_assets(n):
+    return [
+        (
+            {"asset_id": f"asset-{i}", "asset_path": f"sub-{i}/sub-{i}.nwb", "blob_id": None},
+            {
+                "nwb_metadata": {
+                    "file": {
+                        "attributes": {"neurodata_type": "NWBFile", "namespace": "core", "object_id": f"id-{i}"},
+                        "datasets": {"data": {"shape": [i, 32], "dtype": "<i2", "chunks": None}},
+                    }
+                },
+                "values": [1, -2, 3.5, True, False, None, "é", 2 ** 40],
+            },
+        )
+        for i in range(n)
+    ]
+
+
+def test_round_trip():
+    header = {"dandiset_id": "000001", "dandiset_version": "draft", "layouts": {"abc": {"file": {}}}}
+    assets = _make_assets(5)
+    data = encode_output(header, assets)
+    assert is_compact_output(data)
+    x = CompactOutput(data)
+    assert x.header == header
+    assert [h for h, _ in x.assets] == [h for h, _ in assets]
+    assert [decode_body(body) for _, body in x.assets] == [body for _, body in assets]
+
+
+def test_packed_bodies_are_reused():
+    x = CompactOutput(encode_output({}, _make_assets(3)))
+    y = CompactOutput(encode_output({}, x.assets))
+    assert y.assets == x.assets
+
+
+def test_empty_output():
+    x = CompactOutput(encode_output({"dandiset_id": "000001"}, []))
+    assert x.header == {"dandiset_id": "000001"}
+    assert x.assets == []
+
+
+def test_repeated_structure_is_compressed():
+    # The same tree in every asset costs little more than one copy
+    one = len(encode_output({}, _make_assets(1)))
+    many = len(encode_output({}, _make_assets(200)))
+    assert many < 20 * one
+
+
+def test_rejects_other_data():
+    assert not is_compact_output(b'{"dandiset_id": "000001"}')
+    with pytest.raises(ValueError, match="Not a compact output"):
+        CompactOutput(b'{"dandiset_id": "000001"}')
+
+
+def test_rejects_other_format_versions():
+    data = encode_output({}, _make_assets(1))
+    data = MAGIC + bytes([FORMAT_VERSION + 1]) + data[len(MAGIC) + 1:]
+    with pytest.raises(ValueError, match="Unsupported compact output version"):
+        CompactOutput(data)
+
+
+def test_assets_can_be_streamed():
+    assets = _make_assets(5)
+    data = encode_output({}, (a for a in assets), len(assets))
+    assert CompactOutput(data).assets == CompactOutput(encode_output({}, assets)).assets
+    buf = io.BytesIO()
+    buf.write(b"prefix")
+    write_output(buf, {}, iter(assets), len(assets), level=3)
+    assert [decode_body(body) for _, body in CompactOutput(buf.getvalue()[len(b"prefix"):]).assets] == [
+        body for _, body in assets
+    ]
+
+
+def test_rejects_a_wrong_number_of_assets():
+    with pytest.raises(ValueError, match="Expected 3 assets, got 2"):
+        encode_output({}, iter(_make_assets(2)), 3)
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import time
+import urllib.error
+import urllib.parse
+
+import pytest
+
+from dandi_crawler import DandiCrawler, _parse_retry_after
+
+
+def _paginated(items, page_size):
+    """Serves items like a paginated DANDI listing, ignoring larger page sizes."""
+    def handler(method, path, headers):
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(path).query))
+        page = int(query.get("page", 1))
+        n = min(int(query.get("page_size", page_size)), page_size)
+        results = items[(page - 1) * n:page * n]
+        body = {
+            "count": len(items),
+            "next": "next" if page * n < len(items) else None,
+            "results": results,
+        }
+        return 200, {"Content-Type": "application/json"}, json.dumps(body).encode()
+    return handler
+
+
+def _make_crawler(server, **kwargs):
+    return DandiCrawler(f"{server.url}/api", backoff_sec=0.01, **kwargs)
+
+
+async def _collect(it):
+    return [x async for x in it]
+
+
+def test_iter_dandisets_fetches_all_pages_in_order(http_server):
+    dandisets = [{"identifier": f"{i:06d}"} for i in range(25)]
+    http_server.add_handler("/api/dandisets/", _paginated(dandisets, page_size=10))
+    crawler = _make_crawler(http_server, page_size=1000)
+    assert asyncio.run(_collect(crawler.iter_dandisets())) == dandisets
+    pages = [
+        dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(path).query))
+        for _, path, _ in http_server.get_requests("/api/dandisets/")
+    ]
+    assert sorted(int(q["page"]) for q in pages) == [1, 2, 3]
+    # The pages after the first use the page size of the server
+    assert {q["page_size"] for q in pages if q["page"] != "1"} == {"10"}
+    assert pages[0]["ordering"] == "-modified"
+
+
+def test_list_assets(http_server):
+    assets = [
+        {"asset_id": f"a{i}", "path": f"sub-{i}/sub-{i}.nwb", "size": i, "blob": f"b{i}"}
+        for i in range(3)
+    ]
+    http_server.add_handler("/api/dandisets/000001/versions/draft/assets/", _paginated(assets, page_size=2))
+    crawler = _make_crawler(http_server)
+    listed = asyncio.run(crawler.list_assets("000001", "draft"))
+    assert [a.identifier for a in listed] == ["a0", "a1", "a2"]
+    assert listed[2].size == 2 and listed[2].blob == "b2"
+    assert listed[0].download_url == f"{http_server.url}/api/assets/a0/download/"
+
+
+def test_empty_listing(http_server):
+    http_server.add_handler("/api/dandisets/", _paginated([], page_size=10))
+    crawler = _make_crawler(http_server)
+    assert asyncio.run(_collect(crawler.iter_dandisets())) == []
+    assert crawler.num_requests == 1
+
+
+def test_retries_429_honoring_retry_after(http_server):
+    path = "/api/dandisets/000001/versions/draft/assets/"
+    http_server.add(path, status=429, headers={"Retry-After": "0.3"})
+    http_server.add_handler(path, _paginated([{"asset_id": "a0", "path": "x.nwb"}], page_size=10))
+    crawler = _make_crawler(http_server)
+    t0 = time.time()
+    listed = asyncio.run(crawler.list_assets("000001", "draft"))
+    assert [a.identifier for a in listed] == ["a0"]
+    assert time.time() - t0 >= 0.3
+    assert crawler.num_retries == 1
+
+
+def test_retries_server_errors(http_server):
+    path = "/api/dandisets/"
+    http_server.add(path, status=500)
+    http_server.add(path, status=503)
+    http_server.add_handler(path, _paginated([{"identifier": "000001"}], page_size=10))
+    crawler = _make_crawler(http_server)
+    assert asyncio.run(_collect(crawler.iter_dandisets())) == [{"identifier": "000001"}]
+    assert crawler.num_requests == 3
+    assert crawler.num_retries == 2
+
+
+def test_gives_up_after_max_retries(http_server):
+    http_server.add("/api/dandisets/", status=502)
+    crawler = _make_crawler(http_server, max_retries=2)
+    with pytest.raises(urllib.error.HTTPError) as exc_info:
+        asyncio.run(_collect(crawler.iter_dandisets()))
+    assert exc_info.value.code == 502
+    assert crawler.num_requests == 3
+
+
+def test_does_not_retry_client_errors(http_server):
+    crawler = _make_crawler(http_server)
+    with pytest.raises(urllib.error.HTTPError) as exc_info:
+        asyncio.run(crawler.list_assets("999999", "draft"))
+    assert exc_info.value.code == 404
+    assert crawler.num_requests == 1
+
+
+def test_parse_retry_after():
+    assert _parse_retry_after("2") == 2.0
+    assert _parse_retry_after(None) is None
+    # HTTP dates are not supported; the backoff is used instead
+    assert _parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") is None
@@ -0,0 +1,526 @@
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+h5py = pytest.importorskip("h5py")
+h5tojson = pytest.importorskip("h5tojson")
+
+import dandi_nwb_meta  # noqa: E402
+import output_model  # noqa: E402
+import s3_upload  # noqa: E402
+from dandi_nwb_meta import DandiNwbMetaAsset, DandiNwbMetaDandiset  # noqa: E402
+
+
+def _make_asset(tmp_path, i: int, num_series: int = 2) -> DandiNwbMetaAsset:
+    """Creates an asset from a small HDF5 file with the structure of an NWB file."""
+    fname = str(tmp_path / f"asset_{i}.nwb")
+    with h5py.File(fname, "w") as f:
+        f.attrs["neurodata_type"] = "NWBFile"
+        f.attrs["namespace"] = "core"
+        f.attrs["object_id"] = f"file-{i}"
+        acquisition = f.create_group("acquisition")
+        for j in range(num_series):
+            g = acquisition.create_group(f"ElectricalSeries{j}")
+            g.attrs["neurodata_type"] = "ElectricalSeries"
+            g.attrs["namespace"] = "core"
+            g.attrs["object_id"] = f"series-{i}-{j}"
+            d = g.create_dataset("data", shape=(100 + i, 4), dtype="int16")
+            d.attrs["unit"] = "volts"
+    with open(fname, "rb") as f:
+        nwb_metadata = h5tojson.h5_to_object(f, h5tojson.H5ToJsonOpts(skip_all_dataset_data=True))
+    return DandiNwbMetaAsset(
+        asset_id=f"asset-{i}",
+        asset_path=f"sub-{i}/sub-{i}_ecephys.nwb",
+        nwb_metadata=nwb_metadata,
+        download_url=f"https://api.dandiarchive.org/api/assets/asset-{i}/download/",
+        blob_id=f"blob-{i}",
+    )
+
+
+def _make_dandiset(tmp_path, num_assets: int = 4) -> DandiNwbMetaDandiset:
+    # Two layouts: the assets alternate between 2 and 3 series
+    return DandiNwbMetaDandiset(
+        dandiset_id="000001",
+        dandiset_version="draft",
+        nwb_assets=[_make_asset(tmp_path, i, num_series=2 + i % 2) for i in range(num_assets)],
+    )
+
+
+def _expected_dict(X: DandiNwbMetaDandiset) -> dict:
+    # Empty dicts are left out of the outputs
+    return {
+        **X.dict(exclude={"nwb_assets"}),
+        "nwb_assets": [
+            DandiNwbMetaAsset(**dandi_nwb_meta._remove_empty_dicts_in_dict(a.dict())).dict()
+            for a in X.nwb_assets
+        ],
+    }
+
+
+@pytest.mark.parametrize("encoding", ["json", "compact"])
+def test_output_round_trip(tmp_path, monkeypatch, encoding):
+    X = _make_dandiset(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    dandi_nwb_meta._save_output(None, X.dandiset_id, X, encoding=encoding)
+    loaded = dandi_nwb_meta._load_existing_output(None, X.dandiset_id)
+    assert loaded.dict() == _expected_dict(X)
+
+
+def test_compact_output_shares_layouts(tmp_path, monkeypatch):
+    X = _make_dandiset(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    dandi_nwb_meta._save_output(None, X.dandiset_id, X, encoding="compact")
+    loaded = dandi_nwb_meta._load_existing_output(None, X.dandiset_id, lazy=True)
+    layout_ids = [a.layout_id for a in loaded.nwb_assets]
+    assert layout_ids[0] == layout_ids[2] != layout_ids[1] == layout_ids[3]
+    assert loaded.load().dict() == _expected_dict(X)
+
+
+def test_json_output_keeps_existing_lines(tmp_path, monkeypatch):
+    X = _make_dandiset(tmp_path, num_assets=3)
+    monkeypatch.chdir(tmp_path)
+    dandi_nwb_meta._save_output(None, X.dandiset_id, X)
+    with open(f"dandisets/{X.dandiset_id}.json") as f:
+        lines = f.read().splitlines()
+    existing = dandi_nwb_meta._load_existing_output(None, X.dandiset_id, lazy=True)
+    assert [a.get_json_line() for a in existing.nwb_assets] == [x.rstrip(",") for x in lines[1:4]]
+
+    renamed = existing.nwb_assets[1].copy(update={"asset_path": "renamed.nwb"})
+    new_asset = _make_asset(tmp_path, 3)
+    # Assigned like in process_dandiset, which mixes lazy and new assets
+    Y = DandiNwbMetaDandiset(dandiset_id=X.dandiset_id, dandiset_version=X.dandiset_version, nwb_assets=[])
+    Y.nwb_assets = [existing.nwb_assets[0], renamed, existing.nwb_assets[2], new_asset]
+    dandi_nwb_meta._save_output(None, X.dandiset_id, Y)
+    with open(f"dandisets/{X.dandiset_id}.json") as f:
+        new_lines = f.read().splitlines()
+    assert new_lines[1] == lines[1]
+    assert new_lines[3] == lines[3] + ","
+    loaded = dandi_nwb_meta._load_existing_output(None, X.dandiset_id)
+    expected = _expected_dict(X)["nwb_assets"]
+    expected[1]["asset_path"] = "renamed.nwb"
+    assert loaded.dict()["nwb_assets"] == expected + _expected_dict(Y)["nwb_assets"][3:]
+
+
+def test_compact_output_keeps_existing_bodies(tmp_path, monkeypatch):
+    X = _make_dandiset(tmp_path, num_assets=3)
+    monkeypatch.chdir(tmp_path)
+    dandi_nwb_meta._save_output(None, X.dandiset_id, X, encoding="compact")
+    existing = dandi_nwb_meta._load_existing_output(None, X.dandiset_id, lazy=True)
+    Y = DandiNwbMetaDandiset(dandiset_id=X.dandiset_id, dandiset_version=X.dandiset_version, nwb_assets=[])
+    Y.nwb_assets = existing.nwb_assets + [_make_asset(tmp_path, 3)]
+    layouts = dandi_nwb_meta._collect_layouts(Y)
+    bodies = [body for _, body in dandi_nwb_meta._iter_layout_deltas(Y, layouts)]
+    assert bodies[:3] == [a._raw for a in existing.nwb_assets]
+    dandi_nwb_meta._save_output(None, X.dandiset_id, Y, encoding="compact")
+    loaded = dandi_nwb_meta._load_existing_output(None, X.dandiset_id)
+    assert loaded.dict() == _expected_dict(Y)
+
+
+@pytest.fixture
+def bucket(http_server, monkeypatch):
+    """Serves the bucket from the mock HTTP server, without the local cache."""
+    monkeypatch.setattr(dandi_nwb_meta, "_get_bucket_url", lambda key: f"{http_server.url}/{key}")
+    monkeypatch.setenv("DANDI_NWB_META_CACHE_DIR", "")
+    return http_server
+
+
+def _serve_manifest(bucket, output_keys: dict):
+    manifest = dandi_nwb_meta.DandisetManifest(output_keys=output_keys)
+    bucket.add("/dandi-nwb-meta/manifest.json", body=json.dumps(manifest.dict()).encode())
+
+
+def test_outputs_are_fetched_from_the_recorded_key(tmp_path, monkeypatch, bucket):
+    X = _make_dandiset(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    dandi_nwb_meta._save_output(None, X.dandiset_id, X, encoding="compact")
+    compact_key = dandi_nwb_meta._get_object_key_for_compact_output(X.dandiset_id)
+    with open(dandi_nwb_meta._get_local_fname(compact_key), "rb") as f:
+        bucket.add(f"/{compact_key}", body=f.read(), headers={"ETag": '"v1"'})
+    _serve_manifest(bucket, {X.dandiset_id: compact_key})
+
+    [(dandiset_id, loaded)] = list(dandi_nwb_meta.load_existing_outputs_from_bucket([X.dandiset_id]))
+    assert loaded.dict() == _expected_dict(X)
+    versions = dandi_nwb_meta.get_output_versions_from_bucket([X.dandiset_id])
+    assert versions == {X.dandiset_id: f'{compact_key} "v1"'}
+    # No request for the keys of the other layouts and encodings
+    assert {path for _, path, _ in bucket.requests} == {"/dandi-nwb-meta/manifest.json", f"/{compact_key}"}
+
+
+def test_unrecorded_outputs_are_found_by_trying_the_keys(tmp_path, monkeypatch, bucket):
+    X = _make_dandiset(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    dandi_nwb_meta._save_output(None, X.dandiset_id, X, encoding="compact")
+    compact_key = dandi_nwb_meta._get_object_key_for_compact_output(X.dandiset_id)
+    with open(dandi_nwb_meta._get_local_fname(compact_key), "rb") as f:
+        bucket.add(f"/{compact_key}", body=f.read())
+
+    loaded = dandi_nwb_meta.load_existing_output_from_bucket(X.dandiset_id)
+    assert loaded.dict() == _expected_dict(X)
+    assert dandi_nwb_meta.load_existing_output_from_bucket("000002") is None
+
+
+def test_bulk_loaders_skip_failed_dandisets(tmp_path, monkeypatch, bucket):
+    X = _make_dandiset(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    dandi_nwb_meta._save_output(None, X.dandiset_id, X, encoding="compact")
+    compact_key = dandi_nwb_meta._get_object_key_for_compact_output(X.dandiset_id)
+    with open(dandi_nwb_meta._get_local_fname(compact_key), "rb") as f:
+        bucket.add(f"/{compact_key}", body=f.read(), headers={"ETag": '"v1"'})
+    failing_key = dandi_nwb_meta._get_object_key_for_output_index("000002")
+    bucket.add(f"/{failing_key}", status=503)
+    _serve_manifest(bucket, {X.dandiset_id: compact_key, "000002": failing_key})
+
+    outputs = dict(dandi_nwb_meta.load_existing_outputs_from_bucket(["000002", X.dandiset_id]))
+    assert outputs["000002"] is None
+    assert outputs[X.dandiset_id].dict() == _expected_dict(X)
+    versions = dandi_nwb_meta.get_output_versions_from_bucket(["000002", X.dandiset_id])
+    assert versions == {"000002": "", X.dandiset_id: f'{compact_key} "v1"'}
+
+
+class _FailingArchiveIndex:
+    def update_dandiset(self, dandiset_id, assets):
+        raise RuntimeError("index is corrupt")
+
+
+def test_archive_index_failure_is_reported(tmp_path, monkeypatch):
+    mirror_dir = tmp_path / "mirror"
+    (mirror_dir / "000001" / "sub-0").mkdir(parents=True)
+    _make_asset(mirror_dir / "000001" / "sub-0", 0)
+    monkeypatch.chdir(tmp_path)
+    summary = dandi_nwb_meta.process_dandiset(
+        "000001", 60, mirror_dir=str(mirror_dir), use_processes=False,
+        archive_index=_FailingArchiveIndex(),
+    )
+    assert summary.num_extracted_assets == 1
+    assert summary.error == "Failed to update the archive index: index is corrupt"
+    # The output is saved regardless
+    assert summary.output_key is not None
+    assert dandi_nwb_meta._load_existing_output(None, "000001") is not None
+
+
+def _make_mirror(tmp_path, dandiset_ids):
+    mirror_dir = tmp_path / "mirror"
+    for dandiset_id in dandiset_ids:
+        (mirror_dir / dandiset_id / "sub-0").mkdir(parents=True)
+        _make_asset(mirror_dir / dandiset_id / "sub-0", 0)
+    return mirror_dir
+
+
+def _process_mirror(mirror_dir, **kwargs):
+    kwargs.setdefault("max_time_per_dandiset", 60)
+    summaries = dandi_nwb_meta.process_dandisets(
+        max_time=60, mirror_dir=str(mirror_dir), use_processes=False,
+        summary_fname=None, metrics_fname=None, **kwargs,
+    )
+    return sorted(x.dandiset_id for x in summaries)
+
+
+def test_unchanged_dandisets_are_skipped(tmp_path, monkeypatch):
+    mirror_dir = _make_mirror(tmp_path, ["000001", "000002"])
+    monkeypatch.chdir(tmp_path)
+    assert _process_mirror(mirror_dir) == ["000001", "000002"]
+    manifest = dandi_nwb_meta._load_manifest(None)
+    assert sorted(manifest.dandisets) == ["000001", "000002"]
+    assert manifest.dandisets["000001"].failed_asset_ids == []
+    assert _process_mirror(mirror_dir) == []
+    # A new asset changes the digest of its dandiset
+    _make_asset(mirror_dir / "000002" / "sub-0", 1)
+    assert _process_mirror(mirror_dir) == ["000002"]
+    assert _process_mirror(mirror_dir, use_manifest=False) == ["000001", "000002"]
+
+
+def test_failed_assets_are_retried_later(tmp_path, monkeypatch):
+    mirror_dir = _make_mirror(tmp_path, ["000001"])
+    (mirror_dir / "000001" / "sub-0" / "corrupt.nwb").write_bytes(b"not an HDF5 file")
+    monkeypatch.chdir(tmp_path)
+    assert _process_mirror(mirror_dir) == ["000001"]
+    entry = dandi_nwb_meta._load_manifest(None).dandisets["000001"]
+    assert entry.failed_asset_ids == ["local:sub-0/corrupt.nwb"]
+    # Completed with a failed asset: skipped until retry_failed_after_sec has passed
+    assert _process_mirror(mirror_dir) == []
+    assert _process_mirror(mirror_dir, retry_failed_after_sec=0) == ["000001"]
+    assert dandi_nwb_meta._load_manifest(None).dandisets["000001"].last_completed > entry.last_completed
+
+
+def test_incomplete_runs_are_not_recorded(tmp_path, monkeypatch):
+    mirror_dir = _make_mirror(tmp_path, ["000001"])
+    monkeypatch.chdir(tmp_path)
+    # No time for any asset: the dandiset is processed again on the next run
+    assert _process_mirror(mirror_dir, max_time_per_dandiset=0) == ["000001"]
+    assert "000001" not in dandi_nwb_meta._load_manifest(None).dandisets
+    assert _process_mirror(mirror_dir) == ["000001"]
+    assert "000001" in dandi_nwb_meta._load_manifest(None).dandisets
+
+
+def test_runs_with_failed_uploads_are_not_recorded(tmp_path, monkeypatch):
+    # Outputs of a mirror are never uploaded, so the mirror is listed as if it
+    # were the archive, and the upload of each output is faked
+    mirror_dir = _make_mirror(tmp_path, ["000001", "000002"])
+    monkeypatch.chdir(tmp_path)
+    dandisets = [
+        dandi_nwb_meta._dandiset_from_mirror(x, dandi_nwb_meta.list_mirror_assets(str(mirror_dir), x))
+        for x in ["000001", "000002"]
+    ]
+    s3 = _FakeS3()
+    monkeypatch.setattr(dandi_nwb_meta, "_get_s3_client", lambda: s3)
+    monkeypatch.setattr(dandi_nwb_meta, "fetch_all_dandisets", lambda: dandisets)
+
+    def _process_dandiset(dandiset_id, max_time, *, s3, uploader, **kwargs):
+        output_key = dandi_nwb_meta._get_object_key_for_output(dandiset_id)
+        if dandiset_id == "000002":
+            output_key = "fails"
+        dandi_nwb_meta._upload_objects_to_s3(
+            s3, [(output_key, b"{}", "application/json")], label=dandiset_id, uploader=uploader,
+        )
+        return dandi_nwb_meta.DandisetProcessingSummary(
+            dandiset_id=dandiset_id, num_extracted_assets=1, elapsed_sec=0, output_key=output_key,
+        )
+
+    original = s3_upload._upload_bytes_to_s3
+
+    def _upload_bytes_to_s3(s3, bucket, object_key, data, content_type):
+        if object_key == "fails":
+            raise ConnectionError("connection reset")
+        original(s3, bucket, object_key, data, content_type)
+
+    monkeypatch.setattr(dandi_nwb_meta, "process_dandiset", _process_dandiset)
+    monkeypatch.setattr(s3_upload, "_upload_bytes_to_s3", _upload_bytes_to_s3)
+    summaries = dandi_nwb_meta.process_dandisets(
+        max_time=60, max_time_per_dandiset=60, use_processes=False, summary_fname=None, metrics_fname=None,
+    )
+    assert {x.dandiset_id: x.error for x in summaries} == {"000001": None, "000002": "connection reset"}
+    manifest = dandi_nwb_meta.DandisetManifest(
+        **json.loads(s3.objects[dandi_nwb_meta._get_object_key_for_manifest()])
+    )
+    assert sorted(manifest.dandisets) == ["000001"]
+    assert sorted(manifest.output_keys) == ["000001"]
+
+
+def _make_lazy_asset(asset_id, asset_path, blob_id):
+    line = json.dumps({
+        "asset_id": asset_id, "asset_path": asset_path, "download_url": None, "blob_id": blob_id,
+        "nwb_metadata": {"file": {}},
+    })
+    return dandi_nwb_meta.LazyDandiNwbMetaAsset(line)
+
+
+def test_existing_asset_index_lookup():
+    a = _make_lazy_asset("a", "sub-1/x.nwb", "blob-a")
+    b = _make_lazy_asset("b", "sub-2/x.nwb", "blob-b")
+    c = _make_lazy_asset("c", "sub-3/x.nwb", "blob-b")
+    legacy = _make_lazy_asset("d", "sub-4/x.nwb", None)
+    index = output_model.ExistingAssetIndex([a, b, c, legacy])
+    # By asset_id, when the content is the same or unknown
+    assert index.lookup("a", "sub-1/x.nwb", "blob-a") is a
+    assert index.lookup("a", "renamed.nwb", None) is a
+    assert index.lookup("d", "sub-4/x.nwb", "blob-d") is legacy
+    # A renamed asset (new asset_id) with the same content
+    assert index.lookup("a2", "sub-1/x.nwb", "blob-a") is a
+    assert index.lookup("a2", "moved/x.nwb", "blob-a") is a
+    # Among assets with the same content, the one with the same path
+    assert index.lookup("c2", "sub-3/x.nwb", "blob-b") is c
+    assert index.lookup("e", "other.nwb", "blob-b") is b
+    # The asset was rewritten in place, so its content changed
+    assert index.lookup("a", "sub-1/x.nwb", "blob-new") is None
+    assert index.lookup("e", "sub-5/x.nwb", None) is None
+
+
+def test_parse_asset_header():
+    header = {"asset_id": "a", "asset_path": 'sub-1/"quoted", "nwb_metadata": .nwb', "download_url": None,
+              "blob_id": "b"}
+    line = json.dumps({**header, "nwb_metadata": {"file": {"attributes": {"x": 1}}}})
+    assert output_model._parse_asset_header(line) == header
+
+
+def test_parse_asset_header_of_older_outputs():
+    # Older outputs wrote nwb_metadata before the other fields, or without blob_id
+    x = {"asset_id": "a", "asset_path": "p", "nwb_metadata": {"file": {}}, "download_url": None, "blob_id": "b"}
+    assert output_model._parse_asset_header(json.dumps(x)) == x
+    x = {"asset_id": "a", "asset_path": "p", "download_url": None, "nwb_metadata": {"file": {}}}
+    assert output_model._parse_asset_header(json.dumps(x)) == x
+
+
+@pytest.mark.parametrize("delete_other_encoding", [False, True])
+def test_other_encoding_is_only_deleted_on_request(tmp_path, monkeypatch, delete_other_encoding):
+    X = _make_dandiset(tmp_path, num_assets=2)
+    monkeypatch.chdir(tmp_path)
+    dandi_nwb_meta._save_output(None, X.dandiset_id, X)
+    json_fname = dandi_nwb_meta._get_local_fname(dandi_nwb_meta._get_object_key_for_output(X.dandiset_id))
+    stored_keys = {dandi_nwb_meta._get_object_key_for_output(X.dandiset_id)}
+    dandi_nwb_meta._save_output(
+        None, X.dandiset_id, X, encoding="compact",
+        delete_other_encoding=delete_other_encoding, stored_keys=stored_keys,
+    )
+    compact_key = dandi_nwb_meta._get_object_key_for_compact_output(X.dandiset_id)
+    assert os.path.exists(dandi_nwb_meta._get_local_fname(compact_key))
+    assert os.path.exists(json_fname) is not delete_other_encoding
+    assert compact_key in stored_keys
+    loaded = dandi_nwb_meta._load_existing_output(None, X.dandiset_id, object_key=compact_key)
+    assert loaded.dict() == _expected_dict(X)
+
+
+class _FakeS3:
+    """Keeps uploaded objects in memory; uploads fail while fail is True."""
+
+    class exceptions:
+        NoSuchKey = KeyError
+
+    def __init__(self):
+        self.objects = {}
+        self.fail = False
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Config=None):
+        if self.fail:
+            raise ConnectionError("upload failed")
+        self.objects[key] = fileobj.read()
+
+    def delete_object(self, Bucket, Key):
+        if self.fail:
+            raise ConnectionError("delete failed")
+        self.objects.pop(Key, None)
+
+
+def test_failed_checkpoint_upload_is_written_again(tmp_path):
+    X = _make_dandiset(tmp_path, num_assets=2)
+    s3 = _FakeS3()
+    old_key = dandi_nwb_meta._get_object_key_for_output(X.dandiset_id)
+    s3.objects[old_key] = b"old"
+    stored_keys = {old_key}
+    written_shard_keys = set()
+    s3.fail = True
+    with pytest.raises(ConnectionError):
+        dandi_nwb_meta._save_output(
+            s3, X.dandiset_id, X, layout="sharded", written_shard_keys=written_shard_keys, stored_keys=stored_keys,
+        )
+    assert written_shard_keys == set()
+    assert stored_keys == {old_key}
+    s3.fail = False
+    dandi_nwb_meta._save_output(
+        s3, X.dandiset_id, X, layout="sharded", written_shard_keys=written_shard_keys, stored_keys=stored_keys,
+    )
+    index = json.loads(s3.objects[dandi_nwb_meta._get_object_key_for_output_index(X.dandiset_id)])
+    for a in index["nwb_assets"]:
+        assert dandi_nwb_meta._get_object_key_for_asset_shard(X.dandiset_id, a["asset_id"]) in s3.objects
+    # The output in the single-file layout is deleted by the save that succeeded
+    assert old_key not in s3.objects
+    assert old_key not in stored_keys
+    assert len(written_shard_keys) == 2
+
+
+def test_failed_deletions_are_retried_on_the_next_save(tmp_path):
+    X = _make_dandiset(tmp_path, num_assets=1)
+    s3 = _FakeS3()
+    old_key = dandi_nwb_meta._get_object_key_for_output(X.dandiset_id)
+    s3.objects[old_key] = b"old"
+    stored_keys = {old_key}
+    s3.delete_object = lambda Bucket, Key: (_ for _ in ()).throw(ConnectionError("delete failed"))
+    dandi_nwb_meta._save_output(s3, X.dandiset_id, X, layout="sharded", stored_keys=stored_keys)
+    assert old_key in stored_keys
+    del s3.delete_object
+    dandi_nwb_meta._save_output(s3, X.dandiset_id, X, layout="sharded", stored_keys=stored_keys)
+    assert old_key not in s3.objects
+    assert old_key not in stored_keys
+
+
+def _make_pending_assets(tmp_path, num_assets):
+    from local_mirror import get_file_url
+
+    pending = []
+    for i in range(num_assets):
+        _make_asset(tmp_path, i)
+        pending.append(dandi_nwb_meta._PendingAsset(
+            index=i, label=f"asset {i}", asset_id=f"asset-{i}", asset_path=f"asset_{i}.nwb",
+            download_url=get_file_url(str(tmp_path / f"asset_{i}.nwb")),
+        ))
+    return pending
+
+
+class _BreakingExecutor(ThreadPoolExecutor):
+    """Fails the tasks of the given assets with BrokenProcessPool, as when a worker process dies."""
+
+    def __init__(self, broken_asset_ids):
+        super().__init__(max_workers=2)
+        self.broken_asset_ids = list(broken_asset_ids)
+        self.submitted = []
+
+    def submit(self, fn, download_url, asset_id, deadline):
+        self.submitted.append(asset_id)
+        if asset_id in self.broken_asset_ids:
+            self.broken_asset_ids.remove(asset_id)
+            future = Future()
+            future.set_exception(BrokenProcessPool("A child process terminated abruptly"))
+            return future
+        return super().submit(fn, download_url, asset_id, deadline)
+
+
+@pytest.mark.parametrize("num_breaks", [1, 2])
+def test_assets_of_a_dead_worker_are_not_failed(tmp_path, num_breaks):
+    pending = _make_pending_assets(tmp_path, 3)
+    with _BreakingExecutor(["asset-1"] * num_breaks) as executor:
+        results, _, failed = dandi_nwb_meta._extract_pending_assets(
+            pending, deadline=time.time() + 60, num_workers=2, use_processes=False, executor=executor,
+        )
+    assert failed == set()
+    # Submitted again once
+    assert executor.submitted.count("asset-1") == 2
+    assert sorted(results) == ([0, 1, 2] if num_breaks == 1 else [0, 2])
+
+
+class _StuckExecutor(ThreadPoolExecutor):
+    """Runs the extraction of the given asset as a task that never checks its deadline."""
+
+    def __init__(self, stuck_asset_id):
+        super().__init__(max_workers=2)
+        self.stuck_asset_id = stuck_asset_id
+        self.release = threading.Event()
+
+    def submit(self, fn, download_url, asset_id, deadline):
+        if asset_id == self.stuck_asset_id:
+            return super().submit(self.release.wait, 30)
+        return super().submit(fn, download_url, asset_id, deadline)
+
+
+@pytest.mark.parametrize("cut_by_max_asset_deadline", [False, True])
+def test_stuck_extractions_time_out(tmp_path, cut_by_max_asset_deadline):
+    pending = _make_pending_assets(tmp_path, 3)
+    for p in pending:
+        p.timeout = 0.5 if not cut_by_max_asset_deadline else 30
+    t0 = time.time()
+    with _StuckExecutor("asset-0") as executor:
+        results, _, failed = dandi_nwb_meta._extract_pending_assets(
+            pending, deadline=t0 + 60, max_asset_deadline=t0 + 0.5 if cut_by_max_asset_deadline else None,
+            num_workers=2, use_processes=False, executor=executor,
+        )
+        assert time.time() - t0 < 5
+        executor.release.set()
+    assert sorted(results) == [1, 2]
+    assert failed == (set() if cut_by_max_asset_deadline else {0})
+
+
+@pytest.mark.skipif(not hasattr(os, "mkfifo"), reason="needs os.mkfifo")
+def test_stuck_local_reads_are_stopped(tmp_path):
+    pending = _make_pending_assets(tmp_path, 2)
+    # Opening a FIFO for reading blocks until a writer opens it, which never happens
+    fifo = tmp_path / "stuck.nwb"
+    os.mkfifo(fifo)
+    pending[0].download_url = pending[0].download_url.replace("asset_0.nwb", "stuck.nwb")
+    pending[0].timeout = 2
+    t0 = time.time()
+    with dandi_nwb_meta.SharedProcessPool(2) as pool:
+        results, _, failed = dandi_nwb_meta._extract_pending_assets(
+            pending, deadline=t0 + 60, num_workers=2, use_processes=True, executor=pool,
+        )
+        assert time.time() - t0 < 30
+        # The pool was replaced and still works
+        assert pool.submit(abs, -1).result() == 1
+    assert failed == {0}
+    assert sorted(results) == [1]
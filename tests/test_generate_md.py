@@ -0,0 +1,150 @@
+from types import SimpleNamespace
+
+import pytest
+
+h5py = pytest.importorskip("h5py")
+h5tojson = pytest.importorskip("h5tojson")
+
+import generate_md  # noqa: E402
+from dandi_nwb_meta import DandiNwbMetaAsset, DandiNwbMetaDandiset  # noqa: E402
+
+REPORTS = ["neurodata_types.md", "neurodata_types_2.md", "dandisets.md"]
+
+
+def _make_output(tmp_path, dandiset_id, series_per_asset):
+    """An output whose i-th asset has series_per_asset[i] ElectricalSeries (and Units if 0)."""
+    assets = []
+    for i, num_series in enumerate(series_per_asset):
+        fname = str(tmp_path / f"{dandiset_id}_{i}.nwb")
+        with h5py.File(fname, "w") as f:
+            f.attrs["neurodata_type"] = "NWBFile"
+            f.attrs["namespace"] = "core"
+            acquisition = f.create_group("acquisition")
+            for j in range(num_series):
+                g = acquisition.create_group(f"es{j}")
+                g.attrs["neurodata_type"] = "ElectricalSeries"
+                g.attrs["namespace"] = "core"
+            if num_series == 0:
+                g = f.create_group("units")
+                g.attrs["neurodata_type"] = "Units"
+                g.attrs["namespace"] = "core"
+        with open(fname, "rb") as f:
+            nwb_metadata = h5tojson.h5_to_object(f, h5tojson.H5ToJsonOpts(skip_all_dataset_data=True))
+        assets.append(DandiNwbMetaAsset(asset_id=f"{dandiset_id}-{i}", asset_path=f"{i}.nwb", nwb_metadata=nwb_metadata))
+    return DandiNwbMetaDandiset(dandiset_id=dandiset_id, dandiset_version="draft", nwb_assets=assets)
+
+
+class _Bucket:
+    """Stands in for the bucket functions used by generate_md.main."""
+
+    def __init__(self, outputs, versions):
+        self.outputs = outputs
+        self.versions = versions
+        self.failing_ids = set()
+        self.loaded_ids = []
+
+    def install(self, monkeypatch):
+        monkeypatch.setattr(
+            generate_md, "fetch_all_dandisets",
+            lambda: [SimpleNamespace(dandiset_id=k) for k in sorted(self.versions)],
+        )
+        monkeypatch.setattr(
+            generate_md, "get_output_versions_from_bucket",
+            lambda ids, num_parallel: {k: self.versions[k] for k in ids},
+        )
+        monkeypatch.setattr(generate_md, "load_existing_outputs_from_bucket", self._load)
+
+    def _load(self, ids, num_parallel, lazy):
+        for k in ids:
+            self.loaded_ids.append(k)
+            yield k, None if k in self.failing_ids else self.outputs.get(k)
+
+
+def _read_reports(path):
+    ret = {}
+    for fname in REPORTS:
+        with open(path / fname) as f:
+            ret[fname] = [line for line in f if not line.startswith("Last generated")]
+    return ret
+
+
+def _full_rebuild(tmp_path, monkeypatch, outputs, versions):
+    rebuild_dir = tmp_path / "rebuild"
+    rebuild_dir.mkdir()
+    monkeypatch.chdir(rebuild_dir)
+    _Bucket(outputs, versions).install(monkeypatch)
+    generate_md.main()
+    return _read_reports(rebuild_dir)
+
+
+@pytest.fixture
+def outputs(tmp_path):
+    return {
+        "000001": _make_output(tmp_path, "000001", [1, 2]),
+        "000002": _make_output(tmp_path, "000002", [0, 3, 1]),
+        "000003": _make_output(tmp_path, "000003", [0]),
+    }
+
+
+def test_incremental_reports_match_a_full_rebuild(tmp_path, monkeypatch, outputs):
+    versions = {"000001": "k1 a", "000002": "k2 a", "000003": "k3 a", "000004": None}
+    run_dir = tmp_path / "run"
+    run_dir.mkdir()
+    monkeypatch.chdir(run_dir)
+    bucket = _Bucket(dict(outputs), dict(versions))
+    bucket.install(monkeypatch)
+    generate_md.main()
+    assert bucket.loaded_ids == ["000001", "000002", "000003"]
+
+    # 000002 changed, 000003 was removed and 000005 is new
+    bucket.outputs["000002"] = _make_output(tmp_path, "000002", [0, 0, 4])
+    bucket.versions["000002"] = "k2 b"
+    bucket.versions["000003"] = None
+    bucket.outputs["000005"] = _make_output(tmp_path, "000005", [2])
+    bucket.versions["000005"] = "k5 a"
+    bucket.loaded_ids = []
+    generate_md.main()
+    assert bucket.loaded_ids == ["000002", "000005"]
+    reports = _read_reports(run_dir)
+    assert reports == _full_rebuild(tmp_path, monkeypatch, bucket.outputs, bucket.versions)
+    summaries = generate_md._load_summaries(str(run_dir / "report_summaries.json"))
+    assert sorted(summaries) == ["000001", "000002", "000005"]
+    assert summaries["000002"].output_version == "k2 b"
+
+
+def test_unknown_versions_are_loaded_again(tmp_path, monkeypatch, outputs):
+    monkeypatch.chdir(tmp_path)
+    bucket = _Bucket(outputs, {"000001": "k1 a", "000002": "k2 a"})
+    bucket.install(monkeypatch)
+    generate_md.main()
+    # The HEAD request for 000002 failed
+    bucket.versions["000002"] = ""
+    bucket.loaded_ids = []
+    generate_md.main()
+    assert bucket.loaded_ids == ["000002"]
+    summaries = generate_md._load_summaries("report_summaries.json")
+    assert summaries["000002"].output_version == ""
+    # An unknown version never matches, even a summary made from one
+    bucket.loaded_ids = []
+    generate_md.main()
+    assert bucket.loaded_ids == ["000002"]
+
+
+def test_failed_loads_keep_the_last_summary(tmp_path, monkeypatch, outputs):
+    monkeypatch.chdir(tmp_path)
+    bucket = _Bucket(outputs, {"000001": "k1 a", "000002": "k2 a"})
+    bucket.install(monkeypatch)
+    generate_md.main()
+    before = _read_reports(tmp_path)
+    bucket.versions["000002"] = "k2 b"
+    bucket.failing_ids = {"000002"}
+    generate_md.main()
+    summaries = generate_md._load_summaries("report_summaries.json")
+    # The old summary is kept, with its old version so that it is loaded again
+    assert summaries["000002"].output_version == "k2 a"
+    assert _read_reports(tmp_path) == before
+    bucket.failing_ids = set()
+    bucket.loaded_ids = []
+    generate_md.main()
+    assert bucket.loaded_ids == ["000002"]
+    assert generate_md._load_summaries("report_summaries.json")["000002"].output_version == "k2 b"
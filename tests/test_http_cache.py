@@ -0,0 +1,114 @@
+import os
+
+import pytest
+import requests
+
+from http_cache import HttpCache
+
+
+def _versioned(bodies):
+    """Serves bodies[version] with ETag "v<version>", answering 304 to a matching If-None-Match.
+
+    The served version is bodies["current"].
+    """
+    def handler(method, path, headers):
+        etag = f'"v{bodies["current"]}"'
+        if headers.get("If-None-Match") == etag:
+            return 304, {"ETag": etag}, b""
+        return 200, {"ETag": etag}, bodies[bodies["current"]]
+    return handler
+
+
+@pytest.fixture
+def session():
+    with requests.Session() as s:
+        yield s
+
+
+def _read(f):
+    with f:
+        return f.read()
+
+
+def test_unchanged_objects_are_revalidated(http_server, session, tmp_path):
+    bodies = {"current": 1, 1: b"first"}
+    http_server.add_handler("/a", _versioned(bodies))
+    cache = HttpCache(str(tmp_path), max_size=1000)
+    url = f"{http_server.url}/a"
+    assert _read(cache.get(session, url)) == b"first"
+    assert _read(cache.get(session, url)) == b"first"
+    [first, second] = http_server.get_requests("/a")
+    assert "If-None-Match" not in first[2]
+    assert second[2]["If-None-Match"] == '"v1"'
+
+
+def test_changed_objects_are_downloaded_again(http_server, session, tmp_path):
+    bodies = {"current": 1, 1: b"first", 2: b"second"}
+    http_server.add_handler("/a", _versioned(bodies))
+    cache = HttpCache(str(tmp_path), max_size=1000)
+    url = f"{http_server.url}/a"
+    assert _read(cache.get(session, url)) == b"first"
+    bodies["current"] = 2
+    assert _read(cache.get(session, url)) == b"second"
+    assert _read(cache.get(session, url)) == b"second"
+    assert http_server.get_requests("/a")[-1][2]["If-None-Match"] == '"v2"'
+
+
+def test_last_modified_is_sent(http_server, session, tmp_path):
+    last_modified = "Wed, 21 Oct 2026 07:28:00 GMT"
+    http_server.add("/a", body=b"x", headers={"Last-Modified": last_modified})
+    cache = HttpCache(str(tmp_path), max_size=1000)
+    _read(cache.get(session, f"{http_server.url}/a"))
+    _read(cache.get(session, f"{http_server.url}/a"))
+    assert http_server.get_requests("/a")[1][2]["If-Modified-Since"] == last_modified
+
+
+def test_missing_objects_are_removed(http_server, session, tmp_path):
+    http_server.add("/a", body=b"x", headers={"ETag": '"v1"'})
+    http_server.add("/a", status=404)
+    cache = HttpCache(str(tmp_path), max_size=1000)
+    url = f"{http_server.url}/a"
+    assert _read(cache.get(session, url)) == b"x"
+    assert cache.get(session, url) is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_server_errors_are_raised(http_server, session, tmp_path):
+    http_server.add("/a", status=500)
+    cache = HttpCache(str(tmp_path), max_size=1000)
+    with pytest.raises(requests.HTTPError):
+        cache.get(session, f"{http_server.url}/a")
+
+
+def test_least_recently_used_bodies_are_evicted(http_server, session, tmp_path):
+    for name in "abc":
+        http_server.add_handler(f"/{name}", _versioned({"current": name, name: name.encode() * 100}))
+    cache = HttpCache(str(tmp_path), max_size=250)
+    _read(cache.get(session, f"{http_server.url}/a"))
+    _backdate(tmp_path, 100)
+    _read(cache.get(session, f"{http_server.url}/b"))
+    _backdate(tmp_path, 100)
+    # a is used again, so b is now the least recently used
+    _read(cache.get(session, f"{http_server.url}/a"))
+    _read(cache.get(session, f"{http_server.url}/c"))
+    assert len([x for x in os.listdir(tmp_path) if x.endswith(".body")]) == 2
+    # c and a are revalidated, b is downloaded again and evicts c
+    c = cache.get(session, f"{http_server.url}/c")
+    _backdate(tmp_path, 100)
+    _read(cache.get(session, f"{http_server.url}/a"))
+    for name in "ca":
+        assert http_server.get_requests(f"/{name}")[-1][2]["If-None-Match"] == f'"v{name}"'
+    _read(cache.get(session, f"{http_server.url}/b"))
+    assert "If-None-Match" not in http_server.get_requests("/b")[-1][2]
+    # A body that is open stays readable after it is evicted
+    assert _read(c) == b"c" * 100
+    _read(cache.get(session, f"{http_server.url}/c"))
+    assert "If-None-Match" not in http_server.get_requests("/c")[-1][2]
+
+
+def _backdate(cache_dir, seconds):
+    """Makes all the cached bodies older, so that the next accesses sort after them."""
+    for fname in os.listdir(cache_dir):
+        if fname.endswith(".body"):
+            st = os.stat(cache_dir / fname)
+            os.utime(cache_dir / fname, (st.st_atime - seconds, st.st_mtime - seconds))
@@ -0,0 +1,81 @@
+from nwb_layouts import apply_delta, diff_tree, fingerprint_layout
+
+
+def _make_tree(num_series, *, rate=30000.0, object_id="id-0"):
+    return {
+        "file": {
+            "attributes": {"neurodata_type": "NWBFile", "namespace": "core", "object_id": object_id},
+            "groups": {
+                "acquisition": {
+                    "attributes": {},
+                    "groups": {
+                        f"es{j}": {
+                            "attributes": {
+                                "neurodata_type": "ElectricalSeries",
+                                "namespace": "core",
+                                "object_id": f"{object_id}-{j}",
+                            },
+                            "datasets": {
+                                "data": {"shape": [100 * j, 32], "dtype": "<i2", "attributes": {"conversion": 1.0}},
+                                "starting_time": {"shape": [], "dtype": "<f8", "attributes": {"rate": rate}},
+                            },
+                        }
+                        for j in range(num_series)
+                    },
+                },
+            },
+            "datasets": {"session_description": {"shape": [], "dtype": "object", "attributes": {}}},
+        }
+    }
+
+
+def test_fingerprint_ignores_values():
+    a = _make_tree(3)
+    b = _make_tree(3, rate=1000.0, object_id="id-1")
+    assert fingerprint_layout(a) == fingerprint_layout(b)
+
+
+def test_fingerprint_depends_on_structure():
+    assert fingerprint_layout(_make_tree(2)) != fingerprint_layout(_make_tree(3))
+    a = _make_tree(2)
+    b = _make_tree(2)
+    b["file"]["groups"]["acquisition"]["groups"]["es1"]["attributes"]["neurodata_type"] = "SpikeEventSeries"
+    assert fingerprint_layout(a) != fingerprint_layout(b)
+    b = _make_tree(2)
+    b["file"]["datasets"]["session_description"]["attributes"]["comments"] = ""
+    assert fingerprint_layout(a) != fingerprint_layout(b)
+
+
+def test_round_trip_same_layout():
+    base = _make_tree(3)
+    x = _make_tree(3, rate=1000.0, object_id="id-1")
+    delta = diff_tree(base, x)
+    assert apply_delta(base, delta) == x
+    # Only the values that differ are in the delta
+    assert "session_description" not in delta["file"].get("datasets", {})
+
+
+def test_round_trip_other_layout():
+    base = _make_tree(3)
+    for x in [_make_tree(1), _make_tree(5, object_id="id-2"), {"file": {}}, {}]:
+        assert apply_delta(base, diff_tree(base, x)) == x
+        assert apply_delta(x, diff_tree(x, base)) == base
+
+
+def test_round_trip_changed_types():
+    base = {"a": 1, "b": {"c": [1, 2]}, "d": True, "e": None}
+    x = {"a": 1.0, "b": 3, "d": 1, "e": {"f": None}, "g": []}
+    assert apply_delta(base, diff_tree(base, x)) == x
+    for k in x:
+        assert type(apply_delta(base, diff_tree(base, x))[k]) is type(x[k])
+
+
+def test_identical_trees_have_an_empty_delta():
+    assert diff_tree(_make_tree(3), _make_tree(3)) == {}
+
+
+def test_apply_delta_does_not_share_the_base():
+    base = _make_tree(2)
+    x = apply_delta(base, {})
+    x["file"]["groups"]["acquisition"]["groups"]["es0"]["datasets"]["data"]["shape"].append(1)
+    assert base == _make_tree(2)
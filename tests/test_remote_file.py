@@ -0,0 +1,155 @@
+import os
+import re
+import time
+
+import pytest
+import requests
+
+from remote_file import CachedRemoteFile, evict_block_cache
+
+BLOCK_SIZE = 1024
+DATA = bytes(range(256)) * 200  # 50 blocks
+
+
+def _serve_ranges(data):
+    """Answers range requests for data, as an object store does."""
+    def handler(method, path, headers):
+        m = re.match(r"bytes=(\d+)-(\d+)", headers.get("Range", ""))
+        if m is None:
+            return 200, {}, data
+        start, end = int(m.group(1)), min(int(m.group(2)), len(data) - 1)
+        return 206, {"Content-Range": f"bytes {start}-{end}/{len(data)}"}, data[start:end + 1]
+    return handler
+
+
+def _get_ranges(server, path="/file"):
+    ret = []
+    for _, _, headers in server.get_requests(path):
+        m = re.match(r"bytes=(\d+)-(\d+)", headers["Range"])
+        ret.append((int(m.group(1)), int(m.group(2)) + 1))
+    return ret
+
+
+@pytest.fixture
+def session():
+    with requests.Session() as s:
+        yield s
+
+
+@pytest.fixture
+def remote_file(http_server, session):
+    http_server.add_handler("/file", _serve_ranges(DATA))
+
+    def _open(**kwargs):
+        kwargs.setdefault("block_size", BLOCK_SIZE)
+        kwargs.setdefault("prefetch_size", 2 * BLOCK_SIZE)
+        kwargs.setdefault("max_fetch_size", 8 * BLOCK_SIZE)
+        return CachedRemoteFile(f"{http_server.url}/file", session=session, **kwargs)
+    return _open
+
+
+def _read_at(f, offset, n):
+    f.seek(offset)
+    return f.read(n)
+
+
+def test_reads(remote_file, http_server):
+    f = remote_file()
+    assert f.size == len(DATA)
+    assert _read_at(f, 0, 100) == DATA[:100]
+    assert _read_at(f, 10_000, 3000) == DATA[10_000:13_000]
+    assert _read_at(f, len(DATA) - 10, 100) == DATA[-10:]
+    f.seek(0)
+    assert f.read() == DATA
+    # The prefetched blocks are not fetched again
+    assert _get_ranges(http_server)[0] == (0, 2 * BLOCK_SIZE)
+    assert all(start >= 2 * BLOCK_SIZE for start, _ in _get_ranges(http_server)[1:])
+
+
+def test_missing_blocks_are_coalesced(remote_file, http_server):
+    f = remote_file()
+    _read_at(f, 5 * BLOCK_SIZE, 10)
+    # Blocks 6 to 9 are missing and fetched at once; block 5 is not fetched again
+    assert _read_at(f, 5 * BLOCK_SIZE, 5 * BLOCK_SIZE) == DATA[5 * BLOCK_SIZE:10 * BLOCK_SIZE]
+    assert _get_ranges(http_server)[1:] == [(5 * BLOCK_SIZE, 6 * BLOCK_SIZE), (6 * BLOCK_SIZE, 10 * BLOCK_SIZE)]
+
+
+def test_sequential_reads_fetch_ahead(remote_file, http_server):
+    f = remote_file()
+    f.seek(10 * BLOCK_SIZE)
+    for _ in range(20):
+        f.read(BLOCK_SIZE)
+    sizes = [(end - start) // BLOCK_SIZE for start, end in _get_ranges(http_server)[1:]]
+    # Each sequential read doubles the blocks fetched ahead, up to max_fetch_size
+    assert sizes[:2] == [1, 2]
+    assert sizes == sorted(sizes)
+    assert max(sizes) == 8
+    assert len(sizes) < 6
+
+
+def test_random_reads_do_not_fetch_ahead(remote_file, http_server):
+    f = remote_file()
+    for i in [40, 10, 30, 20]:
+        _read_at(f, i * BLOCK_SIZE, 10)
+    assert [(end - start) // BLOCK_SIZE for start, end in _get_ranges(http_server)[1:]] == [1, 1, 1, 1]
+
+
+def test_resumes_from_the_disk_cache(remote_file, http_server, tmp_path):
+    f = remote_file(cache_dir=str(tmp_path), cache_key="asset")
+    _read_at(f, 10 * BLOCK_SIZE, 3 * BLOCK_SIZE)
+    num_requests = len(http_server.requests)
+    # A retried extraction reads the same bytes without any request, even on open
+    g = remote_file(cache_dir=str(tmp_path), cache_key="asset")
+    assert g.size == len(DATA)
+    assert _read_at(g, 0, 2 * BLOCK_SIZE) == DATA[:2 * BLOCK_SIZE]
+    assert _read_at(g, 10 * BLOCK_SIZE, 3 * BLOCK_SIZE) == DATA[10 * BLOCK_SIZE:13 * BLOCK_SIZE]
+    assert len(http_server.requests) == num_requests
+    assert g.num_requests == 0
+    assert g.num_blocks_from_disk == 5
+    # Only the missing blocks are fetched
+    assert _read_at(g, 12 * BLOCK_SIZE, 2 * BLOCK_SIZE) == DATA[12 * BLOCK_SIZE:14 * BLOCK_SIZE]
+    assert _get_ranges(http_server)[-1] == (13 * BLOCK_SIZE, 14 * BLOCK_SIZE)
+    g.clear_cache()
+    assert not os.path.exists(tmp_path / "asset")
+
+
+def test_deadline(remote_file, tmp_path):
+    with pytest.raises(TimeoutError):
+        remote_file(deadline=time.time() - 1)
+    f = remote_file(cache_dir=str(tmp_path), cache_key="asset", deadline=time.time() + 0.5)
+    assert _read_at(f, 0, 10) == DATA[:10]
+    time.sleep(0.6)
+    # Blocks in memory can still be read, but nothing is fetched
+    assert _read_at(f, 0, 10) == DATA[:10]
+    with pytest.raises(TimeoutError):
+        _read_at(f, 20 * BLOCK_SIZE, 10)
+    # After the deadline, a file can still be opened from the disk cache
+    g = remote_file(cache_dir=str(tmp_path), cache_key="asset", deadline=time.time() - 1)
+    assert _read_at(g, 0, 10) == DATA[:10]
+
+
+def test_ignored_range_is_an_error(http_server, session):
+    http_server.add("/file", body=DATA)
+    with pytest.raises(IOError, match="Range request not supported"):
+        CachedRemoteFile(f"{http_server.url}/file", session=session)
+
+
+def test_follows_the_redirect_once(remote_file, http_server, session):
+    http_server.add("/redirect", status=302, headers={"Location": f"{http_server.url}/file"})
+    f = CachedRemoteFile(
+        f"{http_server.url}/redirect", session=session, block_size=BLOCK_SIZE, prefetch_size=BLOCK_SIZE,
+    )
+    assert _read_at(f, 30 * BLOCK_SIZE, 10) == DATA[30 * BLOCK_SIZE:30 * BLOCK_SIZE + 10]
+    assert len(http_server.get_requests("/redirect")) == 1
+    assert len(http_server.get_requests("/file")) == 2
+
+
+def test_evict_block_cache(tmp_path):
+    for i, name in enumerate(["old", "new"]):
+        block_dir = tmp_path / name
+        block_dir.mkdir()
+        (block_dir / "0").write_bytes(b"x" * 100)
+        os.utime(block_dir / "0", (1000 + i, 1000 + i))
+        os.utime(block_dir, (1000 + i, 1000 + i))
+    evict_block_cache(str(tmp_path), max_size=150)
+    assert sorted(os.listdir(tmp_path)) == ["new"]
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+import s3_upload  # noqa: E402
+from s3_upload import BackgroundUploader, _upload_objects_to_s3  # noqa: E402
+from metrics import MetricsRecorder  # noqa: E402
+
+BUCKET = "neurosift"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def _get_object(s3, key):
+    response = s3.get_object(Bucket=BUCKET, Key=key)
+    return response["Body"].read(), response["ContentType"]
+
+
+def _list_keys(s3):
+    return sorted(x["Key"] for x in s3.list_objects_v2(Bucket=BUCKET).get("Contents", []))
+
+
+def test_upload_then_delete(s3):
+    s3.put_object(Bucket=BUCKET, Key="stale", Body=b"old")
+    _upload_objects_to_s3(
+        s3,
+        [("a.json", b"{}", "application/json"), ("b.dnmb", b"DNMB", "application/octet-stream")],
+        label="000001",
+        uploader=None,
+        delete_keys=["stale"],
+    )
+    assert _list_keys(s3) == ["a.json", "b.dnmb"]
+    assert _get_object(s3, "a.json") == (b"{}", "application/json")
+    assert _get_object(s3, "b.dnmb") == (b"DNMB", "application/octet-stream")
+
+
+def test_large_objects_are_uploaded_in_parts(s3):
+    data = bytes(range(256)) * (9 * 1024 * 4)  # 9 MB, above the multipart threshold
+    _upload_objects_to_s3(s3, [("large", data, "application/octet-stream")], label="000001", uploader=None)
+    assert _get_object(s3, "large")[0] == data
+
+
+def test_background_uploads(s3, tmp_path):
+    metrics = MetricsRecorder(str(tmp_path / "metrics.jsonl"))
+    uploader = BackgroundUploader(num_threads=2)
+    for i in range(4):
+        _upload_objects_to_s3(
+            s3, [(f"{i}.json", b"x" * i, "application/json")],
+            label=f"00000{i}", uploader=uploader, metrics=metrics,
+        )
+    assert uploader.wait() == {}
+    uploader.shutdown()
+    metrics.close()
+    assert _list_keys(s3) == [f"{i}.json" for i in range(4)]
+    with open(tmp_path / "metrics.jsonl") as f:
+        events = [json.loads(line) for line in f]
+    assert sorted(e["dandiset_id"] for e in events if e["stage"] == "upload") == [f"00000{i}" for i in range(4)]
+
+
+def test_failed_uploads_are_reported_and_keep_stale_objects(s3, monkeypatch):
+    s3.put_object(Bucket=BUCKET, Key="stale", Body=b"old")
+    original = s3_upload._upload_bytes_to_s3
+
+    def _upload_bytes_to_s3(s3, bucket, object_key, data, content_type):
+        if object_key == "fails":
+            raise RuntimeError("connection reset")
+        original(s3, bucket, object_key, data, content_type)
+
+    monkeypatch.setattr(s3_upload, "_upload_bytes_to_s3", _upload_bytes_to_s3)
+    uploader = BackgroundUploader()
+    _upload_objects_to_s3(
+        s3, [("ok", b"1", "application/json"), ("fails", b"2", "application/json")],
+        label="000001", uploader=uploader, delete_keys=["stale"],
+    )
+    _upload_objects_to_s3(s3, [("other", b"3", "application/json")], label="000002", uploader=uploader)
+    assert uploader.wait() == {"000001": "connection reset"}
+    uploader.shutdown()
+    # The deletions only happen once all uploads succeeded
+    assert _list_keys(s3) == ["ok", "other", "stale"]
@@ -0,0 +1,187 @@
+import threading
+from typing import Any, Dict, Iterable, List, Set, Tuple, Union
+
+
+# Posting lists: dandiset_id -> asset ids
+Postings = Dict[str, Set[str]]
+
+
+class ArchiveIndex:
+    """Inverted index of the neurodata types, namespaces and paths of all assets.
+
+    neurodata_types maps "namespace.neurodata_type" and namespaces maps a
+    namespace to the assets that contain an object of it. paths maps the HDF5
+    path of every group with a neurodata type to the assets that have an
+    object at that path, by neurodata type. Only the groups found by
+    H5ToJsonFile.get_all_groups_and_datasets are indexed, the same ones that
+    are counted by generate_md.py.
+
+    Updates are thread-safe, so process_dandiset calls for several dandisets
+    can share one index.
+    """
+
+    def __init__(self):
+        self.neurodata_types: Dict[str, Postings] = {}
+        self.namespaces: Dict[str, Postings] = {}
+        self.paths: Dict[str, Dict[str, Postings]] = {}
+        # Indexed asset ids by dandiset
+        self.dandisets: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def update_dandiset(self, dandiset_id: str, assets: Iterable[Any]) -> bool:
+        """Brings the postings of a dandiset in line with its current assets.
+
+        assets are DandiNwbMetaAsset or LazyDandiNwbMetaAsset objects. Only the
+        metadata of assets that are not indexed yet is read. Returns whether
+        the index changed.
+        """
+        assets = list(assets)
+        with self._lock:
+            indexed = set(self.dandisets.get(dandiset_id, set()))
+        new_asset_ids = {a.asset_id for a in assets}
+        removed = indexed - new_asset_ids
+        # Read the metadata outside the lock; this is the expensive part. Assets
+        # with the same layout have the same terms, so each layout is read once.
+        added: List[Tuple[str, Set[Tuple[str, str, str]]]] = []
+        layout_terms: Dict[str, Set[Tuple[str, str, str]]] = {}
+        for a in assets:
+            if a.asset_id in indexed:
+                continue
+            layout_id = getattr(a, "layout_id", None)
+            terms = layout_terms.get(layout_id) if layout_id is not None else None
+            if terms is None:
+                terms = _get_asset_terms(a.nwb_metadata)
+                if layout_id is not None:
+                    layout_terms[layout_id] = terms
+            added.append((a.asset_id, terms))
+        if not removed and not added and dandiset_id in self.dandisets:
+            return False
+        with self._lock:
+            if removed:
+                self._remove_assets(dandiset_id, removed)
+            for asset_id, terms in added:
+                for nt, namespace, path in terms:
+                    self.neurodata_types.setdefault(nt, {}).setdefault(dandiset_id, set()).add(asset_id)
+                    self.namespaces.setdefault(namespace, {}).setdefault(dandiset_id, set()).add(asset_id)
+                    self.paths.setdefault(path, {}).setdefault(nt, {}).setdefault(dandiset_id, set()).add(asset_id)
+            self.dandisets[dandiset_id] = new_asset_ids
+        return True
+
+    def find_assets(
+        self,
+        *,
+        neurodata_type: Union[str, None] = None,
+        namespace: Union[str, None] = None,
+        path: Union[str, None] = None,
+    ) -> List[Tuple[str, str]]:
+        """Returns the sorted (dandiset_id, asset_id) of the assets matching all the given terms.
+
+        neurodata_type is "namespace.neurodata_type" (e.g. "core.Units").
+        """
+        selections: List[Postings] = []
+        if neurodata_type is not None:
+            selections.append(self.neurodata_types.get(neurodata_type, {}))
+        if namespace is not None:
+            selections.append(self.namespaces.get(namespace, {}))
+        if path is not None:
+            selections.append(_union(self.paths.get(path, {}).values()))
+        if not selections:
+            raise ValueError("At least one of neurodata_type, namespace and path is required")
+        result: Set[Tuple[str, str]] = {
+            (dandiset_id, asset_id)
+            for dandiset_id, asset_ids in selections[0].items()
+            for asset_id in asset_ids
+        }
+        for postings in selections[1:]:
+            result = {(d, a) for d, a in result if a in postings.get(d, ())}
+        return sorted(result)
+
+    def find_dandisets(self, **terms) -> List[str]:
+        """Returns the sorted ids of the dandisets with assets matching all the given terms."""
+        return sorted({d for d, _ in self.find_assets(**terms)})
+
+    def find_paths(self, neurodata_type: str) -> Dict[str, int]:
+        """Returns the paths where a neurodata type occurs, with the number of assets for each."""
+        ret: Dict[str, int] = {}
+        for path, by_type in self.paths.items():
+            postings = by_type.get(neurodata_type)
+            if postings:
+                ret[path] = sum(len(x) for x in postings.values())
+        return ret
+
+    def get_dandiset_neurodata_types(self, dandiset_id: str) -> Set[str]:
+        return {nt for nt, postings in self.neurodata_types.items() if dandiset_id in postings}
+
+    def to_dict(self) -> dict:
+        return {
+            "neurodata_types": {k: _postings_to_dict(v) for k, v in self.neurodata_types.items()},
+            "namespaces": {k: _postings_to_dict(v) for k, v in self.namespaces.items()},
+            "paths": {
+                k: {nt: _postings_to_dict(v) for nt, v in by_type.items()}
+                for k, by_type in self.paths.items()
+            },
+            "dandisets": {k: sorted(v) for k, v in self.dandisets.items()},
+        }
+
+    @staticmethod
+    def from_dict(x: dict) -> "ArchiveIndex":
+        ret = ArchiveIndex()
+        ret.neurodata_types = {k: _postings_from_dict(v) for k, v in x["neurodata_types"].items()}
+        ret.namespaces = {k: _postings_from_dict(v) for k, v in x["namespaces"].items()}
+        ret.paths = {
+            k: {nt: _postings_from_dict(v) for nt, v in by_type.items()}
+            for k, by_type in x["paths"].items()
+        }
+        ret.dandisets = {k: set(v) for k, v in x["dandisets"].items()}
+        return ret
+
+    def _remove_assets(self, dandiset_id: str, asset_ids: Set[str]):
+        for postings in list(self.neurodata_types.values()) + list(self.namespaces.values()):
+            _remove_from_postings(postings, dandiset_id, asset_ids)
+        for by_type in self.paths.values():
+            for postings in by_type.values():
+                _remove_from_postings(postings, dandiset_id, asset_ids)
+            _prune(by_type)
+        _prune(self.neurodata_types)
+        _prune(self.namespaces)
+        _prune(self.paths)
+
+
+def _get_asset_terms(nwb_metadata) -> Set[Tuple[str, str, str]]:
+    """Returns the (neurodata type, namespace, path) of each typed group of an asset."""
+    terms: Set[Tuple[str, str, str]] = set()
+    all_groups, _ = nwb_metadata.get_all_groups_and_datasets()
+    for path, g in all_groups.items():
+        if "neurodata_type" in g.attributes:
+            namespace = g.attributes.get("namespace", "")
+            terms.add((namespace + "." + g.attributes["neurodata_type"], namespace, path))
+    return terms
+
+
+def _remove_from_postings(postings: Postings, dandiset_id: str, asset_ids: Set[str]):
+    x = postings.get(dandiset_id)
+    if x is not None:
+        x -= asset_ids
+        if not x:
+            del postings[dandiset_id]
+
+
+def _prune(x: dict):
+    for k in [k for k, v in x.items() if not v]:
+        del x[k]
+
+
+def _union(postings_list: Iterable[Postings]) -> Postings:
+    ret: Postings = {}
+    for postings in postings_list:
+        for dandiset_id, asset_ids in postings.items():
+            ret.setdefault(dandiset_id, set()).update(asset_ids)
+    return ret
+
+
+def _postings_to_dict(postings: Postings) -> Dict[str, List[str]]:
+    return {k: sorted(v) for k, v in postings.items()}
+
+
+def _postings_from_dict(x: Dict[str, List[str]]) -> Postings:
+    return {k: set(v) for k, v in x.items()}
@@ -4,7 +4,10 @@ from dandi_nwb_meta import process_dandisets
 def main():
     process_dandisets(
         max_time=60 * 120,
-        max_time_per_dandiset=30
+        max_time_per_dandiset=30,
+        num_parallel_dandisets=4,
+        num_workers_per_dandiset=4,
+        order_by="backlog"
     )
 
 
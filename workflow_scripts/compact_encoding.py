@@ -0,0 +1,103 @@
+import io
+from typing import BinaryIO, Iterable, List, Tuple, Union
+import msgpack
+import zstandard
+
+
+# Format of an encoded output:
+#   MAGIC, then FORMAT_VERSION (one byte)
+#   a zstd frame holding the MessagePack array
+#     [dandiset header, [[asset header, asset body], ...]]
+#   where each asset body is itself MessagePack, stored as bytes, so that it
+#   is only decoded when it is accessed.
+# The frame is compressed with a window large enough to span a whole output,
+# so the group paths, attribute names and dtypes that repeat from one asset to
+# the next are stored as back-references to the first asset that has them.
+MAGIC = b"DNMB"
+FORMAT_VERSION = 2
+
+# 128 MB; the decoder needs the same limit to accept the frames
+_WINDOW_LOG = 27
+_COMPRESSION_LEVEL = 9
+# For outputs that are about to be rewritten, e.g. checkpoints
+FAST_COMPRESSION_LEVEL = 3
+
+
+def encode_output(
+    header: dict,
+    assets: Iterable[Tuple[dict, Union[dict, bytes]]],
+    num_assets: Union[int, None] = None,
+    *,
+    level: int = _COMPRESSION_LEVEL,
+) -> bytes:
+    """Encodes an output given the dandiset header and (header, body) per asset (see write_output)."""
+    buf = io.BytesIO()
+    write_output(buf, header, assets, num_assets, level=level)
+    return buf.getvalue()
+
+
+def write_output(
+    f: BinaryIO,
+    header: dict,
+    assets: Iterable[Tuple[dict, Union[dict, bytes]]],
+    num_assets: Union[int, None] = None,
+    *,
+    level: int = _COMPRESSION_LEVEL,
+):
+    """Writes an encoded output to a binary file, one asset at a time.
+
+    A body can also be given already packed, as bytes from CompactOutput.assets.
+    num_assets is needed if assets is not a sized collection, e.g. a
+    generator that encodes each asset when it is reached. Only one asset is
+    held in memory at a time, besides the compressor's window.
+    """
+    if num_assets is None:
+        num_assets = len(assets)
+    f.write(MAGIC + bytes([FORMAT_VERSION]))
+    params = zstandard.ZstdCompressionParameters.from_level(level, window_log=_WINDOW_LOG, enable_ldm=True)
+    compressor = zstandard.ZstdCompressor(compression_params=params)
+    packer = msgpack.Packer(use_bin_type=True)
+    with compressor.stream_writer(f, closefd=False) as z:
+        z.write(packer.pack_array_header(2))
+        z.write(packer.pack(header))
+        z.write(packer.pack_array_header(num_assets))
+        n = 0
+        for h, body in assets:
+            z.write(packer.pack_array_header(2))
+            z.write(packer.pack(h))
+            z.write(packer.pack(body if isinstance(body, bytes) else _pack(body)))
+            n += 1
+        if n != num_assets:
+            raise ValueError(f"Expected {num_assets} assets, got {n}")
+
+
+class CompactOutput:
+    """A decoded output. Asset bodies are decoded on demand.
+
+    header is the dandiset header, and assets holds the header of each asset
+    and its packed body, to be decoded with decode_body.
+    """
+
+    def __init__(self, data: bytes):
+        if not is_compact_output(data):
+            raise ValueError("Not a compact output")
+        version = data[len(MAGIC)]
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported compact output version: {version}")
+        decompressor = zstandard.ZstdDecompressor(max_window_size=2 ** _WINDOW_LOG)
+        # Streamed frames do not record their decompressed size
+        x = msgpack.unpackb(decompressor.decompressobj().decompress(data[len(MAGIC) + 1:]), raw=False)
+        self.header: dict = x[0]
+        self.assets: List[Tuple[dict, bytes]] = [(h, body) for h, body in x[1]]
+
+
+def is_compact_output(data: bytes) -> bool:
+    return data[:len(MAGIC)] == MAGIC
+
+
+def decode_body(body: bytes) -> dict:
+    return msgpack.unpackb(body, raw=False)
+
+
+def _pack(x) -> bytes:
+    return msgpack.packb(x, use_bin_type=True)
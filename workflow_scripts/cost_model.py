@@ -0,0 +1,99 @@
+from typing import Dict, Union
+from pydantic import BaseModel, Field
+
+
+class LinearFit(BaseModel):
+    """Exponentially weighted least-squares fit of y = a + b * x."""
+    n: float = Field(0, description="Sum of weights")
+    sx: float = Field(0, description="Weighted sum of x")
+    sy: float = Field(0, description="Weighted sum of y")
+    sxx: float = Field(0, description="Weighted sum of x^2")
+    sxy: float = Field(0, description="Weighted sum of x * y")
+
+    def add(self, x: float, y: float, decay: float = 0.98):
+        """Adds an observation; older observations are down-weighted by decay."""
+        self.n = self.n * decay + 1
+        self.sx = self.sx * decay + x
+        self.sy = self.sy * decay + y
+        self.sxx = self.sxx * decay + x * x
+        self.sxy = self.sxy * decay + x * y
+
+    def predict(self, x: float) -> Union[float, None]:
+        if self.n < 1:
+            return None
+        mean_x = self.sx / self.n
+        mean_y = self.sy / self.n
+        var_x = self.sxx / self.n - mean_x * mean_x
+        if self.n < 3 or var_x <= 1e-12 * max(1.0, mean_x * mean_x):
+            # Not enough spread in x for a slope: use the mean
+            return mean_y
+        b = (self.sxy / self.n - mean_x * mean_y) / var_x
+        if b < 0:
+            return mean_y
+        return mean_y + b * (x - mean_x)
+
+
+class DandisetCostHistory(BaseModel):
+    fit: LinearFit = Field(LinearFit(), description="Extraction seconds as a function of asset size in MB")
+    num_remaining_assets: Union[int, None] = Field(None, description="NWB assets left unprocessed by the last run")
+    num_assets: Union[int, None] = Field(None, description="Assets in the listing when num_remaining_assets was recorded")
+    digest: Union[str, None] = Field(None, description="Listing digest when num_remaining_assets was recorded")
+
+
+class CostHistory(BaseModel):
+    """History of asset extraction times, used to predict the cost of assets.
+
+    Costs are predicted from the asset size with a linear fit over the past
+    extractions in the same dandiset, falling back to a fit over all
+    dandisets and then to default_cost.
+    """
+    dandisets: Dict[str, DandisetCostHistory] = Field({}, description="History by dandiset identifier")
+    overall: LinearFit = Field(LinearFit(), description="Fit over all dandisets")
+    default_cost: float = Field(10, description="Predicted seconds per asset without history")
+
+    def predict_asset_cost(self, dandiset_id: str, size: int) -> float:
+        size_mb = size / 1e6
+        h = self.dandisets.get(dandiset_id)
+        cost = h.fit.predict(size_mb) if h is not None else None
+        if cost is None:
+            cost = self.overall.predict(size_mb)
+        if cost is None:
+            cost = self.default_cost
+        return max(cost, 0.1)
+
+    def predict_backlog_cost(
+        self, dandiset_id: str, num_assets: int, total_size: int, digest: Union[str, None] = None
+    ) -> float:
+        """Predicts the time needed for the unprocessed assets of a dandiset.
+
+        num_assets, total_size and digest describe the whole dandiset (from the
+        listing). The number of unprocessed assets is taken from the last run
+        if the listing still has the same digest or number of assets; if
+        assets were added since, they are added to it, and otherwise all
+        assets count as unprocessed.
+        """
+        if num_assets == 0:
+            return 0
+        num_remaining = num_assets
+        h = self.dandisets.get(dandiset_id)
+        if h is not None and h.num_remaining_assets is not None and h.num_assets is not None:
+            if (digest is not None and digest == h.digest) or num_assets == h.num_assets:
+                num_remaining = h.num_remaining_assets
+            elif num_assets > h.num_assets:
+                num_remaining = h.num_remaining_assets + num_assets - h.num_assets
+        return num_remaining * self.predict_asset_cost(dandiset_id, total_size // num_assets)
+
+    def record_asset(self, dandiset_id: str, size: int, duration: float):
+        h = self.dandisets.setdefault(dandiset_id, DandisetCostHistory())
+        h.fit.add(size / 1e6, duration)
+        self.overall.add(size / 1e6, duration)
+
+    def record_remaining(
+        self, dandiset_id: str, num_remaining_assets: int, num_assets: int, digest: Union[str, None] = None
+    ):
+        """Records the number of unprocessed assets left by a run, with the
+        number of assets and the digest of the listing it was made from."""
+        h = self.dandisets.setdefault(dandiset_id, DandisetCostHistory())
+        h.num_remaining_assets = num_remaining_assets
+        h.num_assets = num_assets
+        h.digest = digest
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import os
+import random
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import AsyncIterator, List, Union
+from pydantic import BaseModel, Field
+
+
+DANDI_API_URL = "https://api.dandiarchive.org/api"
+
+
+class CrawledAsset(BaseModel):
+    """An asset from the DANDI asset listing.
+
+    The attributes match the ones used from dandi's RemoteAsset, so that
+    process_dandiset can use either.
+    """
+    identifier: str = Field(description="Asset ID")
+    path: str = Field(description="Asset path in the dandiset")
+    size: int = Field(0, description="Size in bytes")
+    blob: Union[str, None] = Field(None, description="Blob ID of the asset content")
+    download_url: str = Field(description="URL to download the asset")
+
+
+class RateLimiter:
+    """Spaces out the start of requests to at most rate per second."""
+
+    def __init__(self, rate: float):
+        self._interval = 1 / rate if rate > 0 else 0
+        self._next_time = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_time - now
+            self._next_time = max(now, self._next_time) + self._interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class DandiCrawler:
+    """Asynchronous client for the listing endpoints of the DANDI REST API.
+
+    Pages are fetched concurrently: the first page gives the number of
+    results, and the remaining pages are then requested at once. At most
+    max_concurrency requests are open at a time, and requests start at no
+    more than requests_per_second. Failed requests (connection errors, 429
+    and 5xx responses) are retried up to max_retries times with exponential
+    backoff and jitter, honoring Retry-After.
+
+    The API URL defaults to the DANDI_API_URL environment variable or the
+    public archive, so the crawler can be pointed at a local mock.
+    """
+
+    def __init__(
+        self,
+        api_url: Union[str, None] = None,
+        *,
+        max_concurrency: int = 8,
+        requests_per_second: float = 20,
+        max_retries: int = 5,
+        backoff_sec: float = 1,
+        timeout: float = 60,
+        page_size: int = 1000,
+    ):
+        if api_url is None:
+            api_url = os.environ.get("DANDI_API_URL", DANDI_API_URL)
+        self.api_url = api_url.rstrip("/")
+        self._max_concurrency = max_concurrency
+        self._requests_per_second = requests_per_second
+        self._max_retries = max_retries
+        self._backoff_sec = backoff_sec
+        self._timeout = timeout
+        self._page_size = page_size
+        # Created lazily, inside the running event loop
+        self._semaphore: Union[asyncio.Semaphore, None] = None
+        self._rate_limiter: Union[RateLimiter, None] = None
+        self.num_requests = 0
+        self.num_retries = 0
+
+    async def iter_dandisets(self) -> AsyncIterator[dict]:
+        """Yields the listing entries of all non-empty, public dandisets.
+
+        The entries come in the order of the API (most recently modified first).
+        """
+        url = self._url(
+            "/dandisets/",
+            ordering="-modified", draft="true", empty="false", embargoed="false",
+        )
+        async for page in self._iter_pages(url):
+            for ds in page:
+                yield ds
+
+    async def list_assets(self, dandiset_id: str, version: str) -> List[CrawledAsset]:
+        """Lists all assets of a version of a dandiset."""
+        url = self._url(f"/dandisets/{dandiset_id}/versions/{version}/assets/")
+        assets: List[CrawledAsset] = []
+        async for page in self._iter_pages(url):
+            for a in page:
+                assets.append(
+                    CrawledAsset(
+                        identifier=a["asset_id"],
+                        path=a["path"],
+                        size=a.get("size") or 0,
+                        blob=a.get("blob"),
+                        download_url=f"{self.api_url}/assets/{a['asset_id']}/download/",
+                    )
+                )
+        return assets
+
+    async def get_json(self, url: str) -> dict:
+        """GETs a URL and parses the response, with rate limiting and retries."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+            self._rate_limiter = RateLimiter(self._requests_per_second)
+        loop = asyncio.get_event_loop()
+        attempt = 0
+        while True:
+            retry_after: Union[float, None] = None
+            async with self._semaphore:
+                await self._rate_limiter.wait()
+                self.num_requests += 1
+                try:
+                    # urllib is blocking, so it runs in the default executor
+                    return await loop.run_in_executor(None, self._get_json_blocking, url)
+                except urllib.error.HTTPError as e:
+                    if e.code != 429 and e.code < 500:
+                        raise
+                    error: Exception = e
+                    retry_after = _parse_retry_after(e.headers.get("Retry-After") if e.headers else None)
+                except OSError as e:
+                    # Connection errors and timeouts (including URLError)
+                    error = e
+            if attempt >= self._max_retries:
+                raise error
+            delay = self._backoff_sec * 2 ** attempt * (0.5 + random.random())
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            attempt += 1
+            self.num_retries += 1
+            print(f"Retrying {url} in {delay:.1f} seconds ({error})")
+            await asyncio.sleep(delay)
+
+    def _get_json_blocking(self, url: str) -> dict:
+        req = urllib.request.Request(url, headers={"Accept": "application/json"})
+        with urllib.request.urlopen(req, timeout=self._timeout) as response:
+            return json.loads(response.read())
+
+    async def _iter_pages(self, url: str) -> AsyncIterator[List[dict]]:
+        """Yields the results of all pages of a paginated listing, in order."""
+        first = await self.get_json(_with_query(url, page=1, page_size=self._page_size))
+        results = first.get("results") or []
+        yield results
+        # The server may use a smaller page size than the one requested
+        page_size = len(results)
+        if page_size == 0 or first.get("next") is None:
+            return
+        num_pages = (first.get("count", 0) + page_size - 1) // page_size
+        tasks = [
+            asyncio.ensure_future(self.get_json(_with_query(url, page=page, page_size=page_size)))
+            for page in range(2, num_pages + 1)
+        ]
+        try:
+            for task in tasks:
+                yield (await task).get("results") or []
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _url(self, path: str, **query) -> str:
+        return _with_query(self.api_url + path, **query)
+
+
+def _with_query(url: str, **query) -> str:
+    parts = urllib.parse.urlsplit(url)
+    q = dict(urllib.parse.parse_qsl(parts.query))
+    q.update({k: str(v) for k, v in query.items()})
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(q)))
+
+
+def _parse_retry_after(value: Union[str, None]) -> Union[float, None]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
@@ -1,36 +1,336 @@
+import io
 import os
-from tempfile import TemporaryDirectory
-import dandi.dandiarchive as da
+from contextlib import nullcontext
+from dandi.dandiapi import DandiAPIClient
 import json
+import hashlib
 import warnings
 import urllib
+import threading
 import time
-from typing import List
+import queue
+import asyncio
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    Executor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Callable, Deque, Dict, Iterator, List, Set, Tuple
 from typing import Union, Any
 from pydantic import BaseModel, Field
 import gzip
-import boto3
+import requests
+import requests.adapters
 from h5tojson import h5_to_object, H5ToJsonFile, H5ToJsonOpts
+from http_cache import HttpCache
+from remote_file import CachedRemoteFile, evict_block_cache
+from cost_model import CostHistory
+from dandi_crawler import CrawledAsset, DandiCrawler
+from compact_encoding import FAST_COMPRESSION_LEVEL, CompactOutput, write_output
+from archive_index import ArchiveIndex
+from nwb_layouts import diff_tree, fingerprint_layout
+from metrics import MetricsRecorder
+from local_mirror import get_local_path, list_mirror_assets, list_mirror_dandisets
+from manifest import (
+    DandisetManifest,
+    DandisetManifestEntry,
+    _get_object_key_for_manifest,
+    _load_cost_history,
+    _load_manifest,
+    _save_cost_history,
+    _save_manifest,
+    _write_local_json,
+)
+from output_model import (
+    DandiNwbMetaAsset,
+    DandiNwbMetaDandiset,
+    ExistingAssetIndex,
+    LazyDandiNwbMetaAsset,
+    LazyDandiNwbMetaDandiset,
+    iter_output_assets,
+)
+from process_pool import SharedProcessPool
+from s3_upload import (
+    BackgroundUploader,
+    _get_s3_client,
+    _upload_bytes_to_s3,
+    _upload_objects_to_s3,
+)
+
+
+def process_dandisets(
+    *,
+    max_time: float,
+    max_time_per_dandiset: float,
+    num_parallel_dandisets: int = 1,
+    num_workers_per_dandiset: int = 1,
+    use_processes: bool = True,
+    layout: str = "single",
+    encoding: str = "json",
+    delete_other_encoding: bool = False,
+    order_by: str = "modified",
+    use_manifest: bool = True,
+    min_asset_timeout: float = 300,
+    retry_failed_after_sec: float = 7 * 24 * 3600,
+    use_crawler: bool = False,
+    crawler: Union[DandiCrawler, None] = None,
+    summary_fname: Union[str, None] = "process_dandisets_summary.json",
+    metrics_fname: Union[str, None] = "process_dandisets_metrics.jsonl",
+    mirror_dir: Union[str, None] = None,
+):
+    """Processes all public dandisets until max_time has elapsed (see README.md).
+
+    Up to num_parallel_dandisets dandisets are processed at once, each for at
+    most max_time_per_dandiset seconds; a failing dandiset is reported in the
+    summary and does not stop the run. With use_processes, the assets are
+    extracted on one SharedProcessPool with num_workers_per_dandiset workers
+    per dandiset; a calling script then needs an `if __name__ ==
+    "__main__":` guard. layout, encoding and delete_other_encoding are passed
+    to process_dandiset. order_by is "modified" (most recently modified
+    first), "size" (most assets first), "stale" (least recently completed
+    first) or "backlog" (largest predicted time of the unprocessed assets
+    first).
+
+    With use_manifest, a dandiset is skipped if its listing digest matches
+    the one recorded when it was last completed (every asset extracted or
+    failed, and the output uploaded), unless it has failed assets and was
+    completed more than retry_failed_after_sec ago. min_asset_timeout is the
+    smallest timeout of an extraction.
+
+    With use_crawler, the dandisets and their assets are listed by crawler (a
+    DandiCrawler by default) in the background. With mirror_dir, they are
+    taken from this local mirror, and everything is written locally instead
+    of to the bucket. summary_fname and metrics_fname are the files that the
+    summaries and the durations of each stage are written to (None for
+    none). Returns the summaries.
+    """
+    if use_crawler and mirror_dir is not None:
+        raise ValueError("use_crawler and mirror_dir cannot be used together")
+    timer = time.time()
+    deadline = timer + max_time
+    metrics = MetricsRecorder(metrics_fname)
+
+    # The outputs of a local mirror must not reach the public bucket
+    s3 = _get_s3_client() if mirror_dir is None else None
+    uploader = BackgroundUploader() if s3 is not None else None
+    manifest = _load_manifest(s3) if use_manifest else DandisetManifest()
+    cost_history = _load_cost_history(s3)
+    archive_index = _load_archive_index(s3)
+    block_cache_dir = _get_block_cache_dir()
+    if block_cache_dir is not None:
+        # Blocks of the assets that were not extracted are left behind
+        evict_block_cache(block_cache_dir, _get_block_cache_max_size())
+    # Started now, so that the workers import their modules while the dandisets are listed
+    process_pool = (
+        SharedProcessPool(num_parallel_dandisets * num_workers_per_dandiset)
+        if use_processes else None
+    )
 
+    def _select(d: Dandiset) -> bool:
+        # Skip the dandisets that did not change since they were completed,
+        # unless it is time to retry their failed assets
+        if not use_manifest or d.dandiset_id not in manifest.dandisets:
+            return True
+        entry = manifest.dandisets[d.dandiset_id]
+        return entry.digest != d.digest or (
+            bool(entry.failed_asset_ids)
+            and time.time() - entry.last_completed > retry_failed_after_sec
+        )
 
-def process_dandisets(*, max_time: float, max_time_per_dandiset: float):
-    dandisets = fetch_all_dandisets()
+    def _order(dandisets: List[Dandiset]) -> List[Dandiset]:
+        return _order_dandisets(dandisets, order_by, manifest, cost_history)
+
+    stop_crawler = threading.Event()
+    if use_crawler:
+        work_queue = _start_crawler(
+            crawler if crawler is not None else DandiCrawler(),
+            select=_select,
+            order=None if order_by == "modified" else _order,
+            max_queued=2 * num_parallel_dandisets,
+            stop=stop_crawler,
+            metrics=metrics,
+        )
 
-    timer = time.time()
-    for dandiset in dandisets:
+        def _next_work(block: bool) -> Union[_WorkItem, None]:
+            try:
+                item = work_queue.get(timeout=1) if block else work_queue.get_nowait()
+            except queue.Empty:
+                return None
+            return item if item is not None else _END_OF_WORK
+    else:
+        with metrics.timer("list_dandisets") as m:
+            if mirror_dir is not None:
+                mirror_assets = {
+                    dandiset_id: list_mirror_assets(mirror_dir, dandiset_id)
+                    for dandiset_id in list_mirror_dandisets(mirror_dir)
+                }
+                dandisets = [_dandiset_from_mirror(k, v) for k, v in mirror_assets.items()]
+            else:
+                mirror_assets = {}
+                dandisets = fetch_all_dandisets()
+            m["num_dandisets"] = len(dandisets)
+        dandisets = [d for d in dandisets if _select(d)]
+        if use_manifest:
+            print(f"{len(dandisets)} dandisets changed since they were last processed")
+        remaining = iter(
+            _WorkItem(dandiset=d, assets=mirror_assets.get(d.dandiset_id)) for d in _order(dandisets)
+        )
+
+        def _next_work(block: bool) -> Union[_WorkItem, None]:
+            return next(remaining, _END_OF_WORK)
+
+    summaries: List[DandisetProcessingSummary] = []
+
+    def _process(item: _WorkItem) -> DandisetProcessingSummary:
+        dandiset = item.dandiset
         print("")
         print(f"Processing {dandiset.dandiset_id} version {dandiset.version}")
-        process_dandiset(dandiset.dandiset_id, max_time_per_dandiset)
-        elapsed = time.time() - timer
-        print(f"Time elapsed: {elapsed} seconds")
-        if elapsed > max_time:
-            print("Time limit reached.")
-            break
+        t0 = time.time()
+        try:
+            if item.error is not None:
+                raise Exception(f"Failed to list assets: {item.error}")
+            return process_dandiset(
+                dandiset.dandiset_id,
+                min(max_time_per_dandiset, deadline - t0),
+                s3=s3,
+                client=client,
+                num_workers=num_workers_per_dandiset,
+                use_processes=use_processes,
+                executor=process_pool,
+                layout=layout,
+                encoding=encoding,
+                delete_other_encoding=delete_other_encoding,
+                uploader=uploader,
+                cost_history=cost_history,
+                min_asset_timeout=min_asset_timeout,
+                assets=item.assets,
+                output_key=manifest.output_keys.get(dandiset.dandiset_id),
+                archive_index=archive_index,
+                metrics=metrics,
+                mirror_dir=mirror_dir,
+            )
+        except Exception as e:
+            print(str(e))
+            print(f"Failed to process {dandiset.dandiset_id}")
+            return DandisetProcessingSummary(
+                dandiset_id=dandiset.dandiset_id,
+                elapsed_sec=time.time() - t0,
+                error=str(e),
+            )
+
+    with (DandiAPIClient() if mirror_dir is None else nullcontext(None)) as client:
+        with ThreadPoolExecutor(max_workers=num_parallel_dandisets) as executor:
+            in_flight: Dict[Future, Dandiset] = {}
+            manifest_changed = False
+            exhausted = False
+            while True:
+                while (
+                    not exhausted
+                    and len(in_flight) < num_parallel_dandisets
+                    and time.time() <= deadline
+                ):
+                    # Wait for the crawler only when there is nothing else to do
+                    item = _next_work(block=not in_flight)
+                    if item is None:
+                        break
+                    if item is _END_OF_WORK:
+                        exhausted = True
+                        break
+                    in_flight[executor.submit(_process, item)] = item.dandiset
+                if not in_flight:
+                    if exhausted or time.time() > deadline:
+                        break
+                    continue
+                done, _ = wait(
+                    in_flight,
+                    timeout=1 if use_crawler and not exhausted else None,
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    dandiset = in_flight.pop(future)
+                    summary = future.result()
+                    summaries.append(summary)
+                    metrics.record(
+                        "dandiset",
+                        summary.elapsed_sec,
+                        dandiset_id=summary.dandiset_id,
+                        num_extracted_assets=summary.num_extracted_assets,
+                        num_remaining_assets=summary.num_remaining_assets,
+                        num_failed_assets=len(summary.failed_asset_ids),
+                        **({"error": summary.error} if summary.error else {}),
+                    )
+                    for size, duration in summary.asset_costs:
+                        cost_history.record_asset(dandiset.dandiset_id, size, duration)
+                    if summary.error is None:
+                        cost_history.record_remaining(
+                            dandiset.dandiset_id,
+                            summary.num_remaining_assets,
+                            num_assets=dandiset.asset_count,
+                            digest=dandiset.digest,
+                        )
+                    # The output is saved even if the archive index could
+                    # not be updated; only summaries of failed runs lack a key
+                    if (
+                        use_manifest
+                        and summary.output_key is not None
+                        and manifest.output_keys.get(dandiset.dandiset_id) != summary.output_key
+                    ):
+                        manifest.output_keys[dandiset.dandiset_id] = summary.output_key
+                        manifest_changed = True
+                    if summary.error is None and summary.num_remaining_assets == 0:
+                        manifest.dandisets[dandiset.dandiset_id] = DandisetManifestEntry(
+                            modified=dandiset.modified,
+                            digest=dandiset.digest,
+                            last_completed=time.time(),
+                            failed_asset_ids=summary.failed_asset_ids,
+                        )
+                        manifest_changed = True
+                if done:
+                    elapsed = time.time() - timer
+                    print(f"Time elapsed: {elapsed} seconds")
+    stop_crawler.set()
+    if process_pool is not None:
+        process_pool.shutdown()
+    if time.time() > deadline:
+        print("Time limit reached.")
+
+    if uploader is not None:
+        # Outputs that failed to upload do not count as completed
+        upload_errors = uploader.wait()
+        uploader.shutdown()
+        for summary in summaries:
+            if summary.dandiset_id in upload_errors:
+                summary.error = upload_errors[summary.dandiset_id]
+                manifest.dandisets.pop(summary.dandiset_id, None)
+                # The output may still be in the objects of the previous save
+                manifest.output_keys.pop(summary.dandiset_id, None)
+
+    if use_manifest and manifest_changed:
+        _save_manifest(s3, manifest)
+    _save_cost_history(s3, cost_history)
+    _save_archive_index(s3, archive_index)
+
+    _print_processing_summary(summaries, time.time() - timer)
+    metrics.print_summary()
+    metrics.close()
+    if summary_fname is not None:
+        with open(summary_fname, "w") as f:
+            json.dump([x.dict(exclude={"asset_costs"}) for x in summaries], f, indent=2)
+    return summaries
 
 
 class Dandiset(BaseModel):
     dandiset_id: str
     version: str
+    modified: str = ""
+    asset_count: int = 0
+    size: int = 0
+    digest: str = ""
 
 
 def fetch_all_dandisets():
@@ -38,44 +338,290 @@ def fetch_all_dandisets():
     with urllib.request.urlopen(url) as response:
         X = json.loads(response.read())
 
-    dandisets: List[Dandiset] = []
-    for ds in X["results"]:
-        pv = ds["most_recent_published_version"]
-        dv = ds["draft_version"]
-        dandisets.append(
-            Dandiset(
-                dandiset_id=ds["identifier"],
-                version=pv["version"] if pv else dv["version"],
-            )
-        )
+    return [_dandiset_from_listing(ds) for ds in X["results"]]
+
+
+def _dandiset_from_listing(ds: dict) -> Dandiset:
+    """Creates a Dandiset from an entry of the DANDI dandiset listing."""
+    pv = ds["most_recent_published_version"]
+    dv = ds["draft_version"]
+    v = pv if pv else dv
+    return Dandiset(
+        dandiset_id=ds["identifier"],
+        version=v["version"],
+        modified=ds.get("modified") or "",
+        asset_count=v.get("asset_count") or 0,
+        size=v.get("size") or 0,
+        digest=_compute_listing_digest(ds),
+    )
 
-    return dandisets
 
+def _dandiset_from_mirror(dandiset_id: str, assets: List[CrawledAsset]) -> Dandiset:
+    """Creates a Dandiset from the NWB files of a dandiset in a local mirror."""
+    x = [[a.path, a.blob] for a in assets]
+    return Dandiset(
+        dandiset_id=dandiset_id,
+        version="draft",
+        asset_count=len(assets),
+        size=sum(a.size for a in assets),
+        digest=hashlib.sha1(json.dumps(x).encode()).hexdigest(),
+    )
 
-def process_dandiset(dandiset_id: str, max_time: float):
-    timer = time.time()
 
-    if os.environ.get("AWS_ACCESS_KEY_ID") is not None:
-        s3 = boto3.client(
-            "s3",
-            aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
-            aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
-            endpoint_url=os.environ["S3_ENDPOINT_URL"],
-            region_name="auto",  # for cloudflare
+class _WorkItem(BaseModel):
+    dandiset: Dandiset
+    assets: Union[List[CrawledAsset], None] = None
+    error: Union[str, None] = None
+
+
+# Returned by the work sources of process_dandisets when there is no more work
+_END_OF_WORK = _WorkItem(dandiset=Dandiset(dandiset_id="", version=""))
+
+
+def _start_crawler(
+    crawler: DandiCrawler,
+    *,
+    select: Callable[[Dandiset], bool],
+    order: Union[Callable[[List[Dandiset]], List[Dandiset]], None],
+    max_queued: int,
+    stop: threading.Event,
+    metrics: Union[MetricsRecorder, None] = None,
+) -> "queue.Queue[Union[_WorkItem, None]]":
+    """Lists the selected dandisets and their assets in a background thread.
+
+    Returns a queue that receives a _WorkItem for each selected dandiset as
+    soon as its assets are listed, and None at the end. If order is None,
+    the dandisets are taken in listing order as the pages arrive; otherwise
+    the whole listing is fetched and ordered first. The crawler stays at
+    most about max_queued dandisets ahead of the consumer, and ends once
+    stop is set.
+    """
+    work_queue: "queue.Queue[Union[_WorkItem, None]]" = queue.Queue(maxsize=max_queued)
+
+    async def _put(item: Union[_WorkItem, None]):
+        while not stop.is_set():
+            try:
+                work_queue.put_nowait(item)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.1)
+
+    async def _crawl():
+        slots = asyncio.Semaphore(max_queued)
+        tasks: List[asyncio.Future] = []
+
+        async def _list_assets(d: Dandiset):
+            t0 = time.time()
+            try:
+                assets = await crawler.list_assets(d.dandiset_id, d.version)
+                item = _WorkItem(dandiset=d, assets=assets)
+            except Exception as e:
+                item = _WorkItem(dandiset=d, error=str(e))
+            if metrics is not None:
+                metrics.record(
+                    "list_assets",
+                    time.time() - t0,
+                    dandiset_id=d.dandiset_id,
+                    **({"error": item.error} if item.error else {"num_assets": len(item.assets)}),
+                )
+            try:
+                await _put(item)
+            finally:
+                slots.release()
+
+        async def _enqueue(d: Dandiset):
+            await slots.acquire()
+            tasks.append(asyncio.ensure_future(_list_assets(d)))
+
+        try:
+            if order is None:
+                async for ds in crawler.iter_dandisets():
+                    if stop.is_set():
+                        break
+                    d = _dandiset_from_listing(ds)
+                    if select(d):
+                        await _enqueue(d)
+            else:
+                dandisets = [_dandiset_from_listing(ds) async for ds in crawler.iter_dandisets()]
+                for d in order([d for d in dandisets if select(d)]):
+                    if stop.is_set():
+                        break
+                    await _enqueue(d)
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            print(str(e))
+            print("Failed to list dandisets")
+        finally:
+            await _put(None)
+        print(f"Crawler made {crawler.num_requests} requests ({crawler.num_retries} retries)")
+
+    threading.Thread(target=lambda: asyncio.run(_crawl()), daemon=True).start()
+    return work_queue
+
+
+def _compute_listing_digest(ds: dict) -> str:
+    """Digest of the parts of a dandiset listing entry that change with its assets."""
+    versions = [ds.get("draft_version"), ds.get("most_recent_published_version")]
+    x = {
+        "identifier": ds["identifier"],
+        "modified": ds.get("modified"),
+        "versions": [
+            {k: v.get(k) for k in ["version", "modified", "asset_count", "size"]}
+            if v else None
+            for v in versions
+        ],
+    }
+    return hashlib.sha1(json.dumps(x, sort_keys=True).encode()).hexdigest()
+
+
+def _order_dandisets(
+    dandisets: List[Dandiset],
+    order_by: str,
+    manifest: "DandisetManifest",
+    cost_history: CostHistory,
+) -> List[Dandiset]:
+    if order_by == "modified":
+        return sorted(dandisets, key=lambda x: x.modified, reverse=True)
+    elif order_by == "size":
+        return sorted(dandisets, key=lambda x: x.asset_count, reverse=True)
+    elif order_by == "stale":
+        def _last_completed(x: Dandiset):
+            entry = manifest.dandisets.get(x.dandiset_id)
+            return entry.last_completed if entry else 0
+        return sorted(dandisets, key=_last_completed)
+    elif order_by == "backlog":
+        return sorted(
+            dandisets,
+            key=lambda x: cost_history.predict_backlog_cost(x.dandiset_id, x.asset_count, x.size, x.digest),
+            reverse=True,
         )
     else:
-        s3 = None
+        raise ValueError(f"Unexpected order_by: {order_by}")
+
+
+class DandisetProcessingSummary(BaseModel):
+    dandiset_id: str = Field(description="Dandiset identifier")
+    num_nwb_assets: int = Field(0, description="Number of NWB assets in the dandiset")
+    num_existing_assets: int = Field(0, description="Number of assets reused from the existing output")
+    num_extracted_assets: int = Field(0, description="Number of assets extracted in this run")
+    num_remaining_assets: int = Field(0, description="Number of assets that were not reached")
+    failed_asset_ids: List[str] = Field([], description="Identifiers of the assets whose extraction failed")
+    elapsed_sec: float = Field(0, description="Wall time spent on the dandiset")
+    error: Union[str, None] = Field(None, description="Error message if processing failed")
+    output_key: Union[str, None] = Field(None, description="Key of the object that the output is loaded from")
+    asset_costs: List[Tuple[int, float]] = Field([], description="(size, seconds) of each extracted asset")
+
+
+def _load_archive_index(s3: Union[Any, None]) -> ArchiveIndex:
+    """Loads the archive index (empty if there is none)."""
+    object_key = _get_object_key_for_archive_index()
+    if s3 is not None:
+        try:
+            obj = s3.get_object(Bucket="neurosift", Key=object_key)
+        except s3.exceptions.NoSuchKey:
+            return ArchiveIndex()
+        return ArchiveIndex.from_dict(json.loads(gzip.decompress(obj["Body"].read())))
+    else:
+        fname = _get_local_fname(object_key)
+        if not os.path.exists(fname):
+            return ArchiveIndex()
+        with open(fname, "r") as f:
+            return ArchiveIndex.from_dict(json.load(f))
+
+
+def _save_archive_index(s3: Union[Any, None], archive_index: ArchiveIndex):
+    object_key = _get_object_key_for_archive_index()
+    if s3 is not None:
+        data = gzip.compress(json.dumps(archive_index.to_dict()).encode())
+        _upload_bytes_to_s3(s3, "neurosift", object_key, data, "application/gzip")
+    else:
+        _write_local_json(_get_local_fname(object_key), archive_index.to_dict())
+
+
+def _print_processing_summary(summaries: List[DandisetProcessingSummary], elapsed: float):
+    print("")
+    print(f"Processed {len(summaries)} dandisets in {elapsed:.1f} seconds")
+    for x in sorted(summaries, key=lambda x: x.elapsed_sec, reverse=True):
+        rate = x.num_extracted_assets / x.elapsed_sec if x.elapsed_sec > 0 else 0
+        status = (
+            f"error: {x.error}" if x.error
+            else f"{x.num_remaining_assets} remaining, {len(x.failed_asset_ids)} failed"
+        )
+        print(
+            f"{x.dandiset_id} | {x.num_extracted_assets} extracted | "
+            f"{x.elapsed_sec:.1f} s | {rate:.2f} assets/s | {status}"
+        )
+
+
+def process_dandiset(
+    dandiset_id: str,
+    max_time: float,
+    *,
+    s3: Union[Any, None] = None,
+    client: Union[DandiAPIClient, None] = None,
+    num_workers: int = 1,
+    use_processes: bool = True,
+    executor: Union[Executor, SharedProcessPool, None] = None,
+    layout: str = "single",
+    encoding: str = "json",
+    delete_other_encoding: bool = False,
+    uploader: Union["BackgroundUploader", None] = None,
+    checkpoint_every: int = 10,
+    checkpoint_interval_sec: float = 60,
+    cost_history: Union[CostHistory, None] = None,
+    min_asset_timeout: float = 300,
+    asset_timeout_factor: float = 5,
+    asset_deadline_grace_sec: float = 30,
+    assets: Union[List[CrawledAsset], None] = None,
+    output_key: Union[str, None] = None,
+    archive_index: Union[ArchiveIndex, None] = None,
+    metrics: Union[MetricsRecorder, None] = None,
+    mirror_dir: Union[str, None] = None,
+) -> "DandisetProcessingSummary":
+    """Processes the NWB assets of a dandiset and saves the output.
+
+    Up to num_workers assets are extracted at once, cheapest first (costs are
+    predicted from cost_history), on executor if given and otherwise on a
+    pool of processes (use_processes) or threads started for this dandiset.
+    No extraction is started once its predicted cost no longer fits in
+    max_time, and each is cancelled after max(min_asset_timeout,
+    asset_timeout_factor * predicted cost) seconds, or
+    asset_deadline_grace_sec after max_time.
+
+    The assets are listed with client (created if needed), unless they are
+    given, or taken from mirror_dir, in which case the output is written
+    locally and s3 must be None. output_key is the key that the existing
+    output is loaded from, if known. layout, encoding and
+    delete_other_encoding are passed to _save_output, and the upload runs on
+    uploader if given. The output is checkpointed after every
+    checkpoint_every new assets or checkpoint_interval_sec seconds. If
+    archive_index is given it is updated, and a failure to do so is reported
+    as the error of the summary. The duration of each stage is recorded in
+    metrics.
+    """
+    timer = time.time()
+
+    if mirror_dir is not None:
+        if s3 is not None:
+            raise ValueError("The output of a local mirror cannot be saved to the bucket")
+    elif s3 is None:
+        s3 = _get_s3_client()
+    if metrics is None:
+        metrics = MetricsRecorder()
 
     # Load existing output
     print("Checking for existing output")
-    existing = _load_existing_output(s3, dandiset_id)
+    with metrics.timer("load_existing", dandiset_id=dandiset_id) as m:
+        existing = _load_existing_output(s3, dandiset_id, lazy=True, object_key=output_key)
+        m["num_assets"] = len(existing.nwb_assets) if existing is not None else 0
     if existing is not None:
         print(f"Found {len(existing.nwb_assets)} existing assets.")
+        existing_index = ExistingAssetIndex(existing.nwb_assets)
     else:
         print("No existing output found.")
-
-    # Create the dandi parsed url
-    parsed_url = da.parse_dandi_url(f"https://dandiarchive.org/dandiset/{dandiset_id}")
+        existing_index = None
+    # The objects of the output in storage; the ones that a save leaves unused are deleted
+    stored_keys: Set[str] = set(existing.object_keys) if existing is not None else set()
 
     # Create the new output
     X = DandiNwbMetaDandiset(
@@ -85,83 +631,419 @@ def process_dandiset(dandiset_id: str, max_time: float):
     something_changed = False
     if existing is None:
         something_changed = True
-    with parsed_url.navigate() as (client, dandiset, assets):
+    list_timer = time.time()
+    listed_here = assets is None
+    if assets is None and mirror_dir is not None:
+        assets = list_mirror_assets(mirror_dir, dandiset_id)
+    with (DandiAPIClient() if client is None and assets is None else nullcontext(client)) as client:
+        if assets is None:
+            assets = client.get_dandiset(dandiset_id).get_assets()
+        # One entry per NWB asset, in asset order. Entries are None for the
+        # assets that still need to be extracted.
+        entries: List[Union[DandiNwbMetaAsset, LazyDandiNwbMetaAsset, None]] = []
+        pending: List[_PendingAsset] = []
         asset_num = 0
         # Loop through all assets in the dandiset
-        for asset in dandiset.get_assets():
+        for asset in assets:
             asset_num += 1
             if asset.path.endswith(".nwb"):  # only process NWB files
                 # Check if the asset has already been processed
+                blob_id = getattr(asset, "blob", None)
                 item = (
-                    next(
-                        (
-                            x
-                            for x in existing.nwb_assets
-                            if x.asset_id == asset.identifier
-                        ),
-                        None,
-                    )
-                    if existing
+                    existing_index.lookup(asset.identifier, asset.path, blob_id)
+                    if existing_index
                     else None
                 )
                 if item:
                     # The asset has already been processed in the output file
-                    print(
-                        f"{asset_num}: {X.dandiset_id} | {asset.path} | already processed"
-                    )
-                    X.nwb_assets.append(item)
+                    if item.asset_id != asset.identifier or item.asset_path != asset.path:
+                        # Same content under a new asset id or path
+                        print(
+                            f"{asset_num}: {X.dandiset_id} | {asset.path} | already processed as {item.asset_path}"
+                        )
+                        item = item.copy(
+                            update={
+                                "asset_id": asset.identifier,
+                                "asset_path": asset.path,
+                                "download_url": asset.download_url,
+                            }
+                        )
+                        something_changed = True
+                    else:
+                        print(
+                            f"{asset_num}: {X.dandiset_id} | {asset.path} | already processed"
+                        )
+                    if item.blob_id is None and blob_id is not None:
+                        item = item.copy(update={"blob_id": blob_id})
+                        something_changed = True
+                    entries.append(item)
                     continue
-                print(f"{asset_num}: {X.dandiset_id} | {asset.path}")
-                opts = H5ToJsonOpts(skip_all_dataset_data=True)
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    nwb_metadata = h5_to_object(asset.download_url, opts)
-                # Create the new asset
-                A = DandiNwbMetaAsset(
-                    asset_id=asset.identifier,
-                    asset_path=asset.path,
-                    nwb_metadata=nwb_metadata,
-                    download_url=asset.download_url
+                entries.append(None)
+                size = getattr(asset, "size", None) or 0
+                predicted_cost = (cost_history or CostHistory()).predict_asset_cost(dandiset_id, size)
+                pending.append(
+                    _PendingAsset(
+                        index=len(entries) - 1,
+                        label=f"{asset_num}: {X.dandiset_id} | {asset.path}",
+                        asset_id=asset.identifier,
+                        asset_path=asset.path,
+                        download_url=asset.download_url,
+                        blob_id=blob_id,
+                        size=size,
+                        predicted_cost=predicted_cost,
+                        timeout=max(min_asset_timeout, asset_timeout_factor * predicted_cost),
+                    )
                 )
-                # # Open the file for lazy loading
-                # file = remfile.File(asset.download_url, verbose=False)
-                # with h5py.File(file, "r") as h5_file:
-                #     all_groups_in_h5_file = _get_h5_groups(h5_file)
-                #     # Add the groups to the asset
-                #     for group in all_groups_in_h5_file:
-                #         A.nwb_metadata.groups.append(
-                #             H5MetadataGroup(
-                #                 path=group.name, attrs=json.loads(_attrs_to_json(group))
-                #             )
-                #         )
-                #     # Add the datasets to the asset
-                #     all_datasets_in_h5_file = _get_h5_datasets(h5_file)
-                #     for dataset in all_datasets_in_h5_file:
-                #         dataset: h5py.Dataset = dataset
-                #         dtype = _dtype_to_str(dataset)
-                #         A.nwb_metadata.datasets.append(
-                #             H5MetadataDataset(
-                #                 path=dataset.name,
-                #                 attrs=json.loads(_attrs_to_json(dataset)),
-                #                 shape=_format_shape(dataset),
-                #                 chunks=[d for d in dataset.chunks] if dataset.chunks else None,
-                #                 compression=dataset.compression,
-                #                 compression_opts=dataset.compression_opts,
-                #                 dtype=dtype,
-                #             )
-                #         )
-                # Add the asset to the dandiset
-                X.nwb_assets.append(A)
-                something_changed = True
-            if time.time() - timer > max_time:
-                print("Time limit reached for this dandiset.")
-                break
+        # Extract the cheapest assets first to fit as many as possible in max_time
+        pending.sort(key=lambda p: p.predicted_cost)
+    if listed_here:
+        metrics.record("list_assets", time.time() - list_timer, dandiset_id=dandiset_id, num_assets=asset_num)
+
+    written_shard_keys: Set[str] = set()
+
+    def _checkpoint(new_assets: Dict[int, DandiNwbMetaAsset]):
+        X.nwb_assets = [
+            new_assets.get(i, e) for i, e in enumerate(entries)
+            if e is not None or i in new_assets
+        ]
+        print(f"Checkpointing {len(new_assets)} new assets for {dandiset_id}")
+        try:
+            _save_output(
+                s3, dandiset_id, X,
+                layout=layout, encoding=encoding, delete_other_encoding=delete_other_encoding,
+                written_shard_keys=written_shard_keys, stored_keys=stored_keys, checkpoint=True, metrics=metrics,
+            )
+        except Exception as e:
+            print(str(e))
+            print(f"Failed to checkpoint output for {dandiset_id}")
+
+    new_assets, asset_costs, failed_indices = _extract_pending_assets(
+        pending,
+        deadline=timer + max_time,
+        max_asset_deadline=timer + max_time + asset_deadline_grace_sec,
+        num_workers=num_workers,
+        use_processes=use_processes,
+        executor=executor,
+        on_checkpoint=_checkpoint,
+        checkpoint_every=checkpoint_every,
+        checkpoint_interval_sec=checkpoint_interval_sec,
+        dandiset_id=dandiset_id,
+        metrics=metrics,
+    )
+    for index, A in new_assets.items():
+        entries[index] = A
+        something_changed = True
+    # Add the assets to the dandiset, in asset order
+    X.nwb_assets = [e for e in entries if e is not None]
+    if existing is not None and len(X.nwb_assets) != len(existing.nwb_assets):
+        # Assets were removed from the dandiset
+        something_changed = True
+    kept_keys = set() if delete_other_encoding else _get_other_encoding_keys(
+        dandiset_id, layout=layout, encoding=encoding
+    )
+    if existing is not None and stored_keys - kept_keys != _get_output_object_keys(
+        dandiset_id, X, layout=layout, encoding=encoding
+    ):
+        # The output is stored in another layout or encoding
+        something_changed = True
+
     if something_changed:
         print(f"Saving output for {dandiset_id}")
-        _save_output(s3, dandiset_id, X)
+        _save_output(
+            s3, dandiset_id, X,
+            layout=layout, encoding=encoding, delete_other_encoding=delete_other_encoding, uploader=uploader,
+            written_shard_keys=written_shard_keys, stored_keys=stored_keys, metrics=metrics,
+        )
     else:
         print(f"Not saving output for {dandiset_id} because nothing changed.")
 
+    error = None
+    if archive_index is not None:
+        try:
+            if archive_index.update_dandiset(dandiset_id, X.nwb_assets):
+                print(f"Updated the archive index for {dandiset_id}")
+        except Exception as e:
+            print(str(e))
+            print(f"Failed to update the archive index for {dandiset_id}")
+            error = f"Failed to update the archive index: {e}"
+
+    return DandisetProcessingSummary(
+        dandiset_id=dandiset_id,
+        num_nwb_assets=len(entries),
+        num_existing_assets=len(entries) - len(pending),
+        num_extracted_assets=len(new_assets),
+        num_remaining_assets=len(pending) - len(new_assets) - len(failed_indices),
+        failed_asset_ids=[p.asset_id for p in pending if p.index in failed_indices],
+        elapsed_sec=time.time() - timer,
+        error=error,
+        output_key=_get_object_key_for_loading(dandiset_id, layout=layout, encoding=encoding),
+        asset_costs=asset_costs,
+    )
+
+
+class _PendingAsset(BaseModel):
+    index: int
+    label: str
+    asset_id: str
+    asset_path: str
+    download_url: str
+    blob_id: Union[str, None] = None
+    size: int = 0
+    predicted_cost: float = 0
+    timeout: Union[float, None] = None
+
+
+def _extract_pending_assets(
+    pending: List[_PendingAsset],
+    *,
+    deadline: float,
+    max_asset_deadline: Union[float, None] = None,
+    num_workers: int,
+    use_processes: bool,
+    executor: Union[Executor, SharedProcessPool, None] = None,
+    on_checkpoint: Union[Callable[[Dict[int, "DandiNwbMetaAsset"]], None], None] = None,
+    checkpoint_every: int = 10,
+    checkpoint_interval_sec: float = 60,
+    dandiset_id: Union[str, None] = None,
+    metrics: Union[MetricsRecorder, None] = None,
+) -> Tuple[Dict[int, "DandiNwbMetaAsset"], List[Tuple[int, float]], Set[int]]:
+    """Extracts the NWB metadata for the pending assets using a worker pool.
+
+    The pool is executor if one is given (it is not shut down here), and
+    otherwise a new process or thread pool. An extraction that is still
+    running at its deadline counts as timed out; on a SharedProcessPool its
+    worker is stopped (and with it the other extractions on the pool, which
+    are submitted again), while on threads it is left to finish in the
+    background.
+
+    Returns a dict mapping the entry index of each successfully extracted asset
+    to the new asset, the (size, seconds) of each of these extractions, and
+    the entry indices of the assets whose extraction failed.
+    Assets are submitted in order, and at most num_workers are in flight at
+    once, so a slow asset only occupies a single worker. pending is sorted
+    by predicted cost, cheapest first: once an asset has been submitted, the
+    first asset whose predicted cost does not fit before the deadline ends
+    the submissions, since none of the later ones would fit either. Each extraction is cancelled after its timeout, or
+    at max_asset_deadline if that is earlier; an asset cancelled at
+    max_asset_deadline is not reached rather than failed. An asset whose
+    worker process died (which, on a shared pool, may be caused by another
+    dandiset's file) is not reached either; it is submitted again once.
+    on_checkpoint is called with the results so far after every
+    checkpoint_every new assets or checkpoint_interval_sec seconds. An
+    "extract" event is recorded in metrics for each asset.
+    """
+    results: Dict[int, DandiNwbMetaAsset] = {}
+    asset_costs: List[Tuple[int, float]] = []
+    failed: Set[int] = set()
+    if not pending:
+        return results, asset_costs, failed
+    own_pool: Union[SharedProcessPool, ThreadPoolExecutor, None] = None
+    if executor is None:
+        if use_processes:
+            own_pool = executor = SharedProcessPool(num_workers)
+        else:
+            own_pool = executor = ThreadPoolExecutor(max_workers=num_workers)
+    remaining = iter(pending)
+    # Assets to submit again because their worker process died
+    retries: Deque[_PendingAsset] = deque()
+    resubmitted: Set[int] = set()
+    in_flight: Dict[Future, _PendingAsset] = {}
+    start_times: Dict[Future, float] = {}
+    asset_deadlines: Dict[Future, Union[float, None]] = {}
+    time_limit_reached = False
+    exhausted = False
+    # Extractions that timed out on threads, which cannot be stopped
+    abandoned = False
+    last_checkpoint_time = time.time()
+    num_since_checkpoint = 0
+    try:
+        while True:
+            while len(in_flight) < num_workers and not time_limit_reached:
+                if time.time() > deadline:
+                    time_limit_reached = True
+                    break
+                p = retries.popleft() if retries else next(remaining, None)
+                if p is None:
+                    exhausted = True
+                    break
+                if start_times and time.time() + p.predicted_cost > deadline:
+                    # The later assets are predicted to take at least as long
+                    num_skipped = 1 + len(retries) + sum(1 for _ in remaining)
+                    retries.clear()
+                    print(
+                        f"Skipping {num_skipped} assets that are predicted to take "
+                        f"{p.predicted_cost:.1f} seconds or more"
+                    )
+                    exhausted = True
+                    break
+                print(p.label)
+                asset_deadline = time.time() + p.timeout if p.timeout is not None else None
+                if max_asset_deadline is not None and (
+                    asset_deadline is None or asset_deadline > max_asset_deadline
+                ):
+                    asset_deadline = max_asset_deadline
+                extract = (
+                    _extract_local_nwb_metadata if p.download_url.startswith("file://") else _extract_nwb_metadata
+                )
+                future = executor.submit(extract, p.download_url, p.asset_id, asset_deadline)
+                in_flight[future] = p
+                start_times[future] = time.time()
+                asset_deadlines[future] = asset_deadline
+            if not in_flight:
+                break
+            # Wake up at the nearest asset deadline, to stop an extraction
+            # that is stuck where the worker does not check it
+            next_deadline = min(
+                (asset_deadlines[f] for f in in_flight if asset_deadlines[f] is not None), default=None
+            )
+            done, _ = wait(
+                in_flight,
+                timeout=max(0, next_deadline - time.time()) if next_deadline is not None else None,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                p = in_flight.pop(future)
+                duration = time.time() - start_times[future]
+                event = {"dandiset_id": dandiset_id, "asset_id": p.asset_id, "asset_path": p.asset_path, "size": p.size}
+                try:
+                    nwb_metadata, stats = future.result()
+                except BrokenProcessPool as e:
+                    print(f"The worker process extracting {p.asset_path} died")
+                    if metrics is not None:
+                        metrics.record("extract", duration, **event, error=str(e) or "BrokenProcessPool")
+                    if p.index not in resubmitted:
+                        resubmitted.add(p.index)
+                        retries.append(p)
+                        exhausted = False
+                    continue
+                except Exception as e:
+                    print(str(e))
+                    print(f"Failed to extract NWB metadata for {p.asset_path}")
+                    if max_asset_deadline is None or time.time() < max_asset_deadline:
+                        failed.add(p.index)
+                    if metrics is not None:
+                        metrics.record("extract", duration, **event, error=str(e))
+                    continue
+                # Create the new asset
+                t0 = time.time()
+                results[p.index] = DandiNwbMetaAsset(
+                    asset_id=p.asset_id,
+                    asset_path=p.asset_path,
+                    nwb_metadata=nwb_metadata,
+                    download_url=p.download_url,
+                    blob_id=p.blob_id,
+                )
+                if metrics is not None:
+                    metrics.record("extract", duration, **event, **stats, validate_sec=time.time() - t0)
+                asset_costs.append((p.size, duration))
+                num_since_checkpoint += 1
+            now = time.time()
+            for future in [f for f in in_flight if asset_deadlines[f] is not None and asset_deadlines[f] <= now]:
+                p = in_flight.pop(future)
+                print(f"Extraction of {p.asset_path} timed out")
+                # Cut short by max_asset_deadline: not reached rather than failed
+                if max_asset_deadline is None or asset_deadlines[future] < max_asset_deadline:
+                    failed.add(p.index)
+                if metrics is not None:
+                    metrics.record(
+                        "extract", now - start_times[future],
+                        dandiset_id=dandiset_id, asset_id=p.asset_id, asset_path=p.asset_path, size=p.size,
+                        error="timed out",
+                    )
+                if isinstance(executor, SharedProcessPool):
+                    # The other extractions in flight on the pool are submitted again
+                    executor.terminate(future)
+                else:
+                    future.cancel()
+                    abandoned = True
+            # No checkpoint when the final save is about to happen anyway
+            more_to_come = bool(in_flight) or not (exhausted or time_limit_reached)
+            if on_checkpoint is not None and num_since_checkpoint > 0 and more_to_come and (
+                num_since_checkpoint >= checkpoint_every
+                or time.time() - last_checkpoint_time >= checkpoint_interval_sec
+            ):
+                on_checkpoint(results)
+                last_checkpoint_time = time.time()
+                num_since_checkpoint = 0
+    finally:
+        if own_pool is not None:
+            own_pool.shutdown(wait=not abandoned)
+    if time_limit_reached:
+        print("Time limit reached for this dandiset.")
+    return results, asset_costs, failed
+
+
+def _extract_nwb_metadata(
+    download_url: str, asset_id: str, deadline: Union[float, None] = None
+) -> Tuple[H5ToJsonFile, dict]:
+    """Extracts the NWB metadata of a remote asset (runs in a worker).
+
+    The file is read through a CachedRemoteFile whose blocks stay in the disk
+    cache until the extraction succeeds, so that a retry after a failure or
+    an interrupted run does not fetch the same bytes again. The extraction
+    fails with a TimeoutError when it reads past the deadline.
+
+    Returns the metadata and the statistics of the extraction: time spent
+    on HTTP requests (fetch_sec) and on the rest (parse_sec), number of
+    requests, bytes fetched and blocks read from the disk cache.
+    """
+    timer = time.time()
+    opts = H5ToJsonOpts(skip_all_dataset_data=True)
+    f = CachedRemoteFile(
+        download_url,
+        session=_get_http_session(),
+        cache_dir=_get_block_cache_dir(),
+        cache_key=asset_id,
+        deadline=deadline,
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        nwb_metadata = h5_to_object(f, opts)
+    f.clear_cache()
+    elapsed = time.time() - timer
+    stats = {
+        "fetch_sec": f.fetch_sec,
+        "parse_sec": elapsed - f.fetch_sec,
+        "requests": f.num_requests,
+        "bytes_fetched": f.num_bytes_fetched,
+        "blocks_from_disk": f.num_blocks_from_disk,
+    }
+    return nwb_metadata, stats
+
+
+def _extract_local_nwb_metadata(
+    download_url: str, asset_id: str, deadline: Union[float, None] = None
+) -> Tuple[H5ToJsonFile, dict]:
+    """Extracts the NWB metadata of a local asset, given by a file:// URL (runs in a worker).
+
+    The file is read directly, without the block cache. The deadline is
+    enforced by _extract_pending_assets, which stops the worker process.
+    """
+    timer = time.time()
+    opts = H5ToJsonOpts(skip_all_dataset_data=True)
+    with open(get_local_path(download_url), "rb") as f:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            nwb_metadata = h5_to_object(f, opts)
+    return nwb_metadata, {"parse_sec": time.time() - timer}
+
+
+def _get_block_cache_dir() -> Union[str, None]:
+    """Directory of the block cache of remote files ($DANDI_NWB_META_BLOCK_CACHE_DIR).
+
+    Defaults to ~/.cache/dandi-nwb-meta-blocks; an empty string disables it.
+    """
+    cache_dir = os.environ.get(
+        "DANDI_NWB_META_BLOCK_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "dandi-nwb-meta-blocks"),
+    )
+    return cache_dir or None
+
+
+def _get_block_cache_max_size() -> int:
+    """Size limit of the block cache ($DANDI_NWB_META_BLOCK_CACHE_MAX_SIZE, default 2 GB)."""
+    return int(os.environ.get("DANDI_NWB_META_BLOCK_CACHE_MAX_SIZE", 2 * 1024 ** 3))
+
 
 # class H5MetadataGroup(BaseModel):
 #     path: str = Field(description="Path to the group")
@@ -185,19 +1067,6 @@ def process_dandiset(dandiset_id: str, max_time: float):
 #     datasets: List[H5MetadataDataset] = Field(description="HDF5 dataset metadata")
 
 
-class DandiNwbMetaAsset(BaseModel):
-    asset_id: str = Field(description="Asset identifier")
-    asset_path: str = Field(description="Asset path")
-    nwb_metadata: H5ToJsonFile = Field(description="NWB metadata")
-    download_url: Union[str, None] = Field(None, description="Download URL for the asset")
-
-
-class DandiNwbMetaDandiset(BaseModel):
-    dandiset_id: str = Field(description="Dandiset identifier")
-    dandiset_version: str = Field(description="Dandiset version")
-    nwb_assets: List[DandiNwbMetaAsset] = Field(description="List of assets")
-
-
 # def _get_h5_groups(h5_file: h5py.File) -> list:
 #     """Returns a list of all groups in an h5 file.
 
@@ -300,119 +1169,678 @@ class DandiNwbMetaDandiset(BaseModel):
 #     return [int(dim) for dim in shape]
 
 
-def load_existing_output_from_bucket(dandiset_id: str) -> DandiNwbMetaDandiset:
-    with TemporaryDirectory() as tempdir:
-        tmp_output_fname = os.path.join(tempdir, "output.json.gz")
+def load_existing_output_from_bucket(
+    dandiset_id: str, *, lazy: bool = False, object_key: Union[str, None] = None
+) -> Union[DandiNwbMetaDandiset, "LazyDandiNwbMetaDandiset", None]:
+    """Loads the output for a dandiset from the bucket.
+
+    If lazy is True, the assets are returned as LazyDandiNwbMetaAsset objects
+    whose nwb_metadata is only parsed when accessed. For sharded outputs this
+    means that only the shards of the accessed assets are downloaded.
+
+    object_key is the key of the object that the output is loaded from, if it
+    is known (see get_output_keys_from_bucket). Otherwise, or if that object
+    is missing, the keys of the JSON output, the compact output and the index
+    of a sharded output are tried in this order.
+    """
+    for key in _get_output_key_candidates(dandiset_id, object_key):
+        X = _load_output_object(key, lazy=lazy)
+        if X is not None:
+            return X
+    return None
+
+
+def _get_output_key_candidates(dandiset_id: str, object_key: Union[str, None]) -> List[str]:
+    keys = [
+        _get_object_key_for_output(dandiset_id),
+        _get_object_key_for_compact_output(dandiset_id),
+        _get_object_key_for_output_index(dandiset_id),
+    ]
+    if object_key is None:
+        return keys
+    return [object_key] + [k for k in keys if k != object_key]
+
+
+def _load_output_object(
+    object_key: str, *, lazy: bool
+) -> Union[DandiNwbMetaDandiset, "LazyDandiNwbMetaDandiset", None]:
+    """Loads an output from the bucket object it is loaded from (None if missing)."""
+    if object_key.endswith("/index.json"):
+        index = _fetch_from_bucket(object_key)
+        if index is None:
+            return None
+        return _load_sharded_output(
+            json.loads(index),
+            lambda key: json.loads(gzip.decompress(_fetch_from_bucket(key))),
+            lazy=lazy,
+        )
+    if object_key.endswith(".dnmb"):
+        data = _fetch_from_bucket(object_key)
+        return _load_compact_output(data, lazy=lazy) if data is not None else None
+    object_keys = [object_key]
+    url = _get_bucket_url(object_key)
+    cache = _get_output_cache()
+    if cache is not None:
         try:
-            object_key = _get_object_key_for_output(dandiset_id)
-            url = f"https://neurosift.org/{object_key}"
-            _download_file(url, tmp_output_fname)
-        except urllib.error.HTTPError:
+            body = cache.get(_get_http_session(), url)
+        except requests.HTTPError:
+            return None
+        if body is None:
+            return None
+        with body, gzip.open(body, "rt") as f:
+            return _load_existing_output_from_stream(f, lazy=lazy, object_keys=object_keys)
+    # Decompress and parse straight from the response
+    with _get_http_session().get(url, stream=True, headers={"Accept-Encoding": "identity"}) as response:
+        if not response.ok:
             return None
-        return _load_existing_output_from_file(tmp_output_fname)
+        response.raw.decode_content = True
+        with gzip.open(response.raw, "rt") as f:
+            return _load_existing_output_from_stream(f, lazy=lazy, object_keys=object_keys)
+
+
+def get_output_keys_from_bucket() -> Dict[str, str]:
+    """Returns the key of the object that the output of each dandiset is loaded from.
+
+    The keys are recorded in the manifest by process_dandisets. Dandisets
+    that are missing (e.g. processed before the keys were recorded) can still
+    be loaded, by trying the possible keys. Returns an empty dict if the
+    manifest cannot be read.
+    """
+    try:
+        data = _fetch_from_bucket(_get_object_key_for_manifest())
+    except requests.RequestException as e:
+        print(str(e))
+        print("Failed to load the manifest")
+        return {}
+    return DandisetManifest(**json.loads(data)).output_keys if data is not None else {}
+
+
+def load_archive_index_from_bucket() -> Union[ArchiveIndex, None]:
+    """Loads the archive index from the bucket (None if there is none).
+
+    Use its find_assets, find_dandisets and find_paths methods to find the
+    assets with a neurodata type, namespace or path without loading outputs.
+    """
+    data = _fetch_from_bucket(_get_object_key_for_archive_index())
+    if data is None:
+        return None
+    return ArchiveIndex.from_dict(json.loads(gzip.decompress(data)))
+
+
+def load_existing_outputs_from_bucket(
+    dandiset_ids: List[str], *, num_parallel: int = 8, lazy: bool = False
+) -> Iterator[Tuple[str, Union[DandiNwbMetaDandiset, "LazyDandiNwbMetaDandiset", None]]]:
+    """Loads the outputs of many dandisets with parallel downloads.
+
+    Yields (dandiset_id, output) in the order of dandiset_ids, where output is
+    None for dandisets without output, or whose output could not be
+    downloaded. Each output is fetched from the object recorded in the
+    manifest (see get_output_keys_from_bucket), with a single request.
+    Downloads share the pooled HTTP session and run at most 2 * num_parallel
+    outputs ahead of the consumer.
+    """
+    output_keys = get_output_keys_from_bucket()
+    remaining = iter(dandiset_ids)
+    window: Deque[Tuple[str, Future]] = deque()
+    with ThreadPoolExecutor(max_workers=num_parallel) as executor:
+        while True:
+            while len(window) < 2 * num_parallel:
+                dandiset_id = next(remaining, None)
+                if dandiset_id is None:
+                    break
+                future = executor.submit(
+                    load_existing_output_from_bucket,
+                    dandiset_id,
+                    lazy=lazy,
+                    object_key=output_keys.get(dandiset_id),
+                )
+                window.append((dandiset_id, future))
+            if not window:
+                break
+            dandiset_id, future = window.popleft()
+            try:
+                X = future.result()
+            except requests.RequestException as e:
+                print(str(e))
+                print(f"Failed to load the output for {dandiset_id}")
+                X = None
+            yield dandiset_id, X
+
+
+def get_output_versions_from_bucket(
+    dandiset_ids: List[str], *, num_parallel: int = 16
+) -> Dict[str, Union[str, None]]:
+    """Returns the version of the output of each dandiset (None if there is none).
+
+    The version is the key and the ETag (or Last-Modified) of the object that
+    the output is loaded from, so it changes whenever the output is rewritten.
+    It is found with HEAD requests, without downloading any output; usually
+    a single request, to the object recorded in the manifest. The version is
+    "" if the bucket sends neither header, or if the request failed.
+    """
+    output_keys = get_output_keys_from_bucket()
+
+    def _get_version(dandiset_id: str) -> Union[str, None]:
+        try:
+            return _get_output_version(dandiset_id, output_keys.get(dandiset_id))
+        except requests.RequestException as e:
+            print(str(e))
+            print(f"Failed to get the output version for {dandiset_id}")
+            return ""
+
+    with ThreadPoolExecutor(max_workers=num_parallel) as executor:
+        return dict(zip(dandiset_ids, executor.map(_get_version, dandiset_ids)))
+
+
+def _get_output_version(dandiset_id: str, object_key: Union[str, None] = None) -> Union[str, None]:
+    # Same lookup order as load_existing_output_from_bucket
+    for key in _get_output_key_candidates(dandiset_id, object_key):
+        response = _get_http_session().head(_get_bucket_url(key), allow_redirects=True)
+        if response.status_code in (403, 404):
+            continue
+        response.raise_for_status()
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+        return f"{key} {validator}" if validator else ""
+    return None
 
 
 def _load_existing_output(
-    s3: Union[Any, None], dandiset_id: str
-) -> DandiNwbMetaDandiset:
-    """Loads the existing output for a dandiset."""
+    s3: Union[Any, None], dandiset_id: str, *, lazy: bool = False, object_key: Union[str, None] = None
+) -> Union[DandiNwbMetaDandiset, "LazyDandiNwbMetaDandiset", None]:
+    """Loads the existing output for a dandiset, in any layout and encoding.
+
+    The possible objects are tried in the same order as in
+    load_existing_output_from_bucket, starting with object_key if it is given.
+    """
     if s3 is not None:
-        return load_existing_output_from_bucket(dandiset_id)
-    else:
-        output_fname = f"dandisets/{dandiset_id}.json"
-        return _load_existing_output_from_file(output_fname)
+        return load_existing_output_from_bucket(dandiset_id, lazy=lazy, object_key=object_key)
+    for key in _get_output_key_candidates(dandiset_id, object_key):
+        fname = _get_local_fname(key)
+        if not os.path.exists(fname):
+            continue
+        if key.endswith("/index.json"):
+            with open(fname, "r") as f:
+                index = json.load(f)
+
+            def _read_shard(key: str) -> dict:
+                with open(_get_local_fname(key), "r") as f:
+                    return json.load(f)
+
+            return _load_sharded_output(index, _read_shard, lazy=lazy)
+        if key.endswith(".dnmb"):
+            with open(fname, "rb") as f:
+                return _load_compact_output(f.read(), lazy=lazy)
+        return _load_existing_output_from_file(fname, lazy=lazy, object_keys=[key])
+    return None
+
+
+def _load_sharded_output(
+    index: dict, read_shard: Callable[[str], dict], *, lazy: bool
+) -> Union[DandiNwbMetaDandiset, "LazyDandiNwbMetaDandiset"]:
+    """Creates an output from a shard index; shards are read on demand."""
+    dandiset_id = index["dandiset_id"]
+    assets = []
+    object_keys = [_get_object_key_for_output_index(dandiset_id)]
+    for h in index["nwb_assets"]:
+        key = _get_object_key_for_asset_shard(dandiset_id, h["asset_id"])
+        assets.append(
+            LazyDandiNwbMetaAsset(
+                partial(read_shard, key), header=h, shard_key=key
+            )
+        )
+        object_keys.append(key)
+    existing = LazyDandiNwbMetaDandiset(
+        dandiset_id=dandiset_id,
+        dandiset_version=index["dandiset_version"],
+        nwb_assets=assets,
+        object_keys=object_keys,
+    )
+    return existing if lazy else existing.load()
+
+
+def _load_compact_output(
+    data: bytes, *, lazy: bool
+) -> Union[DandiNwbMetaDandiset, "LazyDandiNwbMetaDandiset"]:
+    """Creates an output from its compact encoding; asset bodies are decoded on demand."""
+    x = CompactOutput(data)
+    header = dict(x.header)
+    layouts = header.pop("layouts", None)
+    existing = LazyDandiNwbMetaDandiset(
+        **header,
+        nwb_assets=[LazyDandiNwbMetaAsset(body, header=h, layouts=layouts) for h, body in x.assets],
+        object_keys=[_get_object_key_for_compact_output(header["dandiset_id"])],
+    )
+    return existing if lazy else existing.load()
 
 
-def _get_object_key_for_output(dandiset_id: str) -> str:
-    return f"dandi-nwb-meta/dandisets/{dandiset_id}.json.gz"
+def _fetch_from_bucket(object_key: str) -> Union[bytes, None]:
+    """Fetches an object through the public URL of the bucket (None if missing)."""
+    url = _get_bucket_url(object_key)
+    cache = _get_output_cache()
+    if cache is not None:
+        body = cache.get(_get_http_session(), url)
+        if body is None:
+            return None
+        with body:
+            return body.read()
+    response = _get_http_session().get(url)
+    if response.status_code in (403, 404):
+        return None
+    response.raise_for_status()
+    return response.content
 
 
-def _load_existing_output_from_file(output_fname: str) -> DandiNwbMetaDandiset:
-    if os.path.exists(output_fname):
-        if output_fname.endswith(".gz"):
-            with open(output_fname, "rb") as f:
-                existing = json.loads(gzip.decompress(f.read()))
-                existing = DandiNwbMetaDandiset(**existing)
-        else:
-            with open(output_fname, "r") as f:
-                existing = json.load(f)
-                existing = DandiNwbMetaDandiset(**existing)
-    else:
-        existing = None
-    return existing
+def _get_bucket_url(object_key: str) -> str:
+    return f"https://neurosift.org/{object_key}"
 
 
-def _download_file(url: str, output_fname: str):
-    """Downloads a file from a URL."""
-    with open(output_fname, "wb") as f:
-        # The User-Agent header is required so that cloudflare doesn't block the request
-        req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
-        with urllib.request.urlopen(req) as response:
-            chunk_size = 1024
-            while True:
-                chunk = response.read(chunk_size)
-                if not chunk:
-                    break
-                f.write(chunk)
+_http_session: Union[requests.Session, None] = None
+_http_session_lock = threading.Lock()
 
 
-def _save_output(s3: Union[Any, None], dandiset_id: str, X: DandiNwbMetaDandiset):
-    """Saves the output for a dandiset."""
-    if s3 is not None:
-        with TemporaryDirectory() as tempdir:
-            tmp_output_fname = os.path.join(tempdir, "output.json.gz")
-            _save_output_to_file(tmp_output_fname, X)
-            object_key = _get_object_key_for_output(dandiset_id)
-            print(f"Uploading output to {object_key}")
-            _upload_file_to_s3(s3, "neurosift", object_key, tmp_output_fname)
-    else:
-        output_fname = f"dandisets/{dandiset_id}.json"
-        # make the output directory if it doesn't exist
-        if not os.path.exists("dandisets"):
-            os.makedirs("dandisets")
-        _save_output_to_file(output_fname, X)
-
-
-def _upload_file_to_s3(s3, bucket, object_key, fname):
-    if fname.endswith(".html"):
-        content_type = "text/html"
-    elif fname.endswith(".js"):
-        content_type = "application/javascript"
-    elif fname.endswith(".css"):
-        content_type = "text/css"
-    elif fname.endswith(".png"):
-        content_type = "image/png"
-    elif fname.endswith(".jpg"):
-        content_type = "image/jpeg"
-    elif fname.endswith(".svg"):
-        content_type = "image/svg+xml"
-    elif fname.endswith(".json"):
-        content_type = "application/json"
-    elif fname.endswith(".gz"):
-        content_type = "application/gzip"
-    else:
-        content_type = None
-    extra_args = {}
-    if content_type is not None:
-        extra_args["ContentType"] = content_type
-    s3.upload_file(fname, bucket, object_key, ExtraArgs=extra_args)
+def _get_http_session() -> requests.Session:
+    """Returns the HTTP session (with a connection pool) shared by all bucket reads."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=32)
+            session.mount("https://", adapter)
+            # The User-Agent header is required so that cloudflare doesn't block the request
+            session.headers["User-Agent"] = "Mozilla/5.0"
+            _http_session = session
+        return _http_session
 
 
-def _delete_file_from_s3(s3, bucket, object_key):
-    try:
-        s3.delete_object(Bucket=bucket, Key=object_key)
-    except Exception as e:
-        print(str(e))
-        print("Failed to delete file from S3.")
+_output_cache: Union[HttpCache, None] = None
+
+
+def _get_output_cache() -> Union[HttpCache, None]:
+    """Returns the local cache of bucket objects, or None if it is disabled.
+
+    The cache lives in $DANDI_NWB_META_CACHE_DIR (default
+    ~/.cache/dandi-nwb-meta; set it to an empty string to disable caching) and
+    holds at most $DANDI_NWB_META_CACHE_MAX_SIZE bytes (default 2 GB).
+    """
+    global _output_cache
+    cache_dir = os.environ.get(
+        "DANDI_NWB_META_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "dandi-nwb-meta"),
+    )
+    if not cache_dir:
+        return None
+    with _http_session_lock:
+        if _output_cache is None or _output_cache.cache_dir != cache_dir:
+            max_size = int(os.environ.get("DANDI_NWB_META_CACHE_MAX_SIZE", 2 * 1024 ** 3))
+            _output_cache = HttpCache(cache_dir, max_size)
+        return _output_cache
+
+
+def _get_object_key_for_output(dandiset_id: str) -> str:
+    return f"dandi-nwb-meta/dandisets/{dandiset_id}.json.gz"
+
+
+def _get_object_key_for_archive_index() -> str:
+    return "dandi-nwb-meta/dandisets/archive_index.json.gz"
+
+
+def _get_object_key_for_compact_output(dandiset_id: str) -> str:
+    return f"dandi-nwb-meta/dandisets/{dandiset_id}.dnmb"
+
+
+def _get_object_key_for_output_index(dandiset_id: str) -> str:
+    return f"dandi-nwb-meta/dandisets/{dandiset_id}/index.json"
+
+
+def _get_object_key_for_asset_shard(dandiset_id: str, asset_id: str) -> str:
+    return f"dandi-nwb-meta/dandisets/{dandiset_id}/assets/{asset_id}.json.gz"
+
+
+def _get_local_fname(object_key: str) -> str:
+    """Local path used instead of a bucket object when there are no credentials."""
+    fname = object_key[len("dandi-nwb-meta/"):]
+    return fname[:-len(".gz")] if fname.endswith(".gz") else fname
+
+
+def _load_existing_output_from_file(
+    output_fname: str, *, lazy: bool = False, object_keys: Union[List[str], None] = None
+) -> Union[DandiNwbMetaDandiset, "LazyDandiNwbMetaDandiset", None]:
+    if not os.path.exists(output_fname):
+        return None
+    opener = gzip.open if output_fname.endswith(".gz") else open
+    with opener(output_fname, "rt") as f:
+        return _load_existing_output_from_stream(f, lazy=lazy, object_keys=object_keys)
+
+
+def _load_existing_output_from_stream(
+    f, *, lazy: bool = False, object_keys: Union[List[str], None] = None
+) -> Union[DandiNwbMetaDandiset, "LazyDandiNwbMetaDandiset"]:
+    header, assets = iter_output_assets(f)
+    existing = LazyDandiNwbMetaDandiset(**header, nwb_assets=list(assets), object_keys=object_keys)
+    return existing if lazy else existing.load()
+
+
+def _save_output(
+    s3: Union[Any, None],
+    dandiset_id: str,
+    X: DandiNwbMetaDandiset,
+    *,
+    layout: str = "single",
+    encoding: str = "json",
+    delete_other_encoding: bool = False,
+    uploader: Union[BackgroundUploader, None] = None,
+    written_shard_keys: Union[Set[str], None] = None,
+    stored_keys: Union[Set[str], None] = None,
+    checkpoint: bool = False,
+    metrics: Union[MetricsRecorder, None] = None,
+):
+    """Saves the output for a dandiset.
+
+    layout is "single" (one object for the whole dandiset) or "sharded" (one
+    object per asset plus an index, see _serialize_sharded_output). encoding is
+    "json" or, for the single layout, "compact" (see compact_encoding). The
+    output is serialized one asset at a time, into memory for an upload or
+    into the local file; the upload runs on the uploader if one is given.
+    checkpoint is True for the saves made while extracting, which trade size
+    for speed.
+
+    Outputs are looked up at the key recorded in the manifest, and otherwise
+    as JSON, then compact, then sharded, so an output in another encoding or
+    layout can shadow the new one until it is deleted through stored_keys.
+
+    If stored_keys (the keys of the objects of the output that are in
+    storage, e.g. LazyDandiNwbMetaDandiset.object_keys) is given, the objects
+    that the new output does not use are deleted once it is written: the
+    index and shards when switching to the single layout, the single-file
+    output when switching to the sharded layout, and the shards of removed
+    assets. The single-file output in the other encoding is only deleted if
+    delete_other_encoding is True, since readers outside this repo may fetch
+    it by its URL. stored_keys and written_shard_keys are only updated once
+    the output is written (on the uploader, if one is given), so that after
+    a failed upload the next save writes the same shards again and still
+    deletes the stale objects.
+
+    The serialization (with the local write, if there is no S3 client) and
+    the upload are recorded separately in metrics, if given.
+    """
+    if metrics is None:
+        metrics = MetricsRecorder()
+    with metrics.timer("serialize", dandiset_id=dandiset_id, layout=layout, encoding=encoding):
+        objects = _serialize_output(
+            s3, dandiset_id, X,
+            layout=layout, encoding=encoding, written_shard_keys=written_shard_keys, checkpoint=checkpoint,
+        )
+    new_keys = _get_output_object_keys(dandiset_id, X, layout=layout, encoding=encoding)
+    stale_keys: List[str] = []
+    kept_keys: Set[str] = set()
+    if stored_keys is not None:
+        if not delete_other_encoding:
+            kept_keys = stored_keys & _get_other_encoding_keys(dandiset_id, layout=layout, encoding=encoding)
+        stale_keys = sorted(stored_keys - new_keys - kept_keys)
+
+    def _on_saved(undeleted_keys: List[str]):
+        if written_shard_keys is not None and layout == "sharded":
+            # Every shard of the output is in storage now
+            written_shard_keys.update(new_keys - {_get_object_key_for_output_index(dandiset_id)})
+        if stored_keys is not None:
+            stored_keys.clear()
+            stored_keys.update(new_keys | kept_keys | set(undeleted_keys))
+
+    if s3 is None:
+        for key in stale_keys:
+            fname = _get_local_fname(key)
+            if os.path.exists(fname):
+                os.remove(fname)
+        _on_saved([])
+    elif objects or stale_keys:
+        _upload_objects_to_s3(
+            s3, objects, label=dandiset_id, uploader=uploader, metrics=metrics, delete_keys=stale_keys,
+            on_uploaded=_on_saved,
+        )
+    else:
+        _on_saved([])
+
+
+def _get_output_object_keys(dandiset_id: str, X: DandiNwbMetaDandiset, *, layout: str, encoding: str) -> Set[str]:
+    """Returns the keys of the objects that make up an output once it is saved."""
+    if layout == "sharded":
+        return {_get_object_key_for_output_index(dandiset_id)} | {
+            _get_object_key_for_asset_shard(dandiset_id, a.asset_id) for a in X.nwb_assets
+        }
+    if encoding == "compact":
+        return {_get_object_key_for_compact_output(dandiset_id)}
+    return {_get_object_key_for_output(dandiset_id)}
+
+
+def _get_other_encoding_keys(dandiset_id: str, *, layout: str, encoding: str) -> Set[str]:
+    """Returns the key of the single-file output in the encoding other than encoding."""
+    if layout != "single":
+        return set()
+    if encoding == "compact":
+        return {_get_object_key_for_output(dandiset_id)}
+    return {_get_object_key_for_compact_output(dandiset_id)}
+
+
+def _get_object_key_for_loading(dandiset_id: str, *, layout: str, encoding: str) -> str:
+    """Returns the key of the object that an output is loaded from once it is saved."""
+    if layout == "sharded":
+        return _get_object_key_for_output_index(dandiset_id)
+    if encoding == "compact":
+        return _get_object_key_for_compact_output(dandiset_id)
+    return _get_object_key_for_output(dandiset_id)
+
+
+def _serialize_output(
+    s3: Union[Any, None],
+    dandiset_id: str,
+    X: DandiNwbMetaDandiset,
+    *,
+    layout: str,
+    encoding: str,
+    written_shard_keys: Union[Set[str], None],
+    checkpoint: bool = False,
+) -> List[Tuple[str, bytes, str]]:
+    """Returns the objects to upload, or writes them locally if there is no S3 client."""
+    if encoding not in ("json", "compact"):
+        raise ValueError(f"Unexpected encoding: {encoding}")
+    if layout == "sharded":
+        if encoding != "json":
+            raise ValueError("The sharded layout only supports the json encoding")
+        return _serialize_sharded_output(s3, dandiset_id, X, written_shard_keys=written_shard_keys)
+    elif layout != "single":
+        raise ValueError(f"Unexpected layout: {layout}")
+    if encoding == "compact":
+        return _serialize_compact_output(s3, dandiset_id, X, checkpoint=checkpoint)
+    if s3 is not None:
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as gz:
+            with io.TextIOWrapper(gz, encoding="utf-8") as f:
+                _write_output(f, X)
+        return [(_get_object_key_for_output(dandiset_id), buf.getvalue(), "application/gzip")]
+    output_fname = f"dandisets/{dandiset_id}.json"
+    # make the output directory if it doesn't exist
+    if not os.path.exists("dandisets"):
+        os.makedirs("dandisets")
+    _save_output_to_file(output_fname, X)
+    return []
+
+
+def _serialize_compact_output(
+    s3: Union[Any, None],
+    dandiset_id: str,
+    X: DandiNwbMetaDandiset,
+    *,
+    checkpoint: bool = False,
+) -> List[Tuple[str, bytes, str]]:
+    """Encodes the output one asset at a time (see compact_encoding.write_output).
+
+    Checkpoints are compressed at a faster level, since they are rewritten
+    by the next save.
+    """
+    layouts = _collect_layouts(X)
+
+    def _write(f):
+        write_output(
+            f,
+            {"dandiset_id": X.dandiset_id, "dandiset_version": X.dandiset_version, "layouts": layouts},
+            _iter_layout_deltas(X, layouts),
+            len(X.nwb_assets),
+            **({"level": FAST_COMPRESSION_LEVEL} if checkpoint else {}),
+        )
+
+    object_key = _get_object_key_for_compact_output(dandiset_id)
+    if s3 is not None:
+        buf = io.BytesIO()
+        _write(buf)
+        # Already compressed
+        return [(object_key, buf.getvalue(), "application/octet-stream")]
+    fname = _get_local_fname(object_key)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname + ".tmp", "wb") as f:
+        _write(f)
+    os.replace(fname + ".tmp", fname)
+    return []
+
+
+def _serialize_sharded_output(
+    s3: Union[Any, None],
+    dandiset_id: str,
+    X: DandiNwbMetaDandiset,
+    *,
+    written_shard_keys: Union[Set[str], None] = None,
+) -> List[Tuple[str, bytes, str]]:
+    """Serializes one object per asset and then the index that lists them.
+
+    Assets that were loaded from an up-to-date shard, or whose shard key is in
+    written_shard_keys (see _save_output), are not written again, so
+    adding assets to a sharded output only writes the new shards and the
+    index. An output in the single-file layout is migrated on its first save.
+    """
+    objects: List[Tuple[str, bytes, str]] = []
+    new_shard_keys: List[str] = []
+    for a in X.nwb_assets:
+        key = _get_object_key_for_asset_shard(dandiset_id, a.asset_id)
+        if getattr(a, "shard_key", None) == key:
+            continue
+        if written_shard_keys is not None and key in written_shard_keys:
+            continue
+        new_shard_keys.append(key)
+        x = _remove_empty_dicts_in_dict(a.dict())
+        if s3 is not None:
+            objects.append((key, gzip.compress(json.dumps(x).encode()), "application/gzip"))
+        else:
+            _write_local_json(_get_local_fname(key), x)
+    index = {
+        "dandiset_id": X.dandiset_id,
+        "dandiset_version": X.dandiset_version,
+        "nwb_assets": [
+            {
+                "asset_id": a.asset_id,
+                "asset_path": a.asset_path,
+                "download_url": a.download_url,
+                "blob_id": a.blob_id,
+            }
+            for a in X.nwb_assets
+        ],
+    }
+    index_key = _get_object_key_for_output_index(dandiset_id)
+    print(f"Writing {len(new_shard_keys)} asset shards and index {index_key}")
+    if s3 is not None:
+        # The index goes last so that it never lists a missing shard
+        objects.append((index_key, json.dumps(index).encode(), "application/json"))
+    else:
+        _write_local_json(_get_local_fname(index_key), index)
+    return objects
 
 
 def _save_output_to_file(output_fname: str, X: DandiNwbMetaDandiset):
+    # Write to a temporary file first so that the output is replaced atomically
+    tmp_output_fname = output_fname + ".tmp"
     if output_fname.endswith(".gz"):
-        with gzip.open(output_fname, "wb") as f:
-            f.write(json.dumps(_remove_empty_dicts_in_dict(X.dict())).encode())
+        with gzip.open(tmp_output_fname, "wt") as f:
+            _write_output(f, X)
     else:
-        with open(output_fname, "w") as f:
-            json.dump(_remove_empty_dicts_in_dict(X.dict()), f, indent=2)
+        with open(tmp_output_fname, "w") as f:
+            _write_output(f, X)
+    os.replace(tmp_output_fname, output_fname)
+
+
+def _write_output(f, X: DandiNwbMetaDandiset):
+    """Writes the output as JSON, one asset at a time.
+
+    The dandiset fields go on the first line and each asset on its own line,
+    so only one asset is held as a dict at any time and the output can be
+    read back incrementally. In each asset, nwb_metadata comes after the
+    other fields, so that they can be read without decoding the tree (see
+    output_model._parse_asset_header).
+
+    Assets that were read from such a line are written back as they were
+    read (see LazyDandiNwbMetaAsset.get_json_line), so rewriting an output
+    after adding assets only encodes the new ones.
+    """
+    header = X.dict(exclude={"nwb_assets"})
+    f.write(json.dumps(header)[:-1] + ', "nwb_assets": [')
+    for i, a in enumerate(X.nwb_assets):
+        f.write("\n" if i == 0 else ",\n")
+        line = a.get_json_line() if isinstance(a, LazyDandiNwbMetaAsset) else None
+        if line is None:
+            x = _remove_empty_dicts_in_dict(a.dict())
+            x["nwb_metadata"] = x.pop("nwb_metadata")
+            line = json.dumps(x)
+        f.write(line)
+    f.write("\n]}\n" if X.nwb_assets else "]}\n")
+
+
+def _collect_layouts(X: DandiNwbMetaDandiset) -> Dict[str, dict]:
+    """Returns the distinct layouts of the assets of a compact output, by id.
+
+    The layouts of the assets read from a compact output are kept, so that
+    their bodies can be written back without decoding them. Otherwise, a
+    layout is the first metadata tree seen with each fingerprint (see
+    nwb_layouts.fingerprint_layout). Only the distinct layouts are held in
+    memory, one asset being decoded at a time.
+    """
+    layouts: Dict[str, dict] = {}
+    others = []
+    for a in X.nwb_assets:
+        layout = a.get_shared_layout() if isinstance(a, LazyDandiNwbMetaAsset) else None
+        if layout is not None:
+            layouts.setdefault(a.layout_id, layout)
+        else:
+            others.append(a)
+    for a in others:
+        nwb_metadata = _remove_empty_dicts_in_dict(a.dict())["nwb_metadata"]
+        layouts.setdefault(fingerprint_layout(nwb_metadata), nwb_metadata)
+    return layouts
+
+
+def _iter_layout_deltas(
+    X: DandiNwbMetaDandiset, layouts: Dict[str, dict]
+) -> Iterator[Tuple[dict, Union[dict, bytes]]]:
+    """Yields the (header, body) of each asset, with nwb_metadata split into a layout and a delta.
+
+    The header holds the asset fields and nwb_metadata_layout (the layout id
+    in layouts, from _collect_layouts). The body holds nwb_metadata_delta
+    (the shapes, attribute values and object ids that differ from the
+    layout); it is the packed body read from a compact output if the asset
+    still has the same layout.
+    """
+    for a in X.nwb_assets:
+        header = {
+            "asset_id": a.asset_id,
+            "asset_path": a.asset_path,
+            "download_url": a.download_url,
+            "blob_id": a.blob_id,
+        }
+        body = a.get_compact_body(layouts) if isinstance(a, LazyDandiNwbMetaAsset) else None
+        if body is not None:
+            header["nwb_metadata_layout"] = a.layout_id
+            yield header, body
+            continue
+        nwb_metadata = _remove_empty_dicts_in_dict(a.dict())["nwb_metadata"]
+        layout_id = fingerprint_layout(nwb_metadata)
+        header["nwb_metadata_layout"] = layout_id
+        yield header, {"nwb_metadata_delta": diff_tree(layouts[layout_id], nwb_metadata)}
 
 
 def _remove_empty_dicts_in_dict(x: dict):
@@ -0,0 +1,105 @@
+import json
+from typing import List
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from dandi_nwb_meta import (
+    fetch_all_dandisets,
+    load_existing_output_from_bucket,
+    DandiNwbMetaAsset,
+)
+from s3_upload import _get_s3_client, _upload_file_to_s3
+
+
+# One row per HDF5 group or dataset of every processed asset
+nwb_objects_schema = pa.schema([
+    ('dandiset_id', pa.string()),
+    ('asset_id', pa.string()),
+    ('asset_path', pa.string()),
+    ('kind', pa.string()),  # 'group' or 'dataset'
+    ('path', pa.string()),
+    ('neurodata_type', pa.string()),
+    ('namespace', pa.string()),
+    ('dtype', pa.string()),
+    ('shape', pa.list_(pa.int64())),
+    ('chunks', pa.list_(pa.int64())),
+    ('compression', pa.string()),
+    ('attributes', pa.string()),  # JSON-encoded
+])
+
+
+def main(output_fname: str = 'nwb_objects.parquet'):
+    dandisets = fetch_all_dandisets()
+
+    num_rows = 0
+    with pq.ParquetWriter(output_fname, nwb_objects_schema) as writer:
+        for dandiset in dandisets:
+            X = load_existing_output_from_bucket(dandiset.dandiset_id, lazy=True)
+            if not X:
+                print(f'No output for {dandiset.dandiset_id}')
+                continue
+            print(f'Found output for {dandiset.dandiset_id}')
+            # Write one row group per dandiset so that only one dandiset is in memory
+            rows = []
+            for a in X.nwb_assets:
+                rows.extend(_flatten_asset(dandiset.dandiset_id, a.load()))
+            if rows:
+                writer.write_table(pa.Table.from_pylist(rows, schema=nwb_objects_schema))
+                num_rows += len(rows)
+    print(f'Wrote {num_rows} rows to {output_fname}')
+
+    s3 = _get_s3_client()
+    if s3 is not None:
+        object_key = 'dandi-nwb-meta/nwb_objects.parquet'
+        print(f'Uploading {output_fname} to {object_key}')
+        _upload_file_to_s3(s3, 'neurosift', object_key, output_fname)
+
+
+def find_assets_with_neurodata_type(table: pa.Table, neurodata_type: str) -> pa.Table:
+    """Returns the (dandiset_id, asset_id, asset_path, path) rows of a neurodata type.
+
+    neurodata_type is either qualified by its namespace (e.g. 'core.Units') or not (e.g. 'Units').
+    """
+    if '.' in neurodata_type:
+        namespace, neurodata_type = neurodata_type.rsplit('.', 1)
+        mask = pc.and_(
+            pc.equal(table['namespace'], namespace),
+            pc.equal(table['neurodata_type'], neurodata_type)
+        )
+    else:
+        mask = pc.equal(table['neurodata_type'], neurodata_type)
+    return table.filter(mask).select(['dandiset_id', 'asset_id', 'asset_path', 'path'])
+
+
+def _flatten_asset(dandiset_id: str, a: DandiNwbMetaAsset) -> List[dict]:
+    rows = []
+    all_groups, all_datasets = a.nwb_metadata.get_all_groups_and_datasets()
+    for kind, objects in [('group', all_groups), ('dataset', all_datasets)]:
+        for path, x in objects.items():
+            attributes = x.attributes or {}
+            dtype = getattr(x, 'dtype', None)
+            rows.append({
+                'dandiset_id': dandiset_id,
+                'asset_id': a.asset_id,
+                'asset_path': a.asset_path,
+                'kind': kind,
+                'path': path,
+                'neurodata_type': attributes.get('neurodata_type'),
+                'namespace': attributes.get('namespace'),
+                'dtype': dtype if dtype is None or isinstance(dtype, str) else json.dumps(dtype, default=str),
+                'shape': _int_list(getattr(x, 'shape', None)),
+                'chunks': _int_list(getattr(x, 'chunks', None)),
+                'compression': getattr(x, 'compression', None),
+                'attributes': json.dumps(attributes, default=str),
+            })
+    return rows
+
+
+def _int_list(x):
+    if x is None:
+        return None
+    return [int(d) if d is not None else None for d in x]
+
+
+if __name__ == '__main__':
+    main()
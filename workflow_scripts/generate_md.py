@@ -1,52 +1,52 @@
 from pydantic import BaseModel
-from typing import List, Dict
-from dandi_nwb_meta import fetch_all_dandisets, load_existing_output_from_bucket, DandiNwbMetaAsset
+from typing import List, Dict, Set, Tuple
+from dandi_nwb_meta import fetch_all_dandisets, load_existing_outputs_from_bucket, get_output_versions_from_bucket
 from tabulate import tabulate
 import datetime
+import json
+import os
 from h5tojson import H5ToJsonGroup, H5ToJsonDataset, H5ToJsonFile
 
 
-def main():
+def main(num_parallel_downloads: int = 16, summaries_fname: str = 'report_summaries.json'):
     dandisets = fetch_all_dandisets()
-
-    class Asset(BaseModel):
-        asset: DandiNwbMetaAsset
-        dandiset_id: str
-
-    all_assets: List[Asset] = []
-
-    for dandiset in dandisets:
-        X = load_existing_output_from_bucket(dandiset.dandiset_id)
+    dandiset_ids = [d.dandiset_id for d in dandisets]
+
+    # Only the outputs that changed since the last run are loaded; the other
+    # dandisets are taken from the summaries saved by that run.
+    summaries = _load_summaries(summaries_fname)
+    versions = get_output_versions_from_bucket(dandiset_ids, num_parallel=num_parallel_downloads)
+    new_summaries: Dict[str, DandisetSummary] = {}
+    changed_ids = []
+    for dandiset_id in dandiset_ids:
+        version = versions[dandiset_id]
+        if version is None:
+            continue
+        s = summaries.get(dandiset_id)
+        if version and s is not None and s.output_version == version:
+            new_summaries[dandiset_id] = s
+        else:
+            changed_ids.append(dandiset_id)
+    print(f'{len(changed_ids)} of {len(new_summaries) + len(changed_ids)} outputs changed since the last run')
+    for dandiset_id, X in load_existing_outputs_from_bucket(changed_ids, num_parallel=num_parallel_downloads, lazy=True):
         if not X:
-            print(f'No output for {dandiset.dandiset_id}')
+            print(f'No output for {dandiset_id}')
+            # The output has a version, so the download failed: keep the last
+            # summary, whose old version makes the output load again next run
+            if dandiset_id in summaries:
+                new_summaries[dandiset_id] = summaries[dandiset_id]
             continue
-        print(f'Found output for {dandiset.dandiset_id}')
-        for a in X.nwb_assets:
-            all_assets.append(Asset(asset=a, dandiset_id=dandiset.dandiset_id))
-
-    class NeurodataType(BaseModel):
-        neurodata_type: str
-        dandiset_ids: List[str]
-        path_counts: Dict[str, int]
-
-    neurodata_types: List[NeurodataType] = []
-    for a in all_assets:
-        all_groups, _ = a.asset.nwb_metadata.get_all_groups_and_datasets()
-        for path, g in all_groups.items():
-            if 'neurodata_type' in g.attributes:
-                nt = g.attributes.get('namespace', '') + '.' + g.attributes['neurodata_type']
-                existing = next((n for n in neurodata_types if n.neurodata_type == nt), None)
-                if not existing:
-                    existing = NeurodataType(neurodata_type=nt, dandiset_ids=[], path_counts={})
-                    neurodata_types.append(existing)
-                if a.dandiset_id not in existing.dandiset_ids:
-                    existing.dandiset_ids.append(a.dandiset_id)
-                if path not in existing.path_counts:
-                    existing.path_counts[path] = 0
-                existing.path_counts[path] += 1
+        print(f'Found output for {dandiset_id}')
+        new_summaries[dandiset_id] = summarize_output(X, versions[dandiset_id])
+    _save_summaries(summaries_fname, new_summaries)
+
+    aggregator = ReportAggregator()
+    for dandiset_id in dandiset_ids:
+        if dandiset_id in new_summaries:
+            aggregator.add_summary(new_summaries[dandiset_id])
 
     # sort by neurodata_type
-    neurodata_types = sorted(neurodata_types, key=lambda x: x.neurodata_type)
+    neurodata_types = sorted(aggregator.neurodata_types.values(), key=lambda x: x.neurodata_type)
 
     # Create a markdown table with links to dandisets
     table1 = []
@@ -83,24 +83,7 @@ def main():
         f.write(tabulate(table2, headers=['Neurodata Type', 'Paths'], tablefmt='github'))
 
     # Create a markdown table with neurodata_types for dandisets
-    class DandisetInfo(BaseModel):
-        dandiset_id: str
-        neurodata_types: List[str]
-        num_assets_processed: int
-    dandiset_infos: List[DandisetInfo] = []
-    for a in all_assets:
-        existing = next((d for d in dandiset_infos if d.dandiset_id == a.dandiset_id), None)
-        if not existing:
-            existing = DandisetInfo(dandiset_id=a.dandiset_id, neurodata_types=[], num_assets_processed=0)
-            dandiset_infos.append(existing)
-        existing.num_assets_processed += 1
-        all_groups, _ = a.asset.nwb_metadata.get_all_groups_and_datasets()
-        for path, g in all_groups.items():
-            if 'neurodata_type' in g.attributes:
-                nt = g.attributes.get('namespace', '') + '.' + g.attributes['neurodata_type']
-                if nt not in existing.neurodata_types:
-                    existing.neurodata_types.append(nt)
-    dandiset_infos = sorted(dandiset_infos, key=lambda x: x.dandiset_id)
+    dandiset_infos = sorted(aggregator.dandiset_infos.values(), key=lambda x: x.dandiset_id)
     table3 = []
     for d in dandiset_infos:
         dandiset_link = f'[{d.dandiset_id}](https://dandiarchive.org/dandiset/{d.dandiset_id})'
@@ -113,6 +96,119 @@ def main():
         f.write(tabulate(table3, headers=['Dandiset', 'Assets Processed', 'Neurodata Types'], tablefmt='github'))
 
 
+class NeurodataType(BaseModel):
+    neurodata_type: str
+    dandiset_ids: Set[str]
+    path_counts: Dict[str, int]
+
+
+class DandisetInfo(BaseModel):
+    dandiset_id: str
+    neurodata_types: Set[str]
+    num_assets_processed: int
+
+
+class DandisetSummary(BaseModel):
+    """What the reports need from the output of a dandiset."""
+    dandiset_id: str
+    # Version of the output the summary was made from (see get_output_versions_from_bucket)
+    output_version: str
+    num_assets: int
+    # Number of assets with a group of each neurodata type, by path
+    path_counts: Dict[str, Dict[str, int]]
+
+
+def summarize_output(X, output_version: str) -> DandisetSummary:
+    """Summarizes an output (DandiNwbMetaDandiset or LazyDandiNwbMetaDandiset)."""
+    aggregator = ReportAggregator()
+    for a in X.nwb_assets:
+        aggregator.add_asset(X.dandiset_id, a)
+    return DandisetSummary(
+        dandiset_id=X.dandiset_id,
+        output_version=output_version,
+        num_assets=len(X.nwb_assets),
+        path_counts={nt: n.path_counts for nt, n in aggregator.neurodata_types.items()},
+    )
+
+
+def _load_summaries(fname: str) -> Dict[str, DandisetSummary]:
+    if not os.path.exists(fname):
+        return {}
+    with open(fname, 'r') as f:
+        x = json.load(f)
+    return {s['dandiset_id']: DandisetSummary(**s) for s in x}
+
+
+def _save_summaries(fname: str, summaries: Dict[str, DandisetSummary]):
+    # Sorted and indented, so that the changes between runs are readable diffs
+    x = [summaries[k].dict() for k in sorted(summaries)]
+    with open(fname, 'w') as f:
+        json.dump(x, f, indent=1, sort_keys=True)
+
+
+class ReportAggregator:
+    """Accumulates the data for all reports, indexed by neurodata type and dandiset."""
+
+    def __init__(self):
+        self.neurodata_types: Dict[str, NeurodataType] = {}
+        self.dandiset_infos: Dict[str, DandisetInfo] = {}
+        # Typed groups by layout id; they are the same for all assets of a layout
+        self._layout_typed_groups: Dict[str, List[Tuple[str, str]]] = {}
+
+    def add_asset(self, dandiset_id: str, asset):
+        """Adds an asset (DandiNwbMetaAsset or LazyDandiNwbMetaAsset).
+
+        The metadata of an asset with a layout that was already seen is not decoded.
+        """
+        d = self.dandiset_infos.get(dandiset_id)
+        if d is None:
+            d = DandisetInfo(dandiset_id=dandiset_id, neurodata_types=set(), num_assets_processed=0)
+            self.dandiset_infos[dandiset_id] = d
+        d.num_assets_processed += 1
+        layout_id = getattr(asset, 'layout_id', None)
+        typed_groups = self._layout_typed_groups.get(layout_id) if layout_id is not None else None
+        if typed_groups is None:
+            typed_groups = _get_typed_groups(asset.nwb_metadata)
+            if layout_id is not None:
+                self._layout_typed_groups[layout_id] = typed_groups
+        for nt, path in typed_groups:
+            n = self.neurodata_types.get(nt)
+            if n is None:
+                n = NeurodataType(neurodata_type=nt, dandiset_ids=set(), path_counts={})
+                self.neurodata_types[nt] = n
+            n.dandiset_ids.add(dandiset_id)
+            n.path_counts[path] = n.path_counts.get(path, 0) + 1
+            d.neurodata_types.add(nt)
+
+    def add_summary(self, summary: DandisetSummary):
+        """Adds a dandiset from its summary."""
+        if summary.num_assets == 0:
+            return
+        self.dandiset_infos[summary.dandiset_id] = DandisetInfo(
+            dandiset_id=summary.dandiset_id,
+            neurodata_types=set(summary.path_counts),
+            num_assets_processed=summary.num_assets,
+        )
+        for nt, path_counts in summary.path_counts.items():
+            n = self.neurodata_types.get(nt)
+            if n is None:
+                n = NeurodataType(neurodata_type=nt, dandiset_ids=set(), path_counts={})
+                self.neurodata_types[nt] = n
+            n.dandiset_ids.add(summary.dandiset_id)
+            for path, count in path_counts.items():
+                n.path_counts[path] = n.path_counts.get(path, 0) + count
+
+
+def _get_typed_groups(nwb_metadata: H5ToJsonFile) -> List[Tuple[str, str]]:
+    """Returns the (namespace.neurodata_type, path) of each group with a neurodata type."""
+    ret = []
+    all_groups, _ = nwb_metadata.get_all_groups_and_datasets()
+    for path, g in all_groups.items():
+        if 'neurodata_type' in g.attributes:
+            ret.append((g.attributes.get('namespace', '') + '.' + g.attributes['neurodata_type'], path))
+    return ret
+
+
 def _abbrievate(x: List[str], max_num: int):
     if len(x) <= max_num:
         return x
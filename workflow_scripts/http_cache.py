@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from typing import BinaryIO, Union
+import requests
+
+
+class HttpCache:
+    """On-disk cache of HTTP objects, revalidated with conditional requests.
+
+    Each object is stored as a body file next to a small JSON file with its URL,
+    ETag and Last-Modified headers. Every get() sends a conditional request, so
+    an unchanged object costs one round trip without a body. When the bodies
+    take more than max_size bytes, the least recently used ones are evicted.
+    Bodies are returned as open files, so an evicted body stays readable by
+    the callers that already have it.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, session: requests.Session, url: str) -> Union[BinaryIO, None]:
+        """Returns the cached body of url opened in binary mode (None if the
+        object does not exist). The caller closes it."""
+        key = hashlib.sha1(url.encode()).hexdigest()
+        body_fname = os.path.join(self.cache_dir, f"{key}.body")
+        meta_fname = os.path.join(self.cache_dir, f"{key}.json")
+        meta = self._read_meta(meta_fname) if os.path.exists(body_fname) else None
+        # The stored body must be the object itself, not a compressed transfer of it
+        headers = {"Accept-Encoding": "identity"}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        with session.get(url, headers=headers, stream=True) as response:
+            if response.status_code == 304 and meta is not None:
+                with self._lock:
+                    try:
+                        f = open(body_fname, "rb")
+                    except FileNotFoundError:
+                        f = None
+                    else:
+                        # mark as recently used
+                        os.utime(body_fname)
+                if f is None:
+                    # evicted in the meantime
+                    return self.get(session, url)
+                return f
+            if response.status_code in (403, 404):
+                with self._lock:
+                    self._remove(key)
+                return None
+            response.raise_for_status()
+            tmp_fname = f"{body_fname}.{threading.get_ident()}.tmp"
+            # in case the server applied a Content-Encoding anyway
+            response.raw.decode_content = True
+            with open(tmp_fname, "wb") as f:
+                shutil.copyfileobj(response.raw, f, 1024 * 1024)
+            meta = {
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+        with self._lock:
+            os.replace(tmp_fname, body_fname)
+            with open(meta_fname, "w") as f:
+                json.dump(meta, f)
+            self._evict(keep=key)
+            return open(body_fname, "rb")
+
+    def _read_meta(self, meta_fname: str) -> Union[dict, None]:
+        try:
+            with open(meta_fname, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _remove(self, key: str):
+        for ext in [".body", ".json"]:
+            try:
+                os.remove(os.path.join(self.cache_dir, key + ext))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self, keep: str):
+        """Removes the least recently used bodies until the cache fits in max_size."""
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith(".body"):
+                st = os.stat(os.path.join(self.cache_dir, fname))
+                entries.append((st.st_mtime, st.st_size, fname[:-len(".body")]))
+        total_size = sum(x[1] for x in entries)
+        for _, size, key in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            self._remove(key)
+            total_size -= size
@@ -0,0 +1,61 @@
+import os
+import urllib.parse
+import urllib.request
+from typing import List
+
+from dandi_crawler import CrawledAsset
+
+
+# Directories that hold the chunks of a Zarr asset; they never contain NWB files
+_SKIPPED_DIR_SUFFIXES = (".zarr", ".ngff")
+
+
+def list_mirror_dandisets(mirror_dir: str) -> List[str]:
+    """Returns the sorted ids of the dandisets in a local mirror.
+
+    The mirror has one directory per dandiset, named by its id, holding the
+    assets at their paths in the dandiset (as laid out by dandi download).
+    """
+    return sorted(
+        name for name in os.listdir(mirror_dir)
+        if os.path.isdir(os.path.join(mirror_dir, name)) and not name.startswith(".")
+    )
+
+
+def list_mirror_assets(mirror_dir: str, dandiset_id: str) -> List[CrawledAsset]:
+    """Lists the NWB files of a dandiset in a local mirror, sorted by path.
+
+    The identifier of an asset is "local:" followed by its path, its
+    download_url is a file:// URL, and its blob id is made from its path,
+    size and modification time, so that a file that is rewritten in place is
+    extracted again.
+    """
+    root = os.path.join(mirror_dir, dandiset_id)
+    ret: List[CrawledAsset] = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.endswith(_SKIPPED_DIR_SUFFIXES)]
+        for fname in filenames:
+            if not fname.endswith(".nwb"):
+                continue
+            full_path = os.path.join(dirpath, fname)
+            path = os.path.relpath(full_path, root).replace(os.sep, "/")
+            st = os.stat(full_path)
+            ret.append(
+                CrawledAsset(
+                    identifier=f"local:{path}",
+                    path=path,
+                    size=st.st_size,
+                    blob=f"local:{path}:{st.st_size}:{st.st_mtime_ns}",
+                    download_url=get_file_url(full_path),
+                )
+            )
+    ret.sort(key=lambda a: a.path)
+    return ret
+
+
+def get_file_url(fname: str) -> str:
+    return "file://" + urllib.request.pathname2url(os.path.abspath(fname))
+
+
+def get_local_path(file_url: str) -> str:
+    return urllib.request.url2pathname(urllib.parse.urlparse(file_url).path)
@@ -0,0 +1,87 @@
+import json
+import os
+from typing import Any, Dict, List, Union
+
+from pydantic import BaseModel, Field
+
+from cost_model import CostHistory
+from s3_upload import _upload_bytes_to_s3
+
+
+class DandisetManifestEntry(BaseModel):
+    modified: str = Field(description="Modification timestamp from the dandiset listing")
+    digest: str = Field(description="Digest of the dandiset listing entry")
+    last_completed: float = Field(description="Unix time when all assets were last processed")
+    failed_asset_ids: List[str] = Field(
+        [], description="Identifiers of the assets whose extraction failed when last completed"
+    )
+
+
+class DandisetManifest(BaseModel):
+    dandisets: Dict[str, DandisetManifestEntry] = Field(
+        {}, description="Manifest entries by dandiset identifier"
+    )
+    output_keys: Dict[str, str] = Field(
+        {}, description="Key of the object that the output is loaded from, by dandiset identifier"
+    )
+
+
+def _get_object_key_for_manifest() -> str:
+    return "dandi-nwb-meta/manifest.json"
+
+
+def _get_object_key_for_cost_history() -> str:
+    return "dandi-nwb-meta/cost_history.json"
+
+
+def _load_manifest(s3: Union[Any, None]) -> DandisetManifest:
+    """Loads the manifest of completed dandisets (empty if there is none)."""
+    x = _load_json_object(s3, _get_object_key_for_manifest(), "dandisets/manifest.json")
+    return DandisetManifest(**x) if x is not None else DandisetManifest()
+
+
+def _save_manifest(s3: Union[Any, None], manifest: DandisetManifest):
+    _save_json_object(s3, _get_object_key_for_manifest(), "dandisets/manifest.json", manifest.dict())
+
+
+def _load_cost_history(s3: Union[Any, None]) -> CostHistory:
+    """Loads the history of asset extraction times (empty if there is none)."""
+    x = _load_json_object(s3, _get_object_key_for_cost_history(), "dandisets/cost_history.json")
+    return CostHistory(**x) if x is not None else CostHistory()
+
+
+def _save_cost_history(s3: Union[Any, None], cost_history: CostHistory):
+    _save_json_object(
+        s3, _get_object_key_for_cost_history(), "dandisets/cost_history.json", cost_history.dict()
+    )
+
+
+def _load_json_object(s3: Union[Any, None], object_key: str, local_fname: str) -> Union[dict, None]:
+    """Loads a JSON object from the bucket, or from local_fname if there is no
+    S3 client (None if missing)."""
+    if s3 is not None:
+        try:
+            obj = s3.get_object(Bucket="neurosift", Key=object_key)
+        except s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(obj["Body"].read())
+    else:
+        if not os.path.exists(local_fname):
+            return None
+        with open(local_fname, "r") as f:
+            return json.load(f)
+
+
+def _save_json_object(s3: Union[Any, None], object_key: str, local_fname: str, x: dict):
+    if s3 is not None:
+        _upload_bytes_to_s3(s3, "neurosift", object_key, json.dumps(x).encode(), "application/json")
+    else:
+        _write_local_json(local_fname, x, indent=2)
+
+
+def _write_local_json(fname: str, x: Any, **kwargs):
+    """Writes a JSON file through a temporary file, so that it is replaced atomically."""
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname + ".tmp", "w") as f:
+        json.dump(x, f, **kwargs)
+    os.replace(fname + ".tmp", fname)
@@ -0,0 +1,92 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Union
+
+
+class MetricsRecorder:
+    """Records timed events for the stages of a run.
+
+    Each event has a stage (e.g. "extract" or "upload"), a duration in
+    seconds and stage-specific fields such as dandiset_id, asset_id, bytes or
+    requests. If fname is given, every event is appended to it as a JSON
+    line as soon as it is recorded. Events are also kept in memory for
+    print_summary. Recording is thread-safe.
+    """
+
+    def __init__(self, fname: Union[str, None] = None):
+        self._fname = fname
+        self._lock = threading.Lock()
+        self._file = open(fname, "a") if fname is not None else None
+        self.events: List[dict] = []
+
+    def record(self, stage: str, seconds: float, **fields):
+        event = {"time": time.time(), "stage": stage, "seconds": seconds, **fields}
+        with self._lock:
+            self.events.append(event)
+            if self._file is not None:
+                self._file.write(json.dumps(event) + "\n")
+                self._file.flush()
+
+    @contextmanager
+    def timer(self, stage: str, **fields) -> Iterator[dict]:
+        """Records the duration of a block as an event.
+
+        Yields a dict to which the block can add fields. If the block raises,
+        the error is recorded with the event.
+        """
+        extra: Dict[str, object] = {}
+        t0 = time.time()
+        try:
+            yield extra
+        except Exception as e:
+            extra["error"] = str(e)
+            raise
+        finally:
+            self.record(stage, time.time() - t0, **fields, **extra)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def print_summary(self, top: int = 10):
+        """Prints the totals per stage and the slowest assets and dandisets."""
+        with self._lock:
+            events = list(self.events)
+        print("")
+        print("Time by stage")
+        stages: Dict[str, List[dict]] = {}
+        for e in events:
+            stages.setdefault(e["stage"], []).append(e)
+        for stage, x in stages.items():
+            total = sum(e["seconds"] for e in x)
+            slowest = max(e["seconds"] for e in x)
+            print(f"{stage} | {len(x)} events | {total:.1f} s total | {total / len(x):.2f} s mean | {slowest:.2f} s max")
+        extractions = [e for e in events if e["stage"] == "extract" and "error" not in e]
+        if extractions:
+            # Where the extraction time goes
+            fetch = sum(e.get("fetch_sec", 0) for e in extractions)
+            parse = sum(e.get("parse_sec", 0) for e in extractions)
+            validate = sum(e.get("validate_sec", 0) for e in extractions)
+            num_bytes = sum(e.get("bytes_fetched", 0) for e in extractions)
+            num_requests = sum(e.get("requests", 0) for e in extractions)
+            print(
+                f"extract breakdown | {fetch:.1f} s network | {parse:.1f} s parsing | "
+                f"{validate:.1f} s validation | {num_requests} requests | {num_bytes / 1e6:.1f} MB"
+            )
+        _print_slowest("Slowest assets", [e for e in events if e["stage"] == "extract"], top, ["dandiset_id", "asset_path"])
+        _print_slowest("Slowest dandisets", [e for e in events if e["stage"] == "dandiset"], top, ["dandiset_id"])
+
+
+def _print_slowest(title: str, events: List[dict], top: int, keys: List[str]):
+    if not events:
+        return
+    print("")
+    print(title)
+    for e in sorted(events, key=lambda e: e["seconds"], reverse=True)[:top]:
+        label = " | ".join(str(e.get(k)) for k in keys)
+        status = f" | error: {e['error']}" if "error" in e else ""
+        print(f"{label} | {e['seconds']:.1f} s{status}")
@@ -0,0 +1,83 @@
+import hashlib
+import json
+from typing import Any
+
+
+def fingerprint_layout(nwb_metadata: dict) -> str:
+    """Fingerprint of the structure of an NWB metadata tree (as a dict).
+
+    Two trees have the same fingerprint if they have the same groups and
+    datasets, the same attribute names, and the same neurodata types and
+    namespaces at each path. Shapes, dtypes and attribute values (other than
+    neurodata_type and namespace) can differ.
+    """
+    x = _get_skeleton(nwb_metadata.get("file") or {})
+    return hashlib.sha1(json.dumps(x, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def diff_tree(base: dict, x: dict) -> dict:
+    """Returns the delta that turns base into x (see apply_delta)."""
+    delta = {}
+    for k, v in x.items():
+        if k not in base:
+            delta[k] = [v]
+            continue
+        b = base[k]
+        if isinstance(v, dict) and isinstance(b, dict):
+            d = diff_tree(b, v)
+            if d:
+                delta[k] = d
+        elif type(v) is not type(b) or v != b:
+            delta[k] = [v]
+    for k in base:
+        if k not in x:
+            delta[k] = []
+    return delta
+
+
+def apply_delta(base: dict, delta: dict) -> dict:
+    """Applies a delta from diff_tree to a copy of base.
+
+    In a delta, a dict is the delta of a nested dict, [value] replaces or
+    adds a value and [] deletes it.
+    """
+    ret = {}
+    for k, v in base.items():
+        d = delta.get(k)
+        if d is None:
+            ret[k] = _copy_tree(v)
+        elif isinstance(d, dict):
+            ret[k] = apply_delta(v, d)
+        elif d:
+            ret[k] = _copy_tree(d[0])
+    for k, d in delta.items():
+        if k not in base:
+            ret[k] = _copy_tree(d[0])
+    return ret
+
+
+def _get_skeleton(g: dict) -> list:
+    attributes = g.get("attributes") or {}
+    return [
+        sorted(attributes.keys()),
+        attributes.get("neurodata_type"),
+        attributes.get("namespace"),
+        {k: _get_skeleton(v) for k, v in (g.get("groups") or {}).items()},
+        {
+            k: [
+                sorted((v.get("attributes") or {}).keys()),
+                (v.get("attributes") or {}).get("neurodata_type"),
+                (v.get("attributes") or {}).get("namespace"),
+            ]
+            for k, v in (g.get("datasets") or {}).items()
+        },
+    ]
+
+
+def _copy_tree(x: Any) -> Any:
+    # Faster than copy.deepcopy for trees of dicts, lists and scalars
+    if isinstance(x, dict):
+        return {k: _copy_tree(v) for k, v in x.items()}
+    if isinstance(x, list):
+        return [_copy_tree(v) for v in x]
+    return x
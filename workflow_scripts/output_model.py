@@ -0,0 +1,240 @@
+import json
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+from h5tojson import H5ToJsonFile
+from pydantic import BaseModel, Field
+
+from compact_encoding import decode_body
+from nwb_layouts import apply_delta
+
+
+class DandiNwbMetaAsset(BaseModel):
+    asset_id: str = Field(description="Asset identifier")
+    asset_path: str = Field(description="Asset path")
+    nwb_metadata: H5ToJsonFile = Field(description="NWB metadata")
+    download_url: Union[str, None] = Field(None, description="Download URL for the asset")
+    blob_id: Union[str, None] = Field(None, description="DANDI blob identifier of the asset content")
+
+
+class DandiNwbMetaDandiset(BaseModel):
+    dandiset_id: str = Field(description="Dandiset identifier")
+    dandiset_version: str = Field(description="Dandiset version")
+    nwb_assets: List[DandiNwbMetaAsset] = Field(description="List of assets")
+
+
+class LazyDandiNwbMetaAsset:
+    """An asset of an existing output whose nwb_metadata is parsed on demand.
+
+    Only the header fields (asset_id, asset_path, download_url, blob_id) are
+    kept as attributes. The metadata tree is decoded and validated when
+    nwb_metadata, load() or dict() is called. raw is the asset as a JSON
+    string or dict, its packed body from a compact output (with the header
+    given separately), or a function that fetches it (for sharded outputs, in
+    which case the header is given separately and shard_key is the object key
+    of the shard).
+
+    If the asset is stored as a delta from a shared layout (see
+    dandi_nwb_meta._iter_layout_deltas), layout_id is the id of that layout
+    in layouts, and the tree is rebuilt when it is decoded. Assets with the
+    same layout_id have the same groups, datasets and neurodata types.
+    """
+
+    def __init__(
+        self,
+        raw: Union[str, dict, bytes, Callable[[], dict]],
+        *,
+        header: Union[dict, None] = None,
+        shard_key: Union[str, None] = None,
+        layouts: Union[Dict[str, dict], None] = None,
+    ):
+        if header is None:
+            header = _parse_asset_header(raw) if isinstance(raw, str) else raw
+        self.asset_id: str = header["asset_id"]
+        self.asset_path: str = header["asset_path"]
+        self.download_url: Union[str, None] = header.get("download_url")
+        self.blob_id: Union[str, None] = header.get("blob_id")
+        self.layout_id: Union[str, None] = header.get("nwb_metadata_layout")
+        self.shard_key = shard_key
+        self._raw = raw
+        self._layouts = layouts
+
+    @property
+    def nwb_metadata(self) -> H5ToJsonFile:
+        return self.load().nwb_metadata
+
+    def load(self) -> DandiNwbMetaAsset:
+        return DandiNwbMetaAsset(**self.dict())
+
+    def dict(self) -> dict:
+        if isinstance(self._raw, str):
+            x = json.loads(self._raw)
+        elif isinstance(self._raw, dict):
+            x = dict(self._raw)
+        elif isinstance(self._raw, bytes):
+            x = decode_body(self._raw)
+        else:
+            x = self._raw()
+        if self.layout_id is not None:
+            x.pop("nwb_metadata_layout", None)
+            x["nwb_metadata"] = apply_delta(self._layouts[self.layout_id], x.pop("nwb_metadata_delta"))
+        x["asset_id"] = self.asset_id
+        x["asset_path"] = self.asset_path
+        x["download_url"] = self.download_url
+        x["blob_id"] = self.blob_id
+        return x
+
+    def get_json_line(self) -> Union[str, None]:
+        """Returns the asset as a line of a JSON output (see
+        dandi_nwb_meta._write_output) without decoding its tree, if it was
+        read from one (None otherwise).
+
+        The line is returned as it was read, with the header fields replaced
+        if they changed.
+        """
+        if not isinstance(self._raw, str) or self.layout_id is not None:
+            return None
+        i = self._raw.find(_ASSET_TREE_MARKER)
+        if i < 0:
+            return None
+        header = json.loads(self._raw[:i] + "}")
+        if header.keys() != _ASSET_HEADER_KEYS:
+            # An older line, with fields after the tree
+            return None
+        new_header = {
+            "asset_id": self.asset_id,
+            "asset_path": self.asset_path,
+            "download_url": self.download_url,
+            "blob_id": self.blob_id,
+        }
+        if header == new_header:
+            return self._raw
+        return json.dumps(new_header)[:-1] + self._raw[i:]
+
+    def get_shared_layout(self) -> Union[dict, None]:
+        """Returns the layout that the tree is stored as a delta from (None if there is none)."""
+        return self._layouts[self.layout_id] if self.layout_id is not None else None
+
+    def get_compact_body(self, layouts: Dict[str, dict]) -> Union[bytes, None]:
+        """Returns the packed body of an asset read from a compact output,
+        without decoding it, if its layout is the one in layouts (None
+        otherwise)."""
+        if not isinstance(self._raw, bytes) or self.layout_id is None:
+            return None
+        if layouts.get(self.layout_id) is not self.get_shared_layout():
+            return None
+        return self._raw
+
+    def copy(self, *, update: dict) -> "LazyDandiNwbMetaAsset":
+        """Returns a copy with some of the header fields replaced."""
+        ret = LazyDandiNwbMetaAsset.__new__(LazyDandiNwbMetaAsset)
+        ret.__dict__.update(self.__dict__)
+        ret.__dict__.update(update)
+        return ret
+
+
+# What precedes the metadata tree in the asset lines of a JSON output
+_ASSET_TREE_MARKER = ', "nwb_metadata": '
+_ASSET_HEADER_KEYS = {"asset_id", "asset_path", "download_url", "blob_id"}
+
+
+def _parse_asset_header(line: str) -> dict:
+    """Parses the header fields of an asset line without decoding its metadata tree.
+
+    dandi_nwb_meta._write_output writes nwb_metadata after all the header
+    fields. A quote inside a JSON string is escaped, so the first match of
+    the marker is the start of the tree. Lines of older outputs, with fields after the tree,
+    are decoded in full.
+    """
+    i = line.find(_ASSET_TREE_MARKER)
+    if i >= 0:
+        header = json.loads(line[:i] + "}")
+        if _ASSET_HEADER_KEYS <= header.keys():
+            return header
+    return json.loads(line)
+
+
+class LazyDandiNwbMetaDandiset:
+    """An existing output whose assets are LazyDandiNwbMetaAsset objects.
+
+    object_keys are the keys of the stored objects that the output was loaded
+    from, so that they can be deleted when the output is saved in another
+    layout (see dandi_nwb_meta._save_output).
+    """
+
+    def __init__(
+        self,
+        dandiset_id: str,
+        dandiset_version: str,
+        nwb_assets: List[LazyDandiNwbMetaAsset],
+        object_keys: Union[List[str], None] = None,
+    ):
+        self.dandiset_id = dandiset_id
+        self.dandiset_version = dandiset_version
+        self.nwb_assets = nwb_assets
+        self.object_keys = object_keys or []
+
+    def load(self) -> DandiNwbMetaDandiset:
+        return DandiNwbMetaDandiset(
+            dandiset_id=self.dandiset_id,
+            dandiset_version=self.dandiset_version,
+            nwb_assets=[a.load() for a in self.nwb_assets],
+        )
+
+
+class ExistingAssetIndex:
+    """Index of already-processed assets for constant-time lookup.
+
+    Assets are indexed by asset_id, by (path, blob_id) and by blob_id alone, so
+    that an asset that was renamed but has the same content is still found.
+    An asset found by asset_id whose blob_id is known and differs (a local
+    file rewritten in place) is not returned.
+    """
+
+    def __init__(self, assets: List[Union[DandiNwbMetaAsset, LazyDandiNwbMetaAsset]]):
+        self._by_asset_id: Dict[str, DandiNwbMetaAsset] = {}
+        self._by_path_and_blob_id: Dict[tuple, DandiNwbMetaAsset] = {}
+        self._by_blob_id: Dict[str, DandiNwbMetaAsset] = {}
+        for a in assets:
+            self._by_asset_id[a.asset_id] = a
+            if a.blob_id is not None:
+                self._by_path_and_blob_id[(a.asset_path, a.blob_id)] = a
+                self._by_blob_id.setdefault(a.blob_id, a)
+
+    def lookup(
+        self, asset_id: str, asset_path: str, blob_id: Union[str, None]
+    ) -> Union[DandiNwbMetaAsset, LazyDandiNwbMetaAsset, None]:
+        a = self._by_asset_id.get(asset_id)
+        if a is not None and (a.blob_id is None or blob_id is None or a.blob_id == blob_id):
+            return a
+        if blob_id is None:
+            return None
+        a = self._by_path_and_blob_id.get((asset_path, blob_id))
+        if a is not None:
+            return a
+        return self._by_blob_id.get(blob_id)
+
+
+def iter_output_assets(f) -> Tuple[dict, Iterator["LazyDandiNwbMetaAsset"]]:
+    """Reads an output from a text stream, one asset at a time.
+
+    Returns the dandiset fields and an iterator over the assets. Outputs
+    written by dandi_nwb_meta._write_output are read line by line; older
+    outputs (a single JSON document) are decoded at once, but their assets
+    are still only validated on demand.
+    """
+    first_line = f.readline().rstrip("\n")
+    marker = ', "nwb_assets": ['
+    if first_line.endswith(marker):
+        header = json.loads(first_line[:-len(marker)] + "}")
+
+        def _iter_assets():
+            for line in f:
+                line = line.rstrip("\n").rstrip(",")
+                if line == "]}":
+                    break
+                yield LazyDandiNwbMetaAsset(line)
+
+        return header, _iter_assets()
+    x = json.loads(first_line + f.read())
+    assets = x.pop("nwb_assets")
+    return x, (LazyDandiNwbMetaAsset(a) for a in assets)
@@ -0,0 +1,84 @@
+import multiprocessing
+import threading
+import weakref
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable
+
+
+class SharedProcessPool:
+    """A pool of extraction processes that lives for a whole run.
+
+    The workers are started with the spawn method, since forking a process
+    that runs other threads (uploads, other dandisets) can deadlock the child
+    on a lock held by one of them. They are started right away and import
+    the extraction modules at once, so that this cost is paid once per run
+    rather than inside the time budget of a dandiset. If a worker dies (e.g.
+    h5py crashes on a file), the tasks in flight fail and the pool is
+    replaced by a new one.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor = self._start()
+        # The pool that runs each task, to stop it (see terminate)
+        self._executors: "weakref.WeakKeyDictionary[Future, ProcessPoolExecutor]" = weakref.WeakKeyDictionary()
+
+    def submit(self, fn: Callable, *args) -> Future:
+        with self._lock:
+            executor = self._executor
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            with self._lock:
+                if self._executor is executor:
+                    print("An extraction process died; starting a new process pool")
+                    executor.shutdown(wait=False)
+                    self._executor = self._start()
+                executor = self._executor
+            future = executor.submit(fn, *args)
+        with self._lock:
+            self._executors[future] = executor
+        return future
+
+    def terminate(self, future: Future):
+        """Stops the task of future by killing the workers of its pool, which is replaced.
+
+        A process pool cannot stop a single task, so the other tasks in
+        flight on that pool fail with BrokenProcessPool.
+        """
+        with self._lock:
+            executor = self._executors.get(future)
+            if executor is not self._executor:
+                # Already replaced
+                return
+            print("Stopping the extraction processes; starting a new process pool")
+            self._executor = self._start()
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False)
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            self._executor.shutdown(wait=wait)
+
+    def __enter__(self) -> "SharedProcessPool":
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def _start(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        # A worker process is started for each task submitted while all are busy
+        for _ in range(self.max_workers):
+            executor.submit(_warm_up_worker)
+        return executor
+
+
+def _warm_up_worker():
+    # Import the extraction module, and with it h5py and h5tojson
+    import dandi_nwb_meta  # noqa: F401
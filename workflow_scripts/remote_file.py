@@ -0,0 +1,242 @@
+import io
+import os
+import re
+import shutil
+import threading
+import time
+from typing import Dict, List, Tuple, Union
+import requests
+
+
+def evict_block_cache(cache_dir: str, max_size: int):
+    """Removes the blocks of the least recently used files from a block cache
+    until it takes at most max_size bytes.
+
+    Must not run while files of the cache are being read.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    entries: List[Tuple[float, int, str]] = []
+    for name in os.listdir(cache_dir):
+        block_dir = os.path.join(cache_dir, name)
+        if not os.path.isdir(block_dir):
+            continue
+        size = 0
+        mtime = os.stat(block_dir).st_mtime
+        for fname in os.listdir(block_dir):
+            st = os.stat(os.path.join(block_dir, fname))
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime)
+        entries.append((mtime, size, block_dir))
+    total_size = sum(x[1] for x in entries)
+    for _, size, block_dir in sorted(entries):
+        if total_size <= max_size:
+            break
+        shutil.rmtree(block_dir, ignore_errors=True)
+        total_size -= size
+
+
+class CachedRemoteFile(io.RawIOBase):
+    """Read-only file object for a remote file, read with HTTP range requests.
+
+    The file is read in aligned blocks. Missing blocks that are adjacent are
+    fetched in a single request, and runs of sequential reads fetch
+    progressively more blocks ahead (up to max_fetch_size). The first
+    prefetch_size bytes, which hold the HDF5 superblock and usually the root
+    group and its B-trees, are fetched on open. A server that ignores the
+    Range header is an error, rather than a download of the whole file.
+
+    If cache_dir is given, every fetched block is also stored on disk under
+    cache_dir/cache_key, along with the size of the file, so a retried or
+    interrupted extraction of the same asset does not read those bytes again
+    (not even on open). Call clear_cache() once the blocks are no longer
+    needed.
+
+    If a deadline (unix time) is given, any fetch after it raises a
+    TimeoutError, which cancels the read that needed it.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        *,
+        session: requests.Session,
+        cache_dir: Union[str, None] = None,
+        cache_key: Union[str, None] = None,
+        block_size: int = 64 * 1024,
+        prefetch_size: int = 1024 * 1024,
+        max_fetch_size: int = 8 * 1024 * 1024,
+        deadline: Union[float, None] = None,
+    ):
+        super().__init__()
+        self._url = url
+        self._session = session
+        self._deadline = deadline
+        self._block_size = block_size
+        self._max_fetch_blocks = max(1, max_fetch_size // block_size)
+        self._fetch_blocks = 1
+        self._blocks: Dict[int, bytes] = {}
+        self._pos = 0
+        self._last_read_end = -1
+        self._block_dir = (
+            os.path.join(cache_dir, cache_key) if cache_dir is not None and cache_key is not None else None
+        )
+        if self._block_dir is not None:
+            os.makedirs(self._block_dir, exist_ok=True)
+        self.num_requests = 0
+        self.num_bytes_fetched = 0
+        self.num_blocks_from_disk = 0
+        # Time spent waiting for HTTP responses
+        self.fetch_sec = 0.0
+        self._lock = threading.Lock()
+        self._size = self._open(max(block_size, prefetch_size))
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._size + offset
+        else:
+            raise ValueError(f"Unexpected whence: {whence}")
+        return self._pos
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self._size - self._pos)
+        if n <= 0:
+            return 0
+        start, end = self._pos, self._pos + n
+        with self._lock:
+            self._ensure_blocks(start, end)
+            view = memoryview(b)
+            i = 0
+            for block_index in range(start // self._block_size, (end - 1) // self._block_size + 1):
+                block = self._blocks[block_index]
+                block_start = block_index * self._block_size
+                a = max(start, block_start) - block_start
+                z = min(end, block_start + len(block)) - block_start
+                view[i:i + z - a] = block[a:z]
+                i += z - a
+        self._pos = end
+        return n
+
+    def clear_cache(self):
+        """Removes the blocks of this file from the disk cache."""
+        if self._block_dir is not None:
+            shutil.rmtree(self._block_dir, ignore_errors=True)
+
+    def _ensure_blocks(self, start: int, end: int):
+        first = start // self._block_size
+        last = (end - 1) // self._block_size
+        # Sequential reads fetch progressively larger runs of blocks
+        if start == self._last_read_end:
+            self._fetch_blocks = min(self._fetch_blocks * 2, self._max_fetch_blocks)
+        else:
+            self._fetch_blocks = 1
+        self._last_read_end = end
+        num_blocks = (self._size + self._block_size - 1) // self._block_size
+        block_index = first
+        while block_index <= last:
+            if block_index in self._blocks or self._load_block_from_disk(block_index):
+                block_index += 1
+                continue
+            # Coalesce this missing block with the following missing ones
+            run_end = block_index + 1
+            while (
+                run_end < num_blocks
+                and run_end - block_index < max(last + 1 - block_index, self._fetch_blocks)
+                and run_end not in self._blocks
+                and not self._block_on_disk(run_end)
+            ):
+                run_end += 1
+            self._fetch_range(block_index * self._block_size, min(run_end * self._block_size, self._size))
+            block_index = run_end
+
+    def _get(self, start: int, end: int) -> Tuple[bytes, str]:
+        """Fetches a byte range; returns the data and the Content-Range header."""
+        if self._deadline is not None and time.time() > self._deadline:
+            raise TimeoutError(f"Time limit exceeded while reading {self._url}")
+        t0 = time.time()
+        # Streamed, so that the body of a response to an ignored range is not read
+        with self._session.get(
+            self._url, headers={"Range": f"bytes={start}-{end - 1}"}, timeout=(10, 60), stream=True
+        ) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise IOError(f"Range request not supported for {self._url}")
+            # Subsequent requests go straight to the redirect target
+            self._url = response.url
+            data = response.content
+            content_range = response.headers.get("Content-Range", "")
+        self.fetch_sec += time.time() - t0
+        self.num_requests += 1
+        return data, content_range
+
+    def _open(self, length: int) -> int:
+        """Returns the size of the file, and fetches its first length bytes
+        unless they are in the disk cache."""
+        size = self._load_size_from_disk()
+        if size is not None and self._load_block_from_disk(0):
+            return size
+        data, content_range = self._get(0, length)
+        m = re.match(r"bytes \d+-\d+/(\d+)", content_range)
+        if m is None:
+            raise IOError(f"Unexpected Content-Range for {self._url}: {content_range!r}")
+        size = int(m.group(1))
+        self._store(0, data)
+        if self._block_dir is not None:
+            _write_atomically(os.path.join(self._block_dir, "size"), str(size).encode())
+        return size
+
+    def _fetch_range(self, start: int, end: int):
+        data, _ = self._get(start, end)
+        self._store(start, data)
+
+    def _store(self, start: int, data: bytes):
+        self.num_bytes_fetched += len(data)
+        for i in range(0, len(data), self._block_size):
+            block_index = (start + i) // self._block_size
+            block = data[i:i + self._block_size]
+            self._blocks[block_index] = block
+            if self._block_dir is not None:
+                _write_atomically(os.path.join(self._block_dir, str(block_index)), block)
+
+    def _load_size_from_disk(self) -> Union[int, None]:
+        if self._block_dir is None:
+            return None
+        try:
+            with open(os.path.join(self._block_dir, "size"), "r") as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _block_on_disk(self, block_index: int) -> bool:
+        return self._block_dir is not None and os.path.exists(os.path.join(self._block_dir, str(block_index)))
+
+    def _load_block_from_disk(self, block_index: int) -> bool:
+        if not self._block_on_disk(block_index):
+            return False
+        with open(os.path.join(self._block_dir, str(block_index)), "rb") as f:
+            self._blocks[block_index] = f.read()
+        self.num_blocks_from_disk += 1
+        return True
+
+
+def _write_atomically(fname: str, data: bytes):
+    with open(fname + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(fname + ".tmp", fname)
@@ -0,0 +1,160 @@
+import io
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+
+from metrics import MetricsRecorder
+
+
+def _create_s3_client():
+    if os.environ.get("AWS_ACCESS_KEY_ID") is None:
+        return None
+    return boto3.client(
+        "s3",
+        aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
+        aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
+        endpoint_url=os.environ["S3_ENDPOINT_URL"],
+        region_name="auto",  # for cloudflare
+        # enough connections for all upload threads and multipart parts
+        config=BotoConfig(max_pool_connections=50, retries={"mode": "adaptive"}),
+    )
+
+
+_s3_client: Union[Any, None] = None
+_s3_client_created = False
+_s3_client_lock = threading.Lock()
+
+
+def _get_s3_client():
+    """Returns the S3 client shared by all workers (None without credentials)."""
+    global _s3_client, _s3_client_created
+    with _s3_client_lock:
+        if not _s3_client_created:
+            _s3_client = _create_s3_client()
+            _s3_client_created = True
+        return _s3_client
+
+
+class BackgroundUploader:
+    """Runs uploads on background threads so that processing can continue.
+
+    Each upload is labeled (by dandiset id); wait() blocks until all uploads
+    are done and returns the error messages of the failed ones by label.
+    """
+
+    def __init__(self, num_threads: int = 4):
+        self._executor = ThreadPoolExecutor(max_workers=num_threads)
+        self._futures: List[Tuple[str, Future]] = []
+
+    def submit(self, label: str, fn: Callable[[], None]):
+        self._futures.append((label, self._executor.submit(fn)))
+
+    def wait(self) -> Dict[str, str]:
+        errors: Dict[str, str] = {}
+        for label, future in self._futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(str(e))
+                print(f"Failed to upload output for {label}")
+                errors[label] = str(e)
+        self._futures = []
+        return errors
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+def _upload_objects_to_s3(
+    s3,
+    objects: List[Tuple[str, bytes, str]],
+    *,
+    label: str,
+    uploader: Union[BackgroundUploader, None],
+    metrics: Union[MetricsRecorder, None] = None,
+    delete_keys: Union[List[str], None] = None,
+    on_uploaded: Union[Callable[[List[str]], None], None] = None,
+):
+    """Uploads (object_key, data, content_type) objects in order, then deletes delete_keys.
+
+    The deletions only happen once all the uploads succeeded. on_uploaded is
+    then called with the keys that could not be deleted. The upload is
+    recorded as an "upload" event in metrics, if given.
+    """
+    def _upload():
+        with (metrics or MetricsRecorder()).timer(
+            "upload", dandiset_id=label, num_objects=len(objects), bytes=sum(len(x[1]) for x in objects)
+        ):
+            for object_key, data, content_type in objects:
+                print(f"Uploading output to {object_key}")
+                _upload_bytes_to_s3(s3, "neurosift", object_key, data, content_type)
+            undeleted_keys = []
+            for object_key in delete_keys or []:
+                print(f"Deleting stale object {object_key}")
+                if not _delete_file_from_s3(s3, "neurosift", object_key):
+                    undeleted_keys.append(object_key)
+        if on_uploaded is not None:
+            on_uploaded(undeleted_keys)
+
+    if uploader is not None:
+        uploader.submit(label, _upload)
+    else:
+        _upload()
+
+
+# Objects above 8 MB are uploaded in 8 MB parts, several parts at once
+_transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+)
+
+
+def _upload_bytes_to_s3(s3, bucket, object_key, data: bytes, content_type: str):
+    s3.upload_fileobj(
+        io.BytesIO(data),
+        bucket,
+        object_key,
+        ExtraArgs={"ContentType": content_type},
+        Config=_transfer_config,
+    )
+
+
+def _upload_file_to_s3(s3, bucket, object_key, fname):
+    if fname.endswith(".html"):
+        content_type = "text/html"
+    elif fname.endswith(".js"):
+        content_type = "application/javascript"
+    elif fname.endswith(".css"):
+        content_type = "text/css"
+    elif fname.endswith(".png"):
+        content_type = "image/png"
+    elif fname.endswith(".jpg"):
+        content_type = "image/jpeg"
+    elif fname.endswith(".svg"):
+        content_type = "image/svg+xml"
+    elif fname.endswith(".json"):
+        content_type = "application/json"
+    elif fname.endswith(".gz"):
+        content_type = "application/gzip"
+    else:
+        content_type = None
+    extra_args = {}
+    if content_type is not None:
+        extra_args["ContentType"] = content_type
+    s3.upload_file(fname, bucket, object_key, ExtraArgs=extra_args)
+
+
+def _delete_file_from_s3(s3, bucket, object_key) -> bool:
+    try:
+        s3.delete_object(Bucket=bucket, Key=object_key)
+    except Exception as e:
+        print(str(e))
+        print("Failed to delete file from S3.")
+        return False
+    return True